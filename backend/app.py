@@ -1,26 +1,24 @@
+import asyncio
 import dotenv
+import json
 import os
 import logging
 import uvicorn
 from opentelemetry import trace
 
 #from dapr.ext.fastapi import DaprApp
-from msal import ConfidentialClientApplication
-from azure.core.credentials import AzureKeyCredential
 from fastapi import FastAPI, Depends, Response, status
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from contextlib import asynccontextmanager
 from typing import Annotated, Optional
 from pydantic import BaseModel
 
-from orchestration import SharePointRagOrchestrator
+import services
 from auth import CallContext, get_user_id
-from filestorage import FileStorage
-from notificationhub import NotificationChannel, NotificationHub
-from completions import ChatCompletions
-from telemetry import setup_telemetry, get_logger
+from notificationhub import NotificationChannel
+from telemetry import setup_telemetry, get_logger, render_metrics, METRICS_CONTENT_TYPE
 from indexer_schema import ensure_index_exists
 
 
@@ -28,24 +26,48 @@ dotenv.load_dotenv()
 
 setup_telemetry()
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+# state of the background index verification, reported by /health
+index_status = {"state": "pending"}
+
+async def verify_index():
     try:
         get_logger().info("Ensuring index exists...")
         # Only try to ensure index exists if we have the required environment variables
         if all(os.getenv(var) for var in ["INDEXER_ENDPOINT", "INDEXER_INDEX", "INDEXER_MANAGE_KEY", "OPENAI_ENDPOINT", "OPENAI_APIKEY"]):
-            ensure_index_exists(
+            await asyncio.to_thread(ensure_index_exists,
                 os.getenv("INDEXER_ENDPOINT"),
                 os.getenv("INDEXER_INDEX"),
                 os.getenv("INDEXER_MANAGE_KEY"),
                 os.getenv("OPENAI_ENDPOINT"),
                 os.getenv("OPENAI_APIKEY"),
-                os.getenv("OPENAI_EMBEDDINGS_MODEL") )
+                os.getenv("OPENAI_EMBEDDINGS_MODEL"),
+                services.credential() )
+            index_status["state"] = "ready"
         else:
             get_logger().warning("Skipping index initialization - missing required environment variables")
+            index_status["state"] = "skipped"
     except Exception as e:
         get_logger().error(f"Failed to initialize index: {e}")
+        index_status["state"] = "failed"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # index verification runs in the background so it doesn't hold back readiness
+    verification = asyncio.create_task(verify_index())
+    background = [verification]
+
+    if os.getenv("CRAWLER_ENABLED", "false").lower() == "true":
+        import crawler
+        delta_crawler = crawler.from_env(services.msal_app(), services.orchestrator())
+        background.append(asyncio.create_task(
+            delta_crawler.run_forever(float(os.getenv("CRAWLER_INTERVAL_SECONDS", "300")))))
+
     yield
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    # async clients and the shared HTTP session, after the background work stopped using them
+    await services.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -62,28 +84,18 @@ app.add_middleware(
 # Health check endpoint
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "index": index_status["state"]}
+
+# Prometheus scrape endpoint, independent of Application Insights
+@app.get("/metrics")
+async def metrics():
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 #dapr_app = DaprApp(app)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-tenant_id = os.getenv("TENANT_ID")
-access_principal_delegated = ConfidentialClientApplication(
-    os.getenv("CLIENT_ID"), 
-    authority=f"https://login.microsoftonline.com/{tenant_id}", 
-    client_credential=os.getenv("CLIENT_SECRET"))
-
-orchestrator = SharePointRagOrchestrator(access_principal_delegated)
-
-storage = FileStorage( 
-    storage_account_name=os.getenv("BLOB_STORAGE_ACCOUNT_NAME"),
-    container_name=os.getenv("BLOB_CONTAINER_NAME"))
-
-notification_hub = NotificationHub(os.getenv("WEBPUBSUB_CONNECTION_STRING"), 'hub')
 
-chat_completions = ChatCompletions(os.getenv("OPENAI_ENDPOINT"),
-    os.getenv("OPENAI_COMPLETIONS_MODEL_TEXT"), 
-    os.getenv("OPENAI_COMPLETIONS_MODEL_VISUAL"))
+# clients (MSAL, storage, notification hub, completions, ...) are created lazily in services.py
 
 class SearchRequestItem(BaseModel):
     """
@@ -104,6 +116,25 @@ class CompletionRequestItem(BaseModel):
     text: str
     image: Optional[str] = None
 
+class GroundedCompletionRequestItem(BaseModel):
+    """
+    Question to answer from several fragments at once.
+    fragment_ids: ids of fragments as returned by /suggestions or /indexed, best first
+    include_images: also send the snapshots of the fragments to the visual model
+    max_context_tokens: token budget for the packed fragments, at most COMPLETIONS_MAX_CONTEXT_TOKENS
+    """
+    query: str
+    fragment_ids: list[str]
+    include_images: Optional[bool] = False
+    max_context_tokens: Optional[int] = None
+
+class AskRequestItem(BaseModel):
+    """
+    Natural-language query, the SharePoint keywords are extracted on the server.
+    """
+    query: str
+    max_results: Optional[int] = 3
+
 class KeywordExtractionRequest(BaseModel):
     """
     Request to extract keywords from a search query using LLM.
@@ -139,7 +170,7 @@ async def suggestions_from_sharepoint(
 
         activity.add_event(f"Reaching out to SharePoint for '{item.keywords}'")
 
-        return await orchestrator.search(item.keywords, item.query, ctx, item.max_results)
+        return await services.orchestrator().search(item.keywords, item.query, ctx, item.max_results)
 
 @app.post("/indexed")
 async def suggestions_from_index(
@@ -153,7 +184,25 @@ async def suggestions_from_index(
         ctx = CallContext.for_user(token)
 
         activity.add_event(f"Looking for '{item.query}' in the index")
-        return await orchestrator.search_indexed(item.query, ctx, item.max_results)
+        return await services.orchestrator().search_indexed(item.query, ctx, item.max_results)
+
+@app.post("/ask")
+async def ask(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    item: AskRequestItem):
+    """
+    Combines keyword extraction, /indexed and /suggestions in one call. Streams newline-delimited JSON:
+    {"stage": "indexed", "results": [...]} as soon as the existing index answered,
+    {"stage": "keywords", "keywords": "..."} once the model extracted them, and
+    {"stage": "refined", "results": [...]} after the SharePoint search and indexing of new documents.
+    """
+    ctx = CallContext.for_user(token)
+
+    async def stages():
+        async for result in services.orchestrator().ask(item.query, ctx, item.max_results):
+            yield json.dumps(result, default=str) + "\n"
+
+    return StreamingResponse(stages(), media_type="application/x-ndjson")
 
 @app.get("/media/{filename}", response_class=RedirectResponse, status_code=302)
 async def media_file(filename: str, response: Response):
@@ -161,7 +210,7 @@ async def media_file(filename: str, response: Response):
     Returns a redirect to a media file from the storage account.
     """
     try :
-        return RedirectResponse(storage.get_link(filename))
+        return RedirectResponse(await services.storage().get_link(filename))
     except:
         response.status_code = status.HTTP_404_NOT_FOUND
         return None
@@ -172,7 +221,7 @@ async def media_url(filename: str, response: Response):
     Returns a URL to the media file including the SAS token.
     """        
     try :
-        return storage.get_link(filename)
+        return await services.storage().get_link(filename)
     except:
         response.status_code = status.HTTP_404_NOT_FOUND
         return None    
@@ -184,7 +233,7 @@ async def get_notification_client_token(
     Obtains a token for the client to establish a connection 
     with the notification hub.
     """        
-    return notification_hub.negotiate(get_user_id(token))
+    return await asyncio.to_thread(services.notification_hub().negotiate, get_user_id(token))
 
 @app.post("/indexed/item")
 async def ensure_index(
@@ -195,7 +244,7 @@ async def ensure_index(
     where we can delegate indexing to a separate process.
     """
     ctx = CallContext.for_user(token)
-    docid = await orchestrator.ensure_index(search_result, ctx)
+    docid = await services.orchestrator().ensure_index(search_result, ctx)
     return docid
 
 
@@ -207,10 +256,10 @@ async def extract_keywords(
     Extract keywords from a search query using LLM.
     """
     ctx = CallContext.for_user(token)
-    intercom = NotificationChannel(notification_hub, ctx)
+    intercom = NotificationChannel(services.notification_hub(), ctx)
     
     try:
-        keywords = await chat_completions.extract_keywords(item.query)
+        keywords = await services.chat_completions().extract_keywords(item.query)
         return {"keywords": keywords}
     except Exception as e:
         intercom.send(f"Failed to extract keywords: {e}")
@@ -226,11 +275,11 @@ async def completions(
 
     ctx = CallContext.for_user(token)
     
-    intercom = NotificationChannel(notification_hub, ctx)
+    intercom = NotificationChannel(services.notification_hub(), ctx)
         
     imageUrl = None
     if not item.image is None:
-        imageUrl = storage.get_link(item.image)
+        imageUrl = await services.storage().get_link(item.image)
         intercom_message  = "Asking a visual model for help, it may take a while..."
     else:
         intercom_message  = "Asking a model for help, should be back in a jiffy..."
@@ -238,7 +287,7 @@ async def completions(
     intercom.send(intercom_message)
 
     try:
-        result = await chat_completions.generate(item.query, item.text, imageUrl)
+        result = await services.chat_completions().generate(item.query, item.text, imageUrl)
         intercom.send(f"Here we go")
 
     except Exception as e:
@@ -247,6 +296,51 @@ async def completions(
     
     return result
 
+@app.post("/completions/grounded")
+async def grounded_completions(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    item: GroundedCompletionRequestItem,
+    response: Response):
+    """
+    Answers the query from the given fragments in a single model call, with citations.
+    The token budget is the server's, a client may only lower it.
+    """
+    # every fragment costs a lookup and a permission check before anything is packed
+    max_fragments = int(os.getenv("COMPLETIONS_MAX_FRAGMENTS", "20"))
+    if len(item.fragment_ids) > max_fragments:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": f"At most {max_fragments} fragments can be used for an answer"}
+
+    ctx = CallContext.for_user(token)
+
+    intercom = NotificationChannel(services.notification_hub(), ctx)
+
+    fragments = await services.orchestrator().get_fragments(item.fragment_ids, ctx)
+    if len(fragments) == 0:
+        return {"answer": "", "citations": [], "truncated": False}
+
+    image_urls = {}
+    if item.include_images:
+        with_snapshots = [f for f in fragments if f["snapshot"]]
+        links = await asyncio.gather(*[services.storage().get_link(f["snapshot"]) for f in with_snapshots])
+        image_urls = { f["id"]: link for f, link in zip(with_snapshots, links) }
+
+    intercom.send(f"Asking a model to answer from {len(fragments)} fragments...")
+
+    max_context_tokens = int(os.getenv("COMPLETIONS_MAX_CONTEXT_TOKENS", "6000"))
+    try:
+        result = await services.chat_completions().generate_grounded(
+            item.query,
+            fragments,
+            image_urls,
+            max_context_tokens=min(item.max_context_tokens or max_context_tokens, max_context_tokens))
+        intercom.send(f"Here we go")
+    except Exception as e:
+        intercom.send(f"Oops, something went wrong: {e}")
+        result = {"answer": "", "citations": [], "truncated": False}
+
+    return result
+
 if __name__ == "__main__":
     try:
         port = int(os.getenv('PORT', 8085))
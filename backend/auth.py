@@ -1,10 +1,19 @@
+import asyncio
 import base64
 from dataclasses import dataclass
 import json
+import os
 from msal import ConfidentialClientApplication
+from telemetry import count_cache, stage
 
 SCOPES = ["https://graph.microsoft.com/.default"]
 
+def graph_url(path: str) -> str:
+    """
+    Absolute Graph URL, GRAPH_ENDPOINT points to a different endpoint (e.g. the load-test stand-in).
+    """
+    return os.getenv("GRAPH_ENDPOINT", "https://graph.microsoft.com/v1.0") + path
+
 @dataclass
 class CallContext:
     """
@@ -30,16 +39,20 @@ def get_user_id(token: str):
     user_id = user_json['oid']
     return user_id
     
-def get_token(app: ConfidentialClientApplication, ctx: CallContext = None):
+async def get_token(app: ConfidentialClientApplication, ctx: CallContext = None):
     """
     Obtains the token for the downstream API or reuses the existing one.
+    MSAL calls the identity platform synchronously, that happens in a worker thread.
     """
     
     if ctx.token:
+        count_cache("obo-token", True)
         return ctx.token
     
     if ctx.user_token:
-        token = app.acquire_token_on_behalf_of(ctx.user_token, SCOPES)
+        count_cache("obo-token", False)
+        with stage("obo-token"):
+            token = await asyncio.to_thread(app.acquire_token_on_behalf_of, ctx.user_token, SCOPES)
     
     ctx.token = token["access_token"]
     
@@ -49,5 +62,6 @@ def get_app_token(app: ConfidentialClientApplication):
     """
     Retrieves an token for the app using the client credentials flow.
     """
-    token = app.acquire_token_for_client(scopes=SCOPES)
+    with stage("app-token"):
+        token = app.acquire_token_for_client(scopes=SCOPES)
     return token["access_token"]
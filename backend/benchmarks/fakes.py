@@ -0,0 +1,292 @@
+"""
+Local stand-ins for Graph, Azure OpenAI, Azure AI Search, Blob Storage and Web PubSub, used by the
+load-test harness (benchmarks/loadtest.py). They answer just enough of each API for the request path
+of /suggestions, /indexed and the completion endpoints, with injected latency, slow outliers and 429 responses.
+
+    python -m benchmarks.fakes --base-port 9100 --latency graph=80:20 --tail graph=0.05:3000 --latency openai=400 --throttle openai=0.05
+
+The services listen on consecutive ports in the order of SERVICES. Every document is reported as
+indexed and fresh, so the harness measures the request path and not ingestion.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import re
+import time
+from dataclasses import dataclass
+from urllib.parse import unquote
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+SERVICES = ["graph", "openai", "search", "storage", "pubsub"]
+
+# a handful of documents shared by all fake responses, permission checks are memoized per document
+DOCUMENTS = 5
+DRIVE_ID = "b!loadtest"
+
+@dataclass
+class Behavior:
+    """
+    latency_ms and jitter_ms: added to every response (uniform jitter)
+    tail_share and tail_ms: share of responses delayed by another tail_ms (slow outliers)
+    throttle: share of requests answered with 429 and a Retry-After of retry_after_ms
+    """
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    tail_share: float = 0
+    tail_ms: float = 0
+    throttle: float = 0
+    retry_after_ms: int = 200
+
+    async def apply(self) -> Response | None:
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if self.tail_share > 0 and random.random() < self.tail_share:
+            delay += self.tail_ms
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.throttle > 0 and random.random() < self.throttle:
+            return JSONResponse(
+                {"error": {"code": "TooManyRequests", "message": "Injected throttling"}},
+                status_code=429,
+                headers={"retry-after-ms": str(self.retry_after_ms), "Retry-After": str(max(1, self.retry_after_ms // 1000))})
+        return None
+
+def service_app(name: str, behavior: Behavior, handler) -> FastAPI:
+    """
+    One catch-all app per service, handler(request, path) returns the response of the real API.
+    """
+    app = FastAPI(title=f"fake-{name}")
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "HEAD"])
+    async def dispatch(path: str, request: Request):
+        throttled = await behavior.apply()
+        if throttled is not None:
+            return throttled
+        return await handler(request, "/" + path)
+
+    return app
+
+def _document(n: int) -> dict:
+    return {
+        "id": f"item{n}",
+        "name": f"Document {n}.pdf",
+        "title": f"Document {n}"
+    }
+
+async def graph(request: Request, path: str):
+    if path.endswith("/search/query"):
+        body = await request.json()
+        size = body["requests"][0].get("size", 3)
+        hits = []
+        for n in range(size):
+            document = _document(n % DOCUMENTS)
+            hits.append({
+                "summary": f"... {document['title']} ...",
+                "rank": n + 1,
+                "resource": {
+                    "id": document["id"],
+                    "name": document["name"],
+                    "lastModifiedDateTime": "2024-01-01T00:00:00Z",
+                    "parentReference": {"driveId": DRIVE_ID},
+                    "listItem": {"fields": {"title": document["title"]}}
+                }})
+        return {"value": [{"hitsContainers": [{"hits": hits, "total": len(hits)}]}]}
+
+    match = re.search(r"/drives/([^/]+)/items/([^/?]+)$", path)
+    if match:
+        item_id = match.group(2)
+        return {
+            "id": item_id,
+            "name": f"{item_id}.pdf",
+            "webUrl": f"https://contoso.sharepoint.com/{item_id}.pdf",
+            "lastModifiedDateTime": "2024-01-01T00:00:00Z",
+            "cTag": f"c:{item_id},1",
+            "eTag": f"e:{item_id},1",
+            "size": 1024,
+            "@microsoft.graph.downloadUrl": f"{request.base_url}download/{item_id}"
+        }
+    return JSONResponse({"error": {"code": "itemNotFound"}}, status_code=404)
+
+async def openai(request: Request, path: str):
+    body = await request.json()
+    if path.endswith("/embeddings"):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions", 1536)
+        tokens = sum(len(str(i).split()) for i in inputs)
+        return {
+            "object": "list",
+            "model": body.get("model", "embeddings"),
+            "data": [{"object": "embedding", "index": i, "embedding": [0.01] * dimensions} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+    if path.endswith("/chat/completions"):
+        prompt_tokens = len(json.dumps(body.get("messages", [])).split())
+        completion_tokens = min(body.get("max_tokens") or 100, 60)
+        return {
+            "id": "chatcmpl-loadtest",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "completions"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "A canned answer from the load-test stand-in [1]."}
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+    return JSONResponse({"error": {"code": "NotFound"}}, status_code=404)
+
+def _chunk(n: int) -> dict:
+    document = _document(n % DOCUMENTS)
+    return {
+        "id": f"{DRIVE_ID}-{document['id']}-{n}",
+        "chunk": n,
+        "content": f"Fragment {n} of {document['title']}. " * 20,
+        "uri": f"https://contoso.sharepoint.com/{document['id']}.pdf",
+        "title": document["title"],
+        "documentId": f"b_loadtest-{document['id']}",
+        "driveId": DRIVE_ID,
+        "driveItemId": document["id"],
+        "snapshot": None,
+        "lastModified": "2024-01-01T00:00:00Z"
+    }
+
+async def search(request: Request, path: str):
+    if path.endswith("/docs/search.post.search"):
+        body = await request.json()
+        top = body.get("top") or 50
+        if "-manifest" in path:
+            # the document tier of two-stage queries
+            return {"value": [{"@search.score": 1.0 - n / 100, "id": f"b_loadtest-{_document(n)['id']}"} for n in range(min(top, DOCUMENTS))]}
+        return {"value": [{"@search.score": 1.0 - n / 100, **_chunk(n)} for n in range(top)]}
+    if path.endswith("/docs/search.index"):
+        body = await request.json()
+        return {"value": [{"key": d.get("id"), "status": True, "statusCode": 200} for d in body["value"]]}
+
+    match = re.search(r"docs\('([^']*)'\)", unquote(path))
+    if match and request.method == "GET":
+        key = match.group(1)
+        if "-manifest" in unquote(path):
+            # every document is fresh, nothing gets re-indexed
+            return {"id": key, "lastModified": "2099-01-01T00:00:00Z", "contentTag": "c:loadtest", "chunkCount": 1, "chunkHashes": [], "indexed": "2024-01-01T00:00:00Z"}
+        n = int(key.rsplit("-", 1)[-1]) if key.rsplit("-", 1)[-1].isdigit() else 0
+        return {**_chunk(n), "id": key}
+    return JSONResponse({"error": {"code": "NotFound"}}, status_code=404)
+
+async def storage(request: Request, path: str):
+    if request.method == "PUT":
+        await request.body()
+        return Response(status_code=201, headers={"ETag": '"0x1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+    if request.method in ("GET", "HEAD"):
+        return Response(content=b"\x89PNG\r\n", media_type="image/png")
+    return Response(status_code=202)
+
+async def pubsub(request: Request, path: str):
+    await request.body()
+    return Response(status_code=202)
+
+HANDLERS = {"graph": graph, "openai": openai, "search": search, "storage": storage, "pubsub": pubsub}
+
+# Azurite's well-known development key, only ever used against the stand-in
+ACCOUNT_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+def environment(base_port: int, host: str = "127.0.0.1") -> dict:
+    """
+    Backend settings pointing every client at the stand-ins.
+    """
+    ports = {name: base_port + i for i, name in enumerate(SERVICES)}
+    access_key = base64.b64encode(b"loadtest-access-key-0123456789abcdef").decode()
+    return {
+        "GRAPH_ENDPOINT": f"http://{host}:{ports['graph']}/v1.0",
+        "OPENAI_ENDPOINT": f"http://{host}:{ports['openai']}",
+        "OPENAI_EMBEDDINGS_MODEL": "embeddings",
+        "OPENAI_COMPLETIONS_MODEL_TEXT": "completions",
+        "OPENAI_COMPLETIONS_MODEL_VISUAL": "completions",
+        "INDEXER_ENDPOINT": f"http://{host}:{ports['search']}",
+        "INDEXER_INDEX": "loadtest",
+        "INDEXER_APIKEY": "loadtest",
+        "BLOB_CONNECTION_STRING": f"DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey={ACCOUNT_KEY};BlobEndpoint=http://{host}:{ports['storage']}/devstoreaccount1;",
+        "BLOB_CONTAINER_NAME": "snapshots",
+        "WEBPUBSUB_CONNECTION_STRING": f"Endpoint=http://{host}:{ports['pubsub']};AccessKey={access_key};Version=1.0;",
+    }
+
+class FakeCredential:
+    """
+    Async token credential for the OpenAI token provider, the stand-ins don't check tokens.
+    """
+    async def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        return AccessToken("loadtest", int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+class FakeMsal:
+    """
+    Replaces the ConfidentialClientApplication, OBO and client credential tokens without Entra ID.
+    """
+    def acquire_token_on_behalf_of(self, user_assertion, scopes, **kwargs):
+        return {"access_token": "loadtest"}
+
+    def acquire_token_for_client(self, scopes, **kwargs):
+        return {"access_token": "loadtest"}
+
+def parse_behaviors(latency: list[str], throttle: list[str], retry_after_ms: int, tail: list[str] = ()) -> dict[str, Behavior]:
+    """
+    --latency service=ms[:jitter], --tail service=share:ms and --throttle service=share, service "all" applies to every service.
+    """
+    behaviors = {name: Behavior(retry_after_ms=retry_after_ms) for name in SERVICES}
+
+    def targets(name: str) -> list[str]:
+        if name == "all":
+            return SERVICES
+        if name not in behaviors:
+            raise ValueError(f"Unknown service {name}, expected one of {', '.join(SERVICES)}")
+        return [name]
+
+    for spec in latency:
+        name, value = spec.split("=", 1)
+        ms, _, jitter = value.partition(":")
+        for target in targets(name):
+            behaviors[target].latency_ms = float(ms)
+            behaviors[target].jitter_ms = float(jitter or 0)
+    for spec in tail:
+        name, value = spec.split("=", 1)
+        share, _, ms = value.partition(":")
+        for target in targets(name):
+            behaviors[target].tail_share = float(share)
+            behaviors[target].tail_ms = float(ms or 0)
+    for spec in throttle:
+        name, value = spec.split("=", 1)
+        for target in targets(name):
+            behaviors[target].throttle = float(value)
+    return behaviors
+
+async def serve(base_port: int, behaviors: dict[str, Behavior], host: str = "127.0.0.1"):
+    servers = [
+        uvicorn.Server(uvicorn.Config(service_app(name, behaviors[name], HANDLERS[name]), host=host, port=base_port + i, log_level="warning"))
+        for i, name in enumerate(SERVICES)]
+    await asyncio.gather(*[s.serve() for s in servers])
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--base-port", type=int, default=9100, help="first port, the services follow in the order " + ", ".join(SERVICES))
+    parser.add_argument("--latency", action="append", default=[], help="service=ms[:jitter], e.g. openai=400:100 or all=20")
+    parser.add_argument("--tail", action="append", default=[], help="service=share:ms of slow outliers, e.g. graph=0.05:3000")
+    parser.add_argument("--throttle", action="append", default=[], help="service=share of 429 responses, e.g. openai=0.05")
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stand-in services of the load-test harness")
+    add_arguments(parser)
+    args = parser.parse_args()
+    behaviors = parse_behaviors(args.latency, args.throttle, args.retry_after_ms, args.tail)
+    for i, name in enumerate(SERVICES):
+        print(f"{name:8} :{args.base_port + i} {behaviors[name]}", flush=True)
+    asyncio.run(serve(args.base_port, behaviors))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Peak RSS of PDF ingestion, to verify that memory stays bounded by a page rather than the document.
+
+Generates synthetic PDFs (technical-drawing-like pages with text and many lines, so every page is
+rendered, classified as worth keeping and encoded) with an increasing number of pages and ingests each
+in a fresh interpreter like the orchestrator does: a MemoryBudget reservation, the streamed download
+(from a local HTTP server) into the DocumentCache and PdfProcessor on the cached file. It reports the
+peak RSS, with streaming and page-by-page processing the peak must not grow with the page count.
+backend/tests/test_ingestion_memory.py runs the same check with INGESTION_MEMORY_TEST=true.
+
+    python -m benchmarks.ingestion_memory --pages 20,200 --max-growth-mb 50 [--max-rss-mb 400]
+"""
+import argparse
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import asyncio, json, resource, sys
+sys.path.insert(0, {backend!r})
+from documentcache import DocumentCache
+from drive import DriveFileFetcher
+from memorybudget import MemoryBudget
+from pdfprocessor import PdfProcessor
+
+class DiscardingStorage:
+    # stands in for blob storage, snapshots are encoded but not kept
+    async def exists(self, filename):
+        return False
+    async def put(self, file, filename, content_type=None, metadata=None, overwrite=True):
+        return True
+
+# like in the orchestrator, download and split() run in worker threads, storage calls on the event loop
+async def ingest():
+    item = {{"id": "benchmark", "contentTag": "benchmark", "size": {size}, "downloadUrl": {url!r}}}
+    budget = MemoryBudget(1024 * 1024 * 1024)
+    async with budget.reserve(MemoryBudget.estimate("benchmark.pdf", item["size"])):
+        path = await asyncio.to_thread(DriveFileFetcher(None).download, "benchmark", item, DocumentCache({cache!r}, 1024 * 1024 * 1024))
+        processor = PdfProcessor(path, DiscardingStorage(), loop=asyncio.get_running_loop())
+        return await asyncio.to_thread(lambda: sum(1 for _ in processor.split("benchmark")))
+
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+fragments = asyncio.run(ingest())
+print(json.dumps({{
+    "fragments": fragments,
+    "baseline_kb": baseline,
+    "peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+}}))
+"""
+
+def generate_pdf(path: str, pages: int):
+    import fitz
+
+    doc = fitz.open()
+    for n in range(pages):
+        # A3 landscape, rendered at 150 dpi like in ingestion
+        page = doc.new_page(width=1191, height=842)
+        page.insert_text((40, 40), f"Synthetic drawing sheet {n + 1} of {pages}", fontsize=14)
+        for i in range(60):
+            offset = 60 + i * 12 + n % 7
+            page.draw_line((40, offset), (1150, offset), width=0.5)
+            page.draw_line((40 + i * 18, 60), (40 + i * 18, 800), width=0.5)
+        page.insert_textbox(fitz.Rect(900, 700, 1150, 820), f"Title block {n}\nScale 1:50\nRevision {n % 3}", fontsize=9)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def measure(path: str) -> dict:
+    """
+    Ingests the PDF in a fresh interpreter, downloading it from a local HTTP server like from SharePoint.
+    """
+    directory, filename = os.path.split(path)
+    handler = functools.partial(QuietHandler, directory=directory)
+    with ThreadingHTTPServer(("127.0.0.1", 0), handler) as server, tempfile.TemporaryDirectory() as cache:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            completed = subprocess.run(
+                [sys.executable, "-c", PROBE.format(
+                    backend=BACKEND_DIR,
+                    url=f"http://127.0.0.1:{server.server_address[1]}/{filename}",
+                    size=os.path.getsize(path),
+                    cache=cache)],
+                cwd=BACKEND_DIR,
+                capture_output=True,
+                text=True,
+                check=True)
+        finally:
+            server.shutdown()
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def run(page_counts: list[int]) -> list[dict]:
+    """
+    Peak RSS of ingesting synthetic documents of the given page counts, smallest first.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for pages in page_counts:
+            path = os.path.join(directory, f"synthetic-{pages}.pdf")
+            generate_pdf(path, pages)
+            result = measure(path)
+            result["pages"] = pages
+            result["file_mb"] = os.path.getsize(path) / 1024 / 1024
+            results.append(result)
+    return results
+
+def growth_mb(results: list[dict]) -> float:
+    return (results[-1]["peak_kb"] - results[0]["peak_kb"]) / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS of PDF processing for growing documents")
+    parser.add_argument("--pages", default="20,200", help="comma separated page counts, smallest first")
+    parser.add_argument("--max-growth-mb", type=float, default=50, help="fail if the peak grows more than this from the smallest to the largest document")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="fail if any peak exceeds this")
+    args = parser.parse_args()
+
+    results = run([int(p) for p in args.pages.split(",")])
+    for result in results:
+        print(f"{result['pages']:>5} pages, {result['file_mb']:>7.1f} MB file: "
+              f"baseline {result['baseline_kb'] / 1024:>6.1f} MB, peak {result['peak_kb'] / 1024:>6.1f} MB", flush=True)
+
+    growth = growth_mb(results)
+    print(f"peak growth from {results[0]['pages']} to {results[-1]['pages']} pages: {growth:.1f} MB")
+
+    failed = False
+    if growth > args.max_growth_mb:
+        print(f"FAIL: peak RSS grows with the document by more than {args.max_growth_mb} MB")
+        failed = True
+    if args.max_rss_mb is not None and max(r["peak_kb"] for r in results) / 1024 > args.max_rss_mb:
+        print(f"FAIL: peak RSS above {args.max_rss_mb} MB")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
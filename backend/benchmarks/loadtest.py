@@ -0,0 +1,200 @@
+"""
+Endpoint-level load test of a single backend worker against local stand-ins (benchmarks/fakes.py).
+
+Starts the stand-ins and the FastAPI app (one uvicorn worker, clients pointed at the stand-ins) in
+separate processes, then drives a mix of concurrent users against /suggestions, /indexed,
+/completions/chat, /completions/grounded and /ask. Every user sends its next request as soon as the
+previous one returned (closed loop). Several user counts run one after the other, which shows where
+latency collapses. Reports throughput, p50/p95/p99 latency and the error rate per endpoint.
+
+    python -m benchmarks.loadtest --users 10,50,100 --duration 30 --mix indexed=3,suggestions=1,chat=1 \\
+                                  --latency graph=80:20 --latency openai=400:100 --throttle openai=0.02
+
+--json writes the results for comparisons between runs, --max-p95-ms fails the run on a regression.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks import fakes
+
+ENDPOINTS = {
+    "suggestions": ("/suggestions", lambda n: {"keywords": f"contract {n % 7}", "query": "What is the notice period?", "max_results": 3}),
+    "indexed": ("/indexed", lambda n: {"keywords": "", "query": f"What is the notice period of contract {n % 7}?", "max_results": 3}),
+    "chat": ("/completions/chat", lambda n: {"query": "Summarize the fragment", "text": "Fragment text. " * 50}),
+    # streamed, the latency covers all stages
+    "ask": ("/ask", lambda n: {"query": f"What is the notice period of contract {n % 7}?", "max_results": 3}),
+    "grounded": ("/completions/grounded", lambda n: {"query": "What is the notice period?", "fragment_ids": [f"{fakes.DRIVE_ID}-item{i}-{i}" for i in range(3)]}),
+}
+
+def user_token(n: int) -> str:
+    """
+    An unsigned JWT, the app only reads the oid (for notifications) and passes the token on to the fake MSAL.
+    auth.get_user_id decodes with the standard alphabet, so the payload avoids the URL-safe one.
+    """
+    def encode(value: dict) -> str:
+        return base64.b64encode(json.dumps(value).encode()).decode().rstrip("=")
+    return f"{encode({'alg': 'none'})}.{encode({'oid': f'00000000-0000-0000-0000-{n:012d}'})}.signature"
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for spec in mix.split(","):
+        name, _, weight = spec.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {name}, expected one of {', '.join(ENDPOINTS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+async def run_stage(base_url: str, users: int, duration: float, weights: dict[str, float]) -> dict:
+    import httpx
+
+    samples = {name: [] for name in weights}
+    errors = {name: 0 for name in weights}
+    names = list(weights)
+    deadline = time.monotonic() + duration
+
+    async def user(n: int, client):
+        headers = {"Authorization": f"Bearer {user_token(n)}"}
+        request = 0
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights=[weights[e] for e in names])[0]
+            path, body = ENDPOINTS[name]
+            start = time.perf_counter()
+            try:
+                response = await client.post(base_url + path, json=body(request), headers=headers)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            samples[name].append(time.perf_counter() - start)
+            if not ok:
+                errors[name] += 1
+            request += 1
+
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.monotonic()
+        await asyncio.gather(*[user(n, client) for n in range(users)])
+        elapsed = time.monotonic() - started
+
+    result = {"users": users, "seconds": elapsed, "endpoints": {}}
+    for name in names:
+        latencies = samples[name]
+        if len(latencies) == 0:
+            continue
+        result["endpoints"][name] = {
+            "requests": len(latencies),
+            "rps": len(latencies) / elapsed,
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "error_rate": errors[name] / len(latencies)
+        }
+    return result
+
+def print_stage(result: dict):
+    print(f"\n{result['users']} users, {result['seconds']:.0f}s")
+    print(f"{'endpoint':12} {'requests':>9} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, e in result["endpoints"].items():
+        print(f"{name:12} {e['requests']:>9} {e['rps']:>8.1f} {e['p50_ms']:>8.0f} {e['p95_ms']:>8.0f} {e['p99_ms']:>8.0f} {e['error_rate']:>6.1%}")
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up within {timeout}s")
+
+def serve_app(port: int):
+    """
+    Runs the backend like in production, only the identity clients are swapped for fakes.
+    """
+    import uvicorn
+    import services
+
+    services.override("async_credential", fakes.FakeCredential())
+    services.override("msal_app", fakes.FakeMsal())
+
+    import app
+    uvicorn.run(app.app, host="127.0.0.1", port=port, log_level="warning")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the backend endpoints against local stand-ins")
+    parser.add_argument("--users", default="10,50", help="comma separated concurrent user counts, run one after the other")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per user count")
+    parser.add_argument("--mix", default="indexed=3,suggestions=1,chat=1", help="endpoint weights, endpoints: " + ", ".join(ENDPOINTS))
+    parser.add_argument("--port", type=int, default=8185, help="port of the backend under test")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--max-p95-ms", type=float, default=None, help="fail if any endpoint exceeds this p95")
+    parser.add_argument("--serve-app", action="store_true", help=argparse.SUPPRESS)
+    fakes.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.serve_app:
+        serve_app(args.port)
+        return
+
+    weights = parse_mix(args.mix)
+    env = {
+        **os.environ,
+        **fakes.environment(args.base_port),
+        # keep the run self-contained, whatever the local .env says (dotenv doesn't override)
+        "APPLICATIONINSIGHTS_CONNECTION_STRING": "",
+        "INDEXER_MANAGE_KEY": "",
+        "CRAWLER_ENABLED": "false",
+        "DOCUMENT_CACHE_DIR": os.path.join(tempfile.gettempdir(), "sharepoint-rag-loadtest"),
+    }
+    fake_args = [f"--base-port={args.base_port}", f"--retry-after-ms={args.retry_after_ms}"] + \
+        [f"--latency={s}" for s in args.latency] + [f"--tail={s}" for s in args.tail] + [f"--throttle={s}" for s in args.throttle]
+
+    fake_process = subprocess.Popen([sys.executable, "-m", "benchmarks.fakes", *fake_args], cwd=BACKEND_DIR, env=env)
+    app_process = subprocess.Popen([sys.executable, "-m", "benchmarks.loadtest", "--serve-app", f"--port={args.port}"], cwd=BACKEND_DIR, env=env)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{args.base_port}/", fake_process)
+        base_url = f"http://127.0.0.1:{args.port}"
+        wait_until_ready(base_url + "/health", app_process)
+
+        results = []
+        for users in [int(u) for u in args.users.split(",")]:
+            result = asyncio.run(run_stage(base_url, users, args.duration, weights))
+            print_stage(result)
+            results.append(result)
+    finally:
+        app_process.terminate()
+        fake_process.terminate()
+        app_process.wait()
+        fake_process.wait()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"mix": weights, "results": results}, f, indent=2)
+
+    if args.max_p95_ms is not None:
+        slow = [(r["users"], name) for r in results for name, e in r["endpoints"].items() if e["p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"FAIL: p95 above {args.max_p95_ms} ms for " + ", ".join(f"{name} at {users} users" for users, name in slow))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Latency and recall of two-stage retrieval (document tier, then chunks) against the single-stage query.
+
+For every index, e.g. copies of the corpus at different sizes filled with reindex.py, and every width of
+the document stage, runs each query the way /indexed does, once single-stage and once two-stage, and
+reports p50/p95 latency and recall@k: the share of the single-stage top k the two-stage query returns too.
+The two-stage latency includes embedding the query, which the single-stage query leaves to the index's
+vectorizer. Documents indexed before the document tier have no centroid, re-index them first.
+
+    python -m benchmarks.retrieval --queries queries.txt --index <small> --index <large> [--documents 10,20,50] [-k 30]
+
+The queries file has one query per line.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import dotenv
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.vectors import percentile
+
+async def run_queries(indexer, queries: list[str], k: int) -> tuple[list[list[str]], list[float]]:
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        hits = await indexer.get_from_index(query=query, k=k)
+        latencies.append(time.perf_counter() - start)
+        results.append([h["id"] for h in hits])
+    return results, latencies
+
+def print_row(label: str, latencies: list[float], recall: float = None):
+    recall_text = f"{recall:>8.3f}" if recall is not None else f"{'-':>8}"
+    print(f"{label:>16} {statistics.median(latencies) * 1000:>8.0f} {percentile(latencies, 95) * 1000:>8.0f} {recall_text}")
+
+async def benchmark(args, queries: list[str]):
+    import services
+    from indexer import Indexer
+
+    widths = [int(w) for w in args.documents.split(",")]
+    try:
+        for index in args.index or [os.getenv("INDEXER_INDEX")]:
+            indexer = Indexer(os.getenv("INDEXER_ENDPOINT"), index, services.embeddings(), services.async_credential(), services.transport())
+            try:
+                documents = await indexer.manifest_client.get_document_count()
+                chunks = await indexer.search_client.get_document_count()
+                print(f"\n{index}: {documents} documents, {chunks} chunks, {len(queries)} queries, k={args.k}")
+                print(f"{'stage':>16} {'p50 ms':>8} {'p95 ms':>8} {'recall':>8}")
+
+                indexer.top_documents = 0
+                expected, latencies = await run_queries(indexer, queries, args.k)
+                print_row("single", latencies)
+
+                for width in widths:
+                    indexer.top_documents = width
+                    found, latencies = await run_queries(indexer, queries, args.k)
+                    recalls = [len(set(e) & set(f)) / len(e) for e, f in zip(expected, found) if e]
+                    print_row(f"two-stage {width}", latencies, statistics.mean(recalls) if recalls else None)
+            finally:
+                await indexer.close()
+    finally:
+        await services.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two-stage retrieval with the single-stage query")
+    parser.add_argument("--queries", required=True, help="text file with one query per line")
+    parser.add_argument("--index", action="append", default=[], help="index to run against, repeat for several corpus sizes, defaults to INDEXER_INDEX")
+    parser.add_argument("--documents", default="10,20,50", help="comma separated widths of the document stage")
+    parser.add_argument("-k", type=int, default=30, help="chunks per query, /indexed asks for ten times max_results")
+    args = parser.parse_args()
+
+    dotenv.load_dotenv(os.path.join(BACKEND_DIR, ".env"))
+
+    with open(args.queries, "r", encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    asyncio.run(benchmark(args, queries))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Cold start benchmark for a single backend worker.
+
+Imports app.py in fresh interpreters and reports the import time and the resident set size
+right after startup, which is what a scale-to-zero container pays on its first request.
+It also lists heavy document libraries that got loaded eagerly (they should only load on ingestion).
+
+    python -m benchmarks.startup --runs 5 --max-seconds 3 --max-rss-mb 250
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["fitz", "cv2", "numpy", "PyPDF2", "tiktoken", "docx"]
+
+PROBE = f"""
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "import_seconds": elapsed,
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "heavy_modules": [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+}}))
+"""
+
+def run_once() -> dict:
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - start
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold start time and baseline RSS of the backend")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None, help="fail if the median import time exceeds this")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="fail if the median baseline RSS exceeds this")
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+
+    import_seconds = statistics.median(r["import_seconds"] for r in runs)
+    process_seconds = statistics.median(r["process_seconds"] for r in runs)
+    rss_mb = statistics.median(r["rss_kb"] for r in runs) / 1024
+    heavy = sorted({m for r in runs for m in r["heavy_modules"]})
+
+    print(f"runs:               {args.runs}")
+    print(f"import app (p50):   {import_seconds:.3f}s")
+    print(f"process (p50):      {process_seconds:.3f}s")
+    print(f"baseline RSS (p50): {rss_mb:.1f} MB")
+    print(f"heavy modules:      {', '.join(heavy) if heavy else 'none'}")
+
+    failed = False
+    if args.max_seconds is not None and import_seconds > args.max_seconds:
+        print(f"FAIL: import time above {args.max_seconds}s")
+        failed = True
+    if args.max_rss_mb is not None and rss_mb > args.max_rss_mb:
+        print(f"FAIL: baseline RSS above {args.max_rss_mb} MB")
+        failed = True
+    if heavy:
+        print("FAIL: document libraries are imported at startup")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Recall and latency of a (compressed, reduced or re-tuned) vector index.
+
+Runs every query as a pure vector query against the index under test with the regular HNSW search,
+and against the baseline index with an exhaustive (exact) search. Recall@k is the share of the
+baseline top k found in the top k of the index under test. The baseline defaults to the same
+index, which isolates the loss of the approximate search and the compression.
+
+    python -m benchmarks.vectors --queries queries.txt --index <index> [--baseline-index <index>] [-k 10]
+
+The queries file has one query per line.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import dotenv
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+def run_query(client, query: str, k: int, exhaustive: bool) -> tuple[list[str], float]:
+    from azure.search.documents.models import VectorizableTextQuery
+
+    q = VectorizableTextQuery(text=query, fields="embedding", k_nearest_neighbors=k, exhaustive=exhaustive)
+    start = time.perf_counter()
+    results = client.search(search_text=None, vector_queries=[q], select=["id"], top=k)
+    ids = [r["id"] for r in results]
+    return ids, time.perf_counter() - start
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recall and latency of a vector index against an exhaustive baseline")
+    parser.add_argument("--queries", required=True, help="text file with one query per line")
+    parser.add_argument("--index", default=None, help="index under test, defaults to INDEXER_INDEX")
+    parser.add_argument("--baseline-index", default=None, help="index for the exhaustive baseline, defaults to --index")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    dotenv.load_dotenv(os.path.join(BACKEND_DIR, ".env"))
+
+    import services
+    from azure.search.documents import SearchClient
+
+    index = args.index or os.getenv("INDEXER_INDEX")
+    baseline_index = args.baseline_index or index
+    client = SearchClient(os.getenv("INDEXER_ENDPOINT"), index, services.credential())
+    baseline_client = SearchClient(os.getenv("INDEXER_ENDPOINT"), baseline_index, services.credential())
+
+    with open(args.queries, "r", encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    recalls = []
+    latencies = []
+    baseline_latencies = []
+    for query in queries:
+        expected, baseline_seconds = run_query(baseline_client, query, args.k, exhaustive=True)
+        found, seconds = run_query(client, query, args.k, exhaustive=False)
+        if expected:
+            recalls.append(len(set(expected) & set(found)) / len(expected))
+        latencies.append(seconds)
+        baseline_latencies.append(baseline_seconds)
+
+    print(f"queries:            {len(queries)}")
+    print(f"index:              {index} (hnsw)")
+    print(f"baseline:           {baseline_index} (exhaustive)")
+    print(f"recall@{args.k}:          {statistics.mean(recalls):.3f}" if recalls else "recall: no baseline results")
+    print(f"latency p50/p95:    {statistics.median(latencies) * 1000:.0f} / {percentile(latencies, 95) * 1000:.0f} ms")
+    print(f"baseline p50/p95:   {statistics.median(baseline_latencies) * 1000:.0f} / {percentile(baseline_latencies, 95) * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    main()
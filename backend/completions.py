@@ -1,16 +1,21 @@
 from openai import AsyncAzureOpenAI
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from ratelimit import limiter
+from telemetry import count_tokens, stage
+
+# rough cost of one image in the prompt (a high detail 1024x1024 image)
+IMAGE_TOKEN_COST = 765
 
 class ChatCompletions:
     """
     A helper to call the OpenAI chat completions endpoint. 
     """
-    def __init__(self, api_endpoint, engine_text, engine_visual=None):
+    def __init__(self, api_endpoint, engine_text, engine_visual=None, credential: DefaultAzureCredential = None):
         self.engine_text = engine_text
         # assign engine_visual to self.engine_visual if not null, otherwise engine_text
         self.engine_visual = engine_text if engine_visual is None else engine_visual
         
-        token_provider = get_bearer_token_provider(DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
+        token_provider = get_bearer_token_provider(credential or DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
 
         self.client = AsyncAzureOpenAI(
             azure_endpoint=api_endpoint,
@@ -26,42 +31,132 @@ class ChatCompletions:
         else:
             engine_to_use = self.engine_text 
 
-        response = await self.client.chat.completions.create(
-            model=engine_to_use,
-            messages=[
-                {
-                "role": "user",
-                "content": content,
-                },
-                {
-                "role": "user",
-                "content": [ {"type": "text", "text": prompt} ],
-                },                
-            ],
-            max_tokens=max_tokens,
-            )
+        with stage("completion", model=engine_to_use, visual=image_url is not None):
+            response = await self.__create(
+                model=engine_to_use,
+                messages=[
+                    {
+                    "role": "user",
+                    "content": content,
+                    },
+                    {
+                    "role": "user",
+                    "content": [ {"type": "text", "text": prompt} ],
+                    },                
+                ],
+                max_tokens=max_tokens,
+                )
+        ChatCompletions.__count_usage(response, engine_to_use)
         return response.choices[0].message.content
     
+    async def generate_grounded(self, prompt: str, fragments: list[dict], image_urls: dict[str, str] = None,
+                                max_context_tokens: int = 6000, max_tokens: int = 500) -> dict:
+        """
+        Answers the prompt from several fragments in one model call. Fragments are packed in the given
+        (rank) order until max_context_tokens is used up, the last one is trimmed to fit. image_urls maps
+        fragment ids to snapshot links, images are included while the budget allows.
+        The answer cites fragments as [n], the returned citations map n to the fragment.
+        """
+        encoding = ChatCompletions.__encoding()
+        image_urls = image_urls or {}
+
+        budget = max_context_tokens
+        content = []
+        citations = []
+        truncated = False
+        for fragment in fragments:
+            header = f"[{len(citations) + 1}] {fragment['title']}\n"
+            tokens = encoding.encode(fragment["content"])
+            available = budget - len(encoding.encode(header))
+            if available <= 0:
+                truncated = True
+                break
+            if len(tokens) > available:
+                tokens = tokens[:available]
+                truncated = True
+            content.append({"type": "text", "text": header + encoding.decode(tokens)})
+            budget = available - len(tokens)
+            citations.append({"n": len(citations) + 1, "id": fragment["id"], "title": fragment["title"], "uri": fragment["uri"]})
+
+            image_url = image_urls.get(fragment["id"])
+            if image_url is not None and budget >= IMAGE_TOKEN_COST:
+                content.append({"type": "image_url", "image_url": {"url": image_url}})
+                budget -= IMAGE_TOKEN_COST
+
+            if truncated:
+                break
+
+        visual = any(c["type"] == "image_url" for c in content)
+        engine_to_use = self.engine_visual if visual else self.engine_text
+
+        with stage("completion", model=engine_to_use, visual=visual, fragments=len(citations)):
+            response = await self.__create(
+                model=engine_to_use,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Answer the question using only the numbered sources provided by the user. "
+                                   "Cite the sources you use as [n]. If the sources don't contain the answer, say so."
+                    },
+                    {
+                        "role": "user",
+                        "content": content,
+                    },
+                    {
+                        "role": "user",
+                        "content": [ {"type": "text", "text": prompt} ],
+                    },
+                ],
+                max_tokens=max_tokens,
+                )
+        ChatCompletions.__count_usage(response, engine_to_use)
+
+        return {
+            "answer": response.choices[0].message.content,
+            "citations": citations,
+            "truncated": truncated }
+
     async def extract_keywords(self, query: str, max_tokens: int = 50):
         """
         Extract relevant search keywords from a user query.
         """
         prompt = f"Extract 3-5 relevant search keywords from this query that would be useful for finding documents in SharePoint. Return only the keywords separated by spaces, no explanations or formatting. Query: {query}"
         
-        response = await self.client.chat.completions.create(
-            model=self.engine_text,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that extracts search keywords from user queries. Return only the keywords separated by spaces."
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ],
-            max_tokens=max_tokens,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content.strip()
\ No newline at end of file
+        with stage("keyword-extraction", model=self.engine_text):
+            response = await self.__create(
+                model=self.engine_text,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "You are a helpful assistant that extracts search keywords from user queries. Return only the keywords separated by spaces."
+                    },
+                    {
+                        "role": "user", 
+                        "content": prompt
+                    }
+                ],
+                max_tokens=max_tokens,
+                temperature=0.3
+            )
+        ChatCompletions.__count_usage(response, self.engine_text)
+
+        return response.choices[0].message.content.strip()
+
+    async def close(self):
+        await self.client.close()
+
+    async def __create(self, **kwargs):
+        async with limiter("openai").slot_async():
+            return await self.client.chat.completions.create(**kwargs)
+
+    @staticmethod
+    def __encoding():
+        # tiktoken is only needed here, keep it out of the startup path
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+
+    @staticmethod
+    def __count_usage(response, model: str):
+        if response.usage is not None:
+            count_tokens("prompt", response.usage.prompt_tokens, model)
+            count_tokens("completion", response.usage.completion_tokens, model)
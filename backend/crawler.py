@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import time
+from datetime import timedelta
+
+import dotenv
+from dateutil import parser
+from msal import ConfidentialClientApplication
+
+from auth import CallContext
+from drive import DriveFileFetcher
+from indexer import Indexer
+from orchestration import SharePointRagOrchestrator
+from ratelimit import background
+from telemetry import get_logger, setup_telemetry, stage
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx")
+
+class CrawlerState:
+    """
+    Persistent delta links and checkpoints of the crawler, one JSON file.
+    Per drive it keeps the deltaLink of the last completed enumeration, the nextLink of an
+    enumeration in progress (so an interrupted crawl resumes on the same page) and items
+    that failed to ingest and are retried in the next cycle.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.drives = json.load(f)["drives"]
+        except FileNotFoundError:
+            self.drives = {}
+
+    def drive(self, drive_id: str) -> dict:
+        return self.drives.setdefault(drive_id, {"deltaLink": None, "nextLink": None, "retry": {}})
+
+    def save(self):
+        temp_path = self.path + ".part"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"drives": self.drives}, f, indent=2)
+        os.replace(temp_path, self.path)
+
+class DeltaCrawler:
+    """
+    Walks the configured drives (and all drives of the configured sites) with the Graph delta API
+    using the app identity, and pushes new or changed PDF/DOCX items through the regular
+    ingestion path, so interactive queries find them already indexed. Deleted items are removed
+    from the index. Downloads and ingestions are paced by max_documents_per_minute to leave room for
+    user traffic, items the index already has are skipped without waiting.
+    After every cycle snapshots no document referenced for snapshot_grace are deleted from storage.
+    """
+    def __init__(self,
+                 app: ConfidentialClientApplication,
+                 orchestrator: SharePointRagOrchestrator,
+                 state: CrawlerState,
+                 drives: list[str] = None,
+                 sites: list[str] = None,
+                 max_documents_per_minute: float = 30,
+                 snapshot_grace: timedelta = timedelta(hours=24)):
+        self.app = app
+        self.orchestrator = orchestrator
+        self.state = state
+        self.drives = drives or []
+        self.sites = sites or []
+        self.min_interval = 60 / max_documents_per_minute if max_documents_per_minute > 0 else 0
+        self.snapshot_grace = snapshot_grace
+        self.drive_fetcher = DriveFileFetcher(app)
+        self.log = get_logger()
+        self.__last_ingestion = 0.0
+
+    async def run_forever(self, interval_seconds: float):
+        # everything the crawler calls yields to interactive requests
+        with background():
+            while True:
+                try:
+                    await self.crawl_once()
+                    await self.collect_snapshots()
+                except Exception as e:
+                    self.log.exception(e)
+                await asyncio.sleep(interval_seconds)
+
+    async def crawl_once(self):
+        with stage("crawl"):
+            for drive_id in await self.__all_drives():
+                await self.__crawl_drive(drive_id)
+
+    async def collect_snapshots(self):
+        with stage("snapshot-gc"):
+            deleted = await self.orchestrator.storage.collect_unreferenced("snap-", self.snapshot_grace)
+        if deleted > 0:
+            self.log.info(f"Deleted {deleted} unreferenced snapshots")
+
+    async def __all_drives(self) -> list[str]:
+        drives = list(self.drives)
+        for site_id in self.sites:
+            ctx = CallContext.for_app(self.app)
+            site_drives = await self.drive_fetcher.site_drives(site_id, ctx)
+            drives.extend(d for d in site_drives if d not in drives)
+        return drives
+
+    async def __crawl_drive(self, drive_id: str):
+        drive_state = self.state.drive(drive_id)
+
+        # items which failed last time go first
+        for item_id, search_object in list(drive_state["retry"].items()):
+            if await self.__ingest(search_object):
+                del drive_state["retry"][item_id]
+                self.state.save()
+
+        link = drive_state["nextLink"] or drive_state["deltaLink"]
+        while True:
+            # app tokens are cached by MSAL, a fresh context per page keeps long crawls from expiring
+            ctx = CallContext.for_app(self.app)
+            page = await self.drive_fetcher.delta(drive_id, ctx, link)
+            if page is None:
+                self.log.warning(f"Delta token of drive {drive_id} expired, enumerating from scratch")
+                drive_state["nextLink"] = drive_state["deltaLink"] = None
+                link = None
+                continue
+
+            for item in page["value"]:
+                await self.__process(drive_id, item, drive_state)
+
+            if "@odata.nextLink" in page:
+                link = drive_state["nextLink"] = page["@odata.nextLink"]
+                self.state.save()
+            else:
+                drive_state["nextLink"] = None
+                drive_state["deltaLink"] = page.get("@odata.deltaLink")
+                self.state.save()
+                break
+
+    async def __process(self, drive_id: str, item: dict, drive_state: dict):
+        name = item.get("name", "")
+        if "deleted" in item:
+            drive_state["retry"].pop(item["id"], None)
+            await self.orchestrator.remove_document(drive_id, item["id"])
+            return
+
+        if "file" not in item or not name.lower().endswith(SUPPORTED_EXTENSIONS):
+            return
+
+        search_object = {
+            "id": item["id"],
+            "name": name,
+            "title": os.path.splitext(name)[0],
+            "lastModified": item["lastModifiedDateTime"],
+            "contentTag": item.get("cTag") or item.get("eTag"),
+            "driveId": drive_id }
+
+        if not await self.__ingest(search_object):
+            drive_state["retry"][item["id"]] = search_object
+
+    async def __ingest(self, search_object: dict) -> bool:
+        # the freshness check goes before the pacing, the initial crawl and a resync after an expired
+        # delta token mostly enumerate items that are indexed already
+        safe_id = Indexer.safe_id(search_object["driveId"], search_object["id"])
+        manifest = await self.orchestrator.indexer.get_manifest(safe_id)
+        if manifest is not None and parser.isoparse(manifest["lastModified"]) >= parser.parse(search_object["lastModified"]):
+            return True
+        # a metadata-only change (same content tag) is neither downloaded nor processed, only new content is paced
+        if manifest is None or manifest["contentTag"] != search_object.get("contentTag"):
+            await self.__pace()
+
+        ctx = CallContext.for_app(self.app)
+        doc_id = await self.orchestrator.ensure_document_in_index(search_object, ctx)
+        if doc_id == "":
+            self.log.warning(f"Crawler failed to ingest {search_object['name']}, will retry in the next cycle")
+        return doc_id != ""
+
+    async def __pace(self):
+        wait = self.__last_ingestion + self.min_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.__last_ingestion = time.monotonic()
+
+def from_env(app: ConfidentialClientApplication, orchestrator: SharePointRagOrchestrator) -> DeltaCrawler:
+    """
+    CRAWLER_DRIVES and CRAWLER_SITES are comma separated lists of drive and site ids.
+    """
+    return DeltaCrawler(
+        app,
+        orchestrator,
+        CrawlerState(os.getenv("CRAWLER_STATE_PATH", "crawler-state.json")),
+        drives=[d for d in os.getenv("CRAWLER_DRIVES", "").split(",") if d],
+        sites=[s for s in os.getenv("CRAWLER_SITES", "").split(",") if s],
+        max_documents_per_minute=float(os.getenv("CRAWLER_MAX_DOCUMENTS_PER_MINUTE", "30")),
+        snapshot_grace=timedelta(hours=float(os.getenv("SNAPSHOT_GC_GRACE_HOURS", "24"))))
+
+if __name__ == "__main__":
+    import services
+
+    dotenv.load_dotenv()
+    setup_telemetry()
+
+    crawler = from_env(services.msal_app(), services.orchestrator())
+    asyncio.run(crawler.run_forever(float(os.getenv("CRAWLER_INTERVAL_SECONDS", "300"))))
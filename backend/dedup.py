@@ -0,0 +1,149 @@
+import os
+import re
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+
+from model import MIN_FRAGMENT_LENGTH, DocumentFragment
+
+# a Mersenne prime above the 32 bit shingle hashes, the universal hash family (a*x + b) mod p of the
+# MinHash permutations; with a below 2^31 and b below p, a*x + b stays below 2^64 and uint64 can't wrap
+_PRIME = np.uint64((1 << 61) - 1)
+_MAX_A = 1 << 31
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+SHORT_LINE_WORDS = 6
+
+@dataclass
+class DedupReport:
+    fragments: int
+    removed_fragments: int
+    stripped_lines: int
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+class FragmentDeduplicator:
+    """
+    Removes text of a document that would otherwise be embedded, stored and retrieved over and over.
+    boilerplate      - lines repeated on at least line_share of the fragments (headers, footers, disclaimers,
+                       title blocks) are stripped; numbers in short lines are ignored, so "Page 3 of 12" repeats
+    near duplicates  - fragments whose MinHash signature (word shingles) estimates a Jaccard similarity of at
+                       least threshold with an earlier fragment are dropped, e.g. revision pages; the
+                       candidates come from LSH buckets of bands of the signature instead of all pairs
+    Fragments carrying a snapshot keep their text if stripping would leave too little to be indexed, and are
+    only dropped as near duplicates of a fragment with the same snapshot, so no page image gets lost.
+    """
+    def __init__(self, enabled: bool = True, line_share: float = 0.5, min_fragments: int = 3, threshold: float = 0.9,
+                 shingle_size: int = 5, permutations: int = 64, bands: int = 16):
+        if permutations % bands != 0:
+            raise ValueError("The MinHash permutations must split into equal bands")
+        self.enabled = enabled
+        self.line_share = line_share
+        self.min_fragments = min_fragments
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands = bands
+        # fixed seed, signatures are comparable across runs and processes
+        generator = np.random.default_rng(1)
+        self._a = generator.integers(1, _MAX_A, size=permutations, dtype=np.uint64)
+        self._b = generator.integers(0, int(_PRIME), size=permutations, dtype=np.uint64)
+
+    @staticmethod
+    def from_env():
+        return FragmentDeduplicator(
+            enabled=os.getenv("DEDUP_ENABLED", "true").lower() == "true",
+            line_share=float(os.getenv("DEDUP_LINE_SHARE", "0.5")),
+            threshold=float(os.getenv("DEDUP_NEAR_DUPLICATE_THRESHOLD", "0.9")))
+
+    @staticmethod
+    def normalize_line(line: str) -> str:
+        line = re.sub(r"\s+", " ", line).strip().casefold()
+        # page numbers, dates and revisions; in longer lines numbers are content (dimensions, quantities)
+        if len(line.split(" ")) <= SHORT_LINE_WORDS:
+            line = re.sub(r"\d+", "#", line)
+        return line
+
+    def deduplicate(self, fragments: list[DocumentFragment]) -> tuple[list[DocumentFragment], DedupReport]:
+        """
+        Returns the remaining fragments in their order and what was saved, CPU bound.
+        """
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        tokens_before = sum(len(encoding.encode(f.text)) for f in fragments if len(f.text) > MIN_FRAGMENT_LENGTH)
+        if not self.enabled:
+            return fragments, DedupReport(len(fragments), 0, 0, tokens_before, tokens_before)
+
+        stripped, stripped_lines = self.__strip_boilerplate(fragments)
+        remaining = self.__drop_near_duplicates(stripped)
+        tokens_after = sum(len(encoding.encode(f.text)) for f in remaining if len(f.text) > MIN_FRAGMENT_LENGTH)
+        return remaining, DedupReport(len(fragments), len(fragments) - len(remaining), stripped_lines, tokens_before, tokens_after)
+
+    def __strip_boilerplate(self, fragments: list[DocumentFragment]) -> tuple[list[DocumentFragment], int]:
+        if self.line_share <= 0 or len(fragments) < self.min_fragments:
+            return fragments, 0
+        occurrences = {}
+        for fragment in fragments:
+            for line in {FragmentDeduplicator.normalize_line(l) for l in fragment.text.splitlines()}:
+                if line:
+                    occurrences[line] = occurrences.get(line, 0) + 1
+        minimum = max(self.min_fragments, self.line_share * len(fragments))
+        boilerplate = {line for line, count in occurrences.items() if count >= minimum}
+        if len(boilerplate) == 0:
+            return fragments, 0
+
+        result = []
+        stripped_lines = 0
+        for fragment in fragments:
+            lines = fragment.text.splitlines()
+            kept = [l for l in lines if FragmentDeduplicator.normalize_line(l) not in boilerplate]
+            text = "\n".join(kept)
+            if fragment.snapshot and len(text) <= MIN_FRAGMENT_LENGTH < len(fragment.text):
+                # the page would no longer be indexed and its snapshot not be found
+                result.append(fragment)
+                continue
+            stripped_lines += len(lines) - len(kept)
+            result.append(DocumentFragment(text=text, snapshot=fragment.snapshot))
+        return result, stripped_lines
+
+    def signature(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.casefold())
+        if len(words) < self.shingle_size:
+            shingles = [" ".join(words)]
+        else:
+            shingles = [" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+        hashes = np.array(sorted({zlib.crc32(s.encode("utf-8")) for s in shingles}), dtype=np.uint64)
+        # every row is one permutation of the shingle hashes, the signature keeps the minimum of each
+        permuted = np.bitwise_and((np.outer(self._a, hashes) + self._b[:, None]) % _PRIME, _MAX_HASH)
+        return permuted.min(axis=1)
+
+    def __drop_near_duplicates(self, fragments: list[DocumentFragment]) -> list[DocumentFragment]:
+        if self.threshold <= 0 or self.threshold > 1:
+            return fragments
+        rows = len(self._a) // self.bands
+        buckets = {}
+        kept = []
+        signatures = {}
+        for fragment in fragments:
+            # too short to be indexed anyway
+            if len(fragment.text) <= MIN_FRAGMENT_LENGTH:
+                kept.append(fragment)
+                continue
+            signature = self.signature(fragment.text)
+            keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+            candidates = {k for key in keys for k in buckets.get(key, ())}
+            duplicate = any(
+                kept[k].snapshot == fragment.snapshot and np.mean(signatures[k] == signature) >= self.threshold
+                for k in candidates)
+            if duplicate:
+                continue
+            for key in keys:
+                buckets.setdefault(key, []).append(len(kept))
+            signatures[len(kept)] = signature
+            kept.append(fragment)
+        return kept
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+
+from model import DocumentFragment
+from telemetry import count_cache, get_logger
+
+class DocumentCache:
+    """
+    Size-bounded local disk cache of downloaded originals and the fragments extracted from them.
+    Entries are keyed by drive id, item id and content tag (cTag, falling back to eTag), so
+    a new tag means new binary content while metadata-only edits keep hitting the cache.
+    Least recently used entries are evicted once the cache grows beyond max_bytes.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.log = get_logger()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def __item_key(drive_id: str, item_id: str) -> str:
+        return hashlib.sha256(f"{drive_id}|{item_id}".encode()).hexdigest()[:32]
+
+    @staticmethod
+    def __tag_key(content_tag: str) -> str:
+        return hashlib.sha256(content_tag.encode()).hexdigest()[:16]
+
+    def __stem(self, drive_id: str, item_id: str, content_tag: str) -> str:
+        return os.path.join(self.directory, f"{DocumentCache.__item_key(drive_id, item_id)}-{DocumentCache.__tag_key(content_tag)}")
+
+    def get(self, drive_id: str, item_id: str, content_tag: str) -> str | None:
+        """
+        Returns the path of the cached original or None.
+        """
+        path = self.__stem(drive_id, item_id, content_tag) + ".bin"
+        hit = os.path.exists(path)
+        count_cache("document", hit)
+        if hit:
+            # mtime doubles as the LRU clock
+            os.utime(path)
+        return path if hit else None
+
+    def reserve(self, drive_id: str, item_id: str, content_tag: str) -> str:
+        """
+        Returns a temporary path to download into, see commit().
+        """
+        return f"{self.__stem(drive_id, item_id, content_tag)}.{threading.get_ident()}.part"
+
+    def commit(self, temp_path: str, drive_id: str, item_id: str, content_tag: str) -> str:
+        """
+        Moves a completed download into the cache, drops older versions of the same item
+        and evicts entries until the cache fits into its size budget.
+        """
+        stem = self.__stem(drive_id, item_id, content_tag)
+        path = stem + ".bin"
+        os.replace(temp_path, path)
+        with self._lock:
+            self.__drop_other_versions(drive_id, item_id, os.path.basename(stem))
+            self.__evict(keep=os.path.basename(stem))
+        return path
+
+    def get_fragments(self, drive_id: str, item_id: str, content_tag: str) -> list[DocumentFragment] | None:
+        """
+        Returns the fragments extracted from this exact content before, so re-indexing can skip processing.
+        """
+        path = self.__stem(drive_id, item_id, content_tag) + ".json"
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                fragments = [DocumentFragment(**entry) for entry in json.load(f)]
+        except FileNotFoundError:
+            count_cache("fragments", False)
+            return None
+        count_cache("fragments", True)
+        os.utime(path)
+        return fragments
+
+    def put_fragments(self, drive_id: str, item_id: str, content_tag: str, fragments: list[DocumentFragment]):
+        path = self.__stem(drive_id, item_id, content_tag) + ".json"
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump([{"text": f.text, "snapshot": f.snapshot} for f in fragments], f)
+        os.replace(temp_path, path)
+
+    def drop_fragments(self, drive_id: str, item_id: str, content_tag: str):
+        """
+        Forgets the extracted fragments, e.g. when the snapshots they reference are gone.
+        """
+        self.__remove(self.__stem(drive_id, item_id, content_tag) + ".json")
+
+    def __drop_other_versions(self, drive_id: str, item_id: str, keep: str):
+        prefix = DocumentCache.__item_key(drive_id, item_id) + "-"
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(prefix) and not entry.name.startswith(keep) and not entry.name.endswith(".part"):
+                self.__remove(entry.path)
+
+    def __evict(self, keep: str):
+        entries = [e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith(".part")]
+        total = sum(e.stat().st_size for e in entries)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            if entry.name.startswith(keep):
+                continue
+            total -= entry.stat().st_size
+            self.__remove(entry.path)
+
+    def __remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.log.warning(f"Unable to evict {path} from the document cache: {e}")
+
+@contextmanager
+def open_mapped(path: str):
+    """
+    Opens a cached document as a read-only memory map, pages are loaded by the OS on access.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
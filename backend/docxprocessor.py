@@ -1,7 +1,6 @@
 import docx
-import requests
-import io
 import tiktoken
+from documentcache import open_mapped
 from model import DocumentFragment
 
 class DocxProcessor:
@@ -9,15 +8,14 @@ class DocxProcessor:
     Processes a docx file by splitting it into fragments of a given token limit.
     TODO: introduce overlap between fragments to avoid cutting through words and sentences
     """
-    def __init__(self, docx_file_url, token_limit:int = 1000):
-        self.docx_file_url = docx_file_url
+    def __init__(self, docx_file_path, token_limit:int = 1000):
+        self.docx_file_path = docx_file_path
         self.encoding = tiktoken.get_encoding("cl100k_base")
         self.token_limit = token_limit
 
     def split(self, prefix: str) -> [DocumentFragment]: 
-        response = requests.get(self.docx_file_url)
-        docx_io_bytes = io.BytesIO(response.content)
-        doc = docx.Document(docx_io_bytes)
+        with open_mapped(self.docx_file_path) as docx_bytes:
+            doc = docx.Document(docx_bytes)
         current_block = ""
         current_token_count = 0
         para_len = 0
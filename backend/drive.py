@@ -1,6 +1,13 @@
+import os
 import requests
 from msal import ConfidentialClientApplication
-from auth import CallContext, get_token
+from auth import CallContext, get_token, graph_url
+from documentcache import DocumentCache
+from ratelimit import http_request, limiter
+from resilience import UnavailableError, resilient_get
+from telemetry import count_bytes, stage
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 class DriveFileFetcher:
     """
@@ -11,16 +18,17 @@ class DriveFileFetcher:
 
     @staticmethod
     def item_url(driveid, itemid):
-        return f"https://graph.microsoft.com/v1.0/drives/{driveid}/items/{itemid}"
+        return graph_url(f"/drives/{driveid}/items/{itemid}")
     
-    def __get_item_info(self, driveid, itemid, ctx: CallContext):
+    async def __get_item_info(self, driveid, itemid, ctx: CallContext):
         """
         We're retrieving a temporary URL to fetch the file and some additional metadata.
         """
         url = DriveFileFetcher.item_url(driveid, itemid)
-        token = get_token(self.app, ctx)
-        headers = {"Authorization": "Bearer " + token}
-        response = requests.get(url, headers=headers)
+        with stage("graph-item"):
+            # on the path of every permission check, hedged against slow responses
+            token = await get_token(self.app, ctx)
+            response = await resilient_get("graph", "graph-item", url, headers={"Authorization": "Bearer " + token})
         if response.status_code >= 200 and response.status_code < 300:
             payload = response.json()
             driveitem = { 
@@ -28,14 +36,79 @@ class DriveFileFetcher:
                 'name': payload["name"],
                 'url': payload["webUrl"],
                 'lastModified': payload["lastModifiedDateTime"],
+                # cTag only changes with the binary content, eTag also with metadata
+                'contentTag': payload.get("cTag") or payload.get("eTag") or payload["lastModifiedDateTime"],
+                'size': payload.get("size"),
                 'downloadUrl': payload["@microsoft.graph.downloadUrl"] }
             return driveitem
         else:
             raise Exception(response.status_code, response.text)
 
-    def get_item(self, driveid, itemid, ctx: CallContext) -> dict:
+    async def get_item(self, driveid, itemid, ctx: CallContext) -> dict:
         try:
-            item = self.__get_item_info(driveid, itemid, ctx)
+            item = await self.__get_item_info(driveid, itemid, ctx)
             return item
+        except UnavailableError:
+            raise
         except:
             raise Exception("Unable to get item info")
+
+    async def __get(self, url, ctx: CallContext):
+        token = await get_token(self.app, ctx)
+        headers = {"Authorization": "Bearer " + token}
+        return await http_request("graph", "GET", url, headers=headers)
+
+    async def site_drives(self, siteid, ctx: CallContext) -> list[str]:
+        """
+        Returns the ids of all document libraries of a site.
+        """
+        with stage("graph-site-drives"):
+            response = await self.__get(graph_url(f"/sites/{siteid}/drives?$select=id"), ctx)
+        if response.status_code >= 200 and response.status_code < 300:
+            return [d["id"] for d in response.json()["value"]]
+        raise Exception(response.status_code, response.text)
+
+    async def delta(self, driveid, ctx: CallContext, link: str = None) -> dict:
+        """
+        Fetches one page of the drive delta. Without a link the enumeration starts from scratch,
+        otherwise pass the @odata.nextLink or @odata.deltaLink of the previous page.
+        Returns None if Graph asks for a resync (the delta token expired).
+        """
+        url = link or graph_url(f"/drives/{driveid}/root/delta?$select=id,name,file,deleted,lastModifiedDateTime,cTag,eTag,size")
+        with stage("graph-delta"):
+            response = await self.__get(url, ctx)
+        if response.status_code == 410:
+            return None
+        if response.status_code >= 200 and response.status_code < 300:
+            return response.json()
+        raise Exception(response.status_code, response.text)
+
+    def download(self, driveid, item: dict, cache: DocumentCache) -> str:
+        """
+        Returns a local path to the content of the item, downloading it only if the
+        cache doesn't hold this content tag yet. Blocking, runs in ingestion worker threads.
+        """
+        content_tag = item["contentTag"]
+        path = cache.get(driveid, item["id"], content_tag)
+        if path is not None:
+            return path
+
+        temp_path = cache.reserve(driveid, item["id"], content_tag)
+        downloaded = 0
+        with stage("download", size=item.get("size") or 0), limiter("graph").slot() as permit:
+            # streamed to disk in chunks, the document is never held in memory as a whole
+            with requests.get(item["downloadUrl"], stream=True, timeout=(10, 120)) as response:
+                permit.observe(response.status_code, response.headers)
+                if response.status_code < 200 or response.status_code >= 300:
+                    raise Exception(response.status_code, response.text)
+                try:
+                    with open(temp_path, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            downloaded += len(chunk)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+        count_bytes("download", downloaded)
+        return cache.commit(temp_path, driveid, item["id"], content_tag)
@@ -1,25 +1,40 @@
 from openai import AsyncAzureOpenAI
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from ratelimit import limiter
+from telemetry import count_tokens, stage
 
 class Embeddings:
     """
     Calculates embeddings for a given text using the Azure OpenAI embeddings endpoint.
     """
-    def __init__(self, api_endpoint, engine):
+    def __init__(self, api_endpoint, engine, credential: DefaultAzureCredential = None, dimensions: int = None):
         self.engine = engine
+        # reduced dimensions, only supported by text-embedding-3 and later models
+        self.dimensions = dimensions
 
-        token_provider = get_bearer_token_provider(DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
+        token_provider = get_bearer_token_provider(credential or DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
 
         self.client = AsyncAzureOpenAI(
             azure_endpoint=api_endpoint,
-            api_version = "2023-05-15",
+            # the dimensions parameter needs a newer api version
+            api_version = "2023-05-15" if dimensions is None else "2024-06-01",
             azure_ad_token_provider=token_provider)
 
     async def get_embedding(self, text: str | list[str]):
         """
-        TODO: introduce retries and throttling for long requests (documents of many fragments)
+        Throttling is shared with the other OpenAI calls, see ratelimit.py.
         """
-        response = await self.client.embeddings.create(input=text, model=self.engine)
+        with stage("embedding", inputs=1 if isinstance(text, str) else len(text)):
+            async with limiter("openai").slot_async():
+                if self.dimensions is None:
+                    response = await self.client.embeddings.create(input=text, model=self.engine)
+                else:
+                    response = await self.client.embeddings.create(input=text, model=self.engine, dimensions=self.dimensions)
+        if response.usage is not None:
+            count_tokens("embedding", response.usage.prompt_tokens, self.engine)
         return list(map(lambda x: x.embedding, response.data))
 
+    async def close(self):
+        await self.client.close()
+
 
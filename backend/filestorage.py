@@ -1,44 +1,153 @@
 from datetime import datetime, timedelta, timezone
-from azure.storage.blob import ContainerClient, BlobSasPermissions, generate_blob_sas, BlobServiceClient, UserDelegationKey
-from azure.identity import DefaultAzureCredential
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings, BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+from azure.identity.aio import DefaultAzureCredential
+from model import thumbnail_name
+from ratelimit import limiter
+
+# blob metadata of reference counted (content-addressed) blobs
+REFERENCES = "refs"
+RELEASED = "released"
 
 class FileStorage:
     """
     FileStorage is a wrapper around azure blob storage to keep snashots of document fragments.
+    All calls are async, pass an AioHttpTransport to share the connection pool with other clients.
     """    
     def __init__(self, 
                  container_name: str,
                  storage_connection_string: str = None, 
-                 storage_account_name: str = None) -> None:
+                 storage_account_name: str = None,
+                 credential: DefaultAzureCredential = None,
+                 transport=None) -> None:
         
         print("Storage account name:", storage_account_name)
         print("Storage connection string:", storage_connection_string)
         print("Container name:", container_name)     
 
         if storage_connection_string is not None:
-            self.container_client = ContainerClient.from_connection_string(storage_connection_string, container_name)
-            self.blob_service_client = None
+            self.blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string, transport=transport)
+            self.user_delegation = False
         elif storage_account_name is not None:
-            self.credential = DefaultAzureCredential()
+            self.credential = credential or DefaultAzureCredential()
             self.storage_account_name = storage_account_name
-            container_url = f"https://{storage_account_name}.blob.core.windows.net/{container_name}"
-            self.container_client = ContainerClient.from_container_url(container_url, credential=self.credential)
-            # Create BlobServiceClient for user delegation key
             service_url = f"https://{storage_account_name}.blob.core.windows.net"
-            self.blob_service_client = BlobServiceClient(account_url=service_url, credential=self.credential)
+            # the service client also issues the user delegation keys
+            self.blob_service_client = BlobServiceClient(account_url=service_url, credential=self.credential, transport=transport)
+            self.user_delegation = True
         else:
             raise ValueError("Either storage_connection_string or storage_account_name must be provided")
+        # shares the pipeline (and transport) of the service client
+        self.container_client = self.blob_service_client.get_container_client(container_name)
+
+    async def close(self):
+        await self.blob_service_client.close()
+
+    async def put(self, file: bytes, filename: str, content_type: str = None, metadata: dict = None, overwrite: bool = True) -> bool:
+        """
+        Uploads the file, returns False if overwrite is off and the blob already exists. The existence check
+        is a condition of the upload itself, so of concurrent uploads of the same name exactly one is stored.
+        """
+        blob_client = self.container_client.get_blob_client(filename)
+        content_settings = ContentSettings(content_type=content_type) if content_type else None
+        try:
+            async with limiter("storage").slot_async():
+                await blob_client.upload_blob(file, overwrite=overwrite, content_settings=content_settings, metadata=metadata)
+        except ResourceExistsError:
+            return False
+        return True
+
+    async def exists(self, filename: str) -> bool:
+        async with limiter("storage").slot_async():
+            return await self.container_client.get_blob_client(filename).exists()
 
-    def put(self, file: bytes, filename: str):
+    async def retain(self, filename: str) -> bool:
+        """
+        Whether the blob exists. An unreferenced reference counted blob gets a new release time, so
+        collect_unreferenced() doesn't delete it before an ingestion about to reference it counts it.
+        """
         blob_client = self.container_client.get_blob_client(filename)
-        blob_client.upload_blob(file, overwrite=True)
+        while True:
+            try:
+                async with limiter("storage").slot_async():
+                    properties = await blob_client.get_blob_properties()
+                metadata = dict(properties.metadata or {})
+                if metadata.get(REFERENCES) != "0":
+                    return True
+                metadata[RELEASED] = datetime.now(timezone.utc).isoformat()
+                async with limiter("storage").slot_async():
+                    await blob_client.set_blob_metadata(metadata, etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+                return True
+            except ResourceModifiedError:
+                continue
+            except ResourceNotFoundError:
+                return False
+
+    async def add_references(self, filename: str, delta: int) -> int | None:
+        """
+        Changes the reference count kept in the blob metadata, with optimistic concurrency so concurrent
+        ingestions don't lose updates. Returns the new count, None for missing or not reference counted blobs.
+        A count dropping to zero stamps the release time, collect_unreferenced() deletes the blob later.
+        """
+        blob_client = self.container_client.get_blob_client(filename)
+        while True:
+            try:
+                async with limiter("storage").slot_async():
+                    properties = await blob_client.get_blob_properties()
+                metadata = dict(properties.metadata or {})
+                if REFERENCES not in metadata:
+                    return None
+                references = max(0, int(metadata[REFERENCES]) + delta)
+                metadata[REFERENCES] = str(references)
+                if references == 0:
+                    metadata[RELEASED] = datetime.now(timezone.utc).isoformat()
+                else:
+                    metadata.pop(RELEASED, None)
+                async with limiter("storage").slot_async():
+                    await blob_client.set_blob_metadata(metadata, etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+                return references
+            except ResourceModifiedError:
+                continue
+            except ResourceNotFoundError:
+                return None
+
+    async def collect_unreferenced(self, prefix: str, grace: timedelta) -> int:
+        """
+        Deletes reference counted blobs (and their thumbnails) that have not been referenced for the grace period.
+        The grace period covers ingestions that found a blob already uploaded but did not reference it yet.
+        """
+        deleted = 0
+        cutoff = datetime.now(timezone.utc) - grace
+        async with limiter("storage").slot_async():
+            blobs = [b async for b in self.container_client.list_blobs(name_starts_with=prefix, include=["metadata"])]
+        for blob in blobs:
+            metadata = blob.metadata or {}
+            if metadata.get(REFERENCES) != "0" or RELEASED not in metadata:
+                continue
+            if datetime.fromisoformat(metadata[RELEASED]) > cutoff:
+                continue
+            try:
+                async with limiter("storage").slot_async():
+                    # only if nobody referenced it again since the listing
+                    await self.container_client.delete_blob(blob.name, etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+            except (ResourceModifiedError, ResourceNotFoundError):
+                continue
+            deleted += 1
+            try:
+                async with limiter("storage").slot_async():
+                    await self.container_client.delete_blob(thumbnail_name(blob.name))
+            except ResourceNotFoundError:
+                pass
+        return deleted
 
     
-    def get_link(self, filename: str) -> str:
+    async def get_link(self, filename: str) -> str:
         blob_client = self.container_client.get_blob_client(filename)
         
         # If using connection string (account key), use the original method
-        if self.blob_service_client is None:
+        if not self.user_delegation:
             # generate sas token for blob using account key
             sas_token = generate_blob_sas(
                 account_name=self.container_client.account_name,
@@ -54,10 +163,11 @@ class FileStorage:
             key_start_time = datetime.now(timezone.utc) - timedelta(minutes=5)
             key_expiry_time = key_start_time + timedelta(hours=1)
             
-            user_delegation_key = self.blob_service_client.get_user_delegation_key(
-                key_start_time=key_start_time,
-                key_expiry_time=key_expiry_time
-            )
+            async with limiter("storage").slot_async():
+                user_delegation_key = await self.blob_service_client.get_user_delegation_key(
+                    key_start_time=key_start_time,
+                    key_expiry_time=key_expiry_time
+                )
             
             sas_token = generate_blob_sas(
                 account_name=self.storage_account_name,
@@ -1,13 +1,28 @@
 import datetime
+import hashlib
+import math
 import re
+import time
 from dateutil import parser
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
 from embeddings import Embeddings
-from model import DocumentFragment
+from indexer_schema import VectorConfig, manifest_index_name
+from model import MIN_FRAGMENT_LENGTH, DocumentFragment, thumbnail_name
+from ratelimit import limiter
+from telemetry import stage
 
-from azure.search.documents.models import VectorizableTextQuery
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
+
+# the centroid is only read when a manifest is rewritten
+MANIFEST_FIELDS = ["id", "lastModified", "contentTag", "chunkCount", "chunkHashes", "snapshots", "indexed"]
+# manifest record without a centroid, present once every document of the index has one (see reindex.py);
+# document keys (Indexer.safe_id) never start with "="
+DOCUMENT_TIER_MARKER = "=document-tier"
+# while the marker is missing, how long the two-stage query stays off before looking again
+DOCUMENT_TIER_RECHECK_SECONDS = 300
 
 class IndexedItem:
     id: str
@@ -24,9 +39,16 @@ class Indexer:
     """
     Indexer is a wrapper around Azure Cognitive Search. It takes care of indexing documents
     as well as performing search queries against the index.
+    With top_documents, unscoped queries run in two stages: the top documents by the centroid of their
+    chunk vectors (kept in the manifest), then the chunks of only these documents. Documents indexed
+    before the centroid existed would never be selected, so that only starts once the manifest index
+    carries the DOCUMENT_TIER_MARKER, until then queries stay single-stage.
     """
-    def __init__(self, indexer_endpoint, index_name, emb: Embeddings, credential: AzureKeyCredential | DefaultAzureCredential = None):
+    def __init__(self, indexer_endpoint, index_name, emb: Embeddings, credential: AzureKeyCredential | DefaultAzureCredential = None, transport=None,
+                 top_documents: int = 0):
         self.emb = emb
+        self.top_documents = top_documents
+        self.__document_tier = (False, float("-inf"))
         self.credentials = credential
         self.indexer_endpoint = indexer_endpoint
         self.index_name = index_name
@@ -36,10 +58,23 @@ class Indexer:
         else:
             self.credential = credential
         
+        # both clients share the transport (and with it the connection pool) when one is given
         self.search_client = SearchClient(
             indexer_endpoint, 
             index_name, 
-            self.credential)
+            self.credential,
+            **({"transport": transport} if transport is not None else {}))
+
+        # one record per document: source version, chunk count and chunk hashes
+        self.manifest_client = SearchClient(
+            indexer_endpoint,
+            manifest_index_name(index_name),
+            self.credential,
+            **({"transport": transport} if transport is not None else {}))
+
+    async def close(self):
+        await self.search_client.close()
+        await self.manifest_client.close()
         
     @staticmethod
     def safe_id(namespace, id):
@@ -48,60 +83,299 @@ class Indexer:
         """
         return re.sub(r'[^a-zA-Z0-9_=-]', '_', f"{namespace}-{id}")
 
-    async def index_with_embeddings(self, docid: str, driveId: str, driveItemId: str, uri: str, title: str, fragments: list[DocumentFragment]):
+    @staticmethod
+    def chunk_hash(fragment: DocumentFragment) -> str:
+        return hashlib.sha256(f"{fragment.text}\0{fragment.snapshot or ''}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def centroid(vectors: list[list[float]]) -> list[float]:
+        """
+        Normalized mean of the chunk vectors, the document's position in the document tier.
+        """
+        sums = [sum(component) for component in zip(*vectors)]
+        norm = math.sqrt(sum(x * x for x in sums)) or 1.0
+        return [x / norm for x in sums]
+
+    async def index_with_embeddings(self, docid: str, driveId: str, driveItemId: str, uri: str, title: str, fragments: list[DocumentFragment],
+                                    last_modified: datetime.datetime = None, content_tag: str = None) -> tuple[set[str], set[str]]:
+        """
+        Submits the given fragments to the indexer. Fragments of MIN_FRAGMENT_LENGTH characters or less are ignored.
+        Only chunks whose hash differs from the manifest are embedded and uploaded, unchanged chunks only
+        get the current title, uri and lastModified merged in, chunks beyond the new chunk count are removed.
+        The manifest is written last, so it only describes complete uploads,
+        together with the centroid of all chunk vectors for two-stage queries.
+        Returns the snapshots the document references now but didn't before, and those it no longer references.
+        """
+        last_modified = last_modified or datetime.datetime.now(datetime.timezone.utc)
+        filtered_fragments = list(filter(lambda f: len(f.text) > MIN_FRAGMENT_LENGTH, fragments))
+        hashes = [Indexer.chunk_hash(f) for f in filtered_fragments]
+
+        manifest = await self.get_manifest(docid, centroid=True)
+        previous_hashes = manifest["chunkHashes"] if manifest is not None else []
+        snapshots = {f.snapshot for f in filtered_fragments if f.snapshot}
+        previous_snapshots = set(manifest.get("snapshots") or []) if manifest is not None else set()
+        changed = [i for i, h in enumerate(hashes) if i >= len(previous_hashes) or previous_hashes[i] != h]
+
+        vectors = {}
+        if len(changed) > 0:
+            embedded = await self.emb.get_embedding([filtered_fragments[i].text for i in changed])
+            vectors = {i: embedded[n] for n, i in enumerate(changed)}
+            documents = [{
+                'id': f"{docid}-{i}",
+                'chunk': i,
+                'documentId': docid,
+                'driveId': driveId,
+                'driveItemId': driveItemId,
+                'content': filtered_fragments[i].text, 
+                'embedding': vectors[i],
+                'uri': uri,
+                'title': title,
+                'lastModified': last_modified,
+                'snapshot': filtered_fragments[i].snapshot
+            } for i in changed] 
+            with stage("index-upload", documentId=docid, chunks=len(documents), unchanged=len(hashes) - len(changed)):
+                async with limiter("search").slot_async():
+                    await self.search_client.upload_documents(documents)
+
+        # a rename or move along with the content change must reach the unchanged chunks as well
+        changed_set = set(changed)
+        await self.__merge_chunk_metadata(docid, [i for i in range(len(hashes)) if i not in changed_set], uri, title, last_modified)
+
+        if manifest is not None:
+            stale = [{"id": f"{docid}-{i}"} for i in range(len(hashes), manifest["chunkCount"])]
+        else:
+            # indexed before the manifest existed, the chunk set is only known to the index itself
+            keep = {f"{docid}-{i}" for i in range(len(hashes))}
+            stale = [k for k in await self.__search_chunk_keys(docid) if k["id"] not in keep]
+        if len(stale) > 0:
+            with stage("index-delete", documentId=docid, chunks=len(stale)):
+                async with limiter("search").slot_async():
+                    await self.search_client.delete_documents(stale)
+
+        if len(hashes) == 0:
+            centroid = None
+        elif manifest is not None and manifest.get("centroid") and len(changed) == 0 and len(hashes) == manifest["chunkCount"]:
+            centroid = manifest["centroid"]
+        else:
+            centroid = Indexer.centroid(await self.__chunk_vectors(docid, filtered_fragments, vectors))
+
+        async with limiter("search").slot_async():
+            await self.manifest_client.upload_documents([{
+                "id": docid,
+                "lastModified": last_modified,
+                "contentTag": content_tag,
+                "chunkCount": len(hashes),
+                "chunkHashes": hashes,
+                "snapshots": sorted(snapshots),
+                "centroid": centroid,
+                "indexed": datetime.datetime.now(datetime.timezone.utc)
+            }])
+
+        return snapshots - previous_snapshots, previous_snapshots - snapshots
+
+    async def __chunk_vectors(self, docid: str, fragments: list[DocumentFragment], vectors: dict[int, list[float]]) -> list[list[float]]:
         """
-        Submits the given fragments to the indexer. Fragments with less than 50 characters are ignored.
+        Vectors of all chunks: the new ones, the unchanged ones read back from the index, or embedded again
+        if the index doesn't keep them (VECTOR_STORED=false, the embedding field can't be selected then).
         """
-        filtered_fragments = list(filter(lambda f: len(f.text) > 50, fragments))
-        fragment_texts = [f.text for f in filtered_fragments]
-        vectors = await self.emb.get_embedding(fragment_texts)
+        missing = {i for i in range(len(fragments)) if i not in vectors}
+        if len(missing) > 0 and VectorConfig.from_env().stored:
+            async with limiter("search").slot_async():
+                async for r in await self.search_client.search(
+                        search_text="*",
+                        filter="documentId eq '" + docid + "'",
+                        select="chunk, embedding",
+                        top=100000):
+                    if r["chunk"] in missing and r.get("embedding"):
+                        vectors[r["chunk"]] = r["embedding"]
+            missing = sorted(i for i in missing if i not in vectors)
+        if len(missing) > 0:
+            embedded = await self.emb.get_embedding([fragments[i].text for i in missing])
+            vectors.update(zip(missing, embedded))
+        return [vectors[i] for i in range(len(fragments))]
+
+    async def __merge_chunk_metadata(self, docid: str, chunks, uri: str, title: str, last_modified: datetime.datetime):
         documents = [{
-            'id': f"{docid}-{i}",
-            'chunk': i,
-            'documentId': docid,
-            'driveId': driveId,
-            'driveItemId': driveItemId,
-            'content': fragment.text, 
-            'embedding': vectors[i],
-            'uri': uri,
-            'title': title,
-            'lastModified': datetime.datetime.now(),
-            'snapshot': fragment.snapshot
-        } for i,fragment in enumerate(filtered_fragments)] 
-        self.search_client.upload_documents(documents)
-        
+            "id": f"{docid}-{i}",
+            "uri": uri,
+            "title": title,
+            "lastModified": last_modified
+        } for i in chunks]
+        if len(documents) == 0:
+            return
+        with stage("index-merge", documentId=docid, chunks=len(documents)):
+            # the service takes at most 1000 actions per batch
+            for start in range(0, len(documents), 1000):
+                async with limiter("search").slot_async():
+                    await self.search_client.merge_documents(documents[start:start + 1000])
 
-    def is_in_index(self, id: str, file_last_modified: datetime = None):
+    async def refresh_manifest(self, docid: str, last_modified: datetime.datetime, uri: str, title: str, chunk_count: int):
+        """
+        Moves the document to a new source version whose content did not change (e.g. a rename or move):
+        the chunks get the new title and uri, the manifest the new lastModified.
+        """
+        await self.__merge_chunk_metadata(docid, range(chunk_count), uri, title, last_modified)
+        async with limiter("search").slot_async():
+            await self.manifest_client.merge_documents([{
+                "id": docid,
+                "lastModified": last_modified
+            }])
+
+    async def get_manifest(self, docid: str, centroid: bool = False) -> dict | None:
+        """
+        Point read of the manifest record of a document, None if the document has none.
+        """
+        try:
+            async with limiter("search").slot_async():
+                return await self.manifest_client.get_document(key=docid, selected_fields=MANIFEST_FIELDS + (["centroid"] if centroid else []))
+        except ResourceNotFoundError:
+            return None
+
+    async def is_in_index(self, id: str, file_last_modified: datetime = None):
         """
         Verifies if the given id is in the index. If file_last_modified is given, it is used to check if the index is up to date.
         """
         print("Checking if document is in index:", id)
 
-        results = list(self.search_client.search(
-            search_text="*",
-            filter="documentId eq '" + id + "'",
-            select="lastModified",
-            top=1))
+        with stage("freshness-check", documentId=id):
+            manifest = await self.get_manifest(id)
+            if manifest is None:
+                # documents indexed before the manifest existed
+                async with limiter("search").slot_async():
+                    results = [r async for r in await self.search_client.search(
+                        search_text="*",
+                        filter="documentId eq '" + id + "'",
+                        select="lastModified",
+                        top=1)]
+                manifest = results[0] if len(results) > 0 else None
         
-        if(len(results) == 0):
+        if manifest is None:
             return False
 
         if (file_last_modified is None):
             return True
 
-        lastModified = parser.isoparse(results[0]["lastModified"])
+        lastModified = parser.isoparse(manifest["lastModified"])
 
         return lastModified >= file_last_modified
 
-    def get_from_index(self, query: str, ids: [str] = None, k: int = 1):
+    async def is_searchable(self, docid: str, fragments: list[DocumentFragment], last_modified: datetime.datetime) -> bool:
+        """
+        Whether queries return the chunks index_with_embeddings just wrote for these fragments: every chunk
+        with the new content and lastModified. The old version's chunks have the same keys, counting them
+        doesn't tell whether a re-index is visible yet.
+        """
+        hashes = [Indexer.chunk_hash(f) for f in fragments if len(f.text) > MIN_FRAGMENT_LENGTH]
+        visible = set()
+        async with limiter("search").slot_async():
+            async for r in await self.search_client.search(
+                    search_text="*",
+                    filter="documentId eq '" + docid + "'",
+                    select="chunk, content, snapshot, lastModified",
+                    top=100000):
+                i = r["chunk"]
+                if i < len(hashes) \
+                        and Indexer.chunk_hash(DocumentFragment(text=r["content"], snapshot=r["snapshot"])) == hashes[i] \
+                        and parser.isoparse(r["lastModified"]) >= last_modified:
+                    visible.add(i)
+        return len(visible) == len(hashes)
+
+    async def delete_document(self, docid: str) -> int:
+        """
+        Deletes all fragments of the given document and its manifest, returns the number of deleted fragments.
+        """
+        with stage("index-delete", documentId=docid):
+            manifest = await self.get_manifest(docid)
+            if manifest is not None:
+                keys = [{"id": f"{docid}-{i}"} for i in range(manifest["chunkCount"])]
+            else:
+                keys = await self.__search_chunk_keys(docid)
+            if len(keys) > 0:
+                async with limiter("search").slot_async():
+                    await self.search_client.delete_documents(keys)
+            if manifest is not None:
+                async with limiter("search").slot_async():
+                    await self.manifest_client.delete_documents([{"id": docid}])
+        return len(keys)
+
+    async def __search_chunk_keys(self, docid: str) -> list[dict]:
+        async with limiter("search").slot_async():
+            return [{"id": r["id"]} async for r in await self.search_client.search(
+                search_text="*",
+                filter="documentId eq '" + docid + "'",
+                select="id",
+                top=100000)]
+
+    async def mark_document_tier_complete(self):
         """
-        Executes a search query against the index. If ids is given, the query is restricted to the given ids.
+        Records that every document of the index has a centroid, e.g. after a re-index into a fresh index.
+        """
+        async with limiter("search").slot_async():
+            await self.manifest_client.upload_documents([{
+                "id": DOCUMENT_TIER_MARKER,
+                "indexed": datetime.datetime.now(datetime.timezone.utc)
+            }])
+
+    async def __is_document_tier_complete(self) -> bool:
+        complete, checked = self.__document_tier
+        if complete or time.monotonic() - checked < DOCUMENT_TIER_RECHECK_SECONDS:
+            return complete
+        complete = await self.get_manifest(DOCUMENT_TIER_MARKER) is not None
+        self.__document_tier = (complete, time.monotonic())
+        return complete
+
+    async def __top_documents(self, vector: list[float]) -> list[str]:
+        with stage("index-query-documents", k=self.top_documents):
+            async with limiter("search").slot_async():
+                return [r["id"] async for r in await self.manifest_client.search(
+                    search_text=None,
+                    vector_queries=[VectorizedQuery(vector=vector, fields="centroid", k_nearest_neighbors=self.top_documents)],
+                    select="id",
+                    top=self.top_documents)]
+
+    async def get_fragments(self, ids: list[str]) -> list[dict]:
+        """
+        Looks up fragments by their keys, unknown keys are skipped.
+        """
+        fragments = []
+        with stage("index-lookup", count=len(ids)):
+            for id in ids:
+                try:
+                    async with limiter("search").slot_async():
+                        h = await self.search_client.get_document(
+                            key=id,
+                            selected_fields=["id", "content", "uri", "title", "documentId", "driveId", "driveItemId", "snapshot"])
+                except ResourceNotFoundError:
+                    continue
+                fragments.append({
+                    "id": h["id"],
+                    "content": h["content"],
+                    "uri": h["uri"],
+                    "title": h["title"],
+                    "documentId": h["documentId"],
+                    "driveId": h["driveId"],
+                    "driveItemId": h["driveItemId"],
+                    "snapshot": h["snapshot"]
+                })
+        return fragments
+
+    async def get_from_index(self, query: str, ids: [str] = None, k: int = 1):
+        """
+        Executes a search query against the index. If ids is given, the query is restricted to the given ids,
+        otherwise with top_documents to the chunks of the documents closest to the query.
         """
         q = VectorizableTextQuery(
             text=query,
             fields="embedding",
-            k=k)
-        
+            k_nearest_neighbors=k)
+
+        # documents without a centroid (indexed before the document tier) are only found by a single-stage query
+        if ids is None and self.top_documents > 0 and await self.__is_document_tier_complete():
+            # embedded once for both stages instead of by the vectorizer of each index
+            vector = (await self.emb.get_embedding([query]))[0]
+            q = VectorizedQuery(vector=vector, fields="embedding", k_nearest_neighbors=k)
+            ids = await self.__top_documents(vector) or None
+
         if ids is None:
             filter = None
         elif len(ids) == 1:
@@ -109,12 +383,14 @@ class Indexer:
         else:
             filter = "search.in(documentId, '" + ",".join(ids) + "', ',')"
 
-        res = list(self.search_client.search(
-            search_text=query,
-            filter=filter,
-            select="id, content, uri, title, documentId, driveId, driveItemId, snapshot",
-            vector_queries=[q],
-            top=k))
+        with stage("index-query", k=k, scoped=ids is not None):
+            async with limiter("search").slot_async():
+                res = [h async for h in await self.search_client.search(
+                    search_text=query,
+                    filter=filter,
+                    select="id, content, uri, title, documentId, driveId, driveItemId, snapshot",
+                    vector_queries=[q],
+                    top=k)]
         
         return [
             { 
@@ -126,7 +402,8 @@ class Indexer:
                 "documentId": h["documentId"],
                 "driveId": h["driveId"],
                 "driveItemId": h["driveItemId"],
-                "snapshot": h["snapshot"]
+                "snapshot": h["snapshot"],
+                "thumbnail": thumbnail_name(h["snapshot"]) if h["snapshot"] else None
             }
             for i,h in enumerate(res)]
     
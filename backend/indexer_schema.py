@@ -1,27 +1,134 @@
+import os
+from dataclasses import dataclass
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
 from azure.identity import DefaultAzureCredential
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
+    BinaryQuantizationCompression,
     HnswAlgorithmConfiguration, 
     HnswParameters,
+    RescoringOptions,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
     SearchFieldDataType,
     SearchIndex,
     SearchField,
     SimpleField,
     VectorSearch, 
+    VectorSearchCompressionRescoreStorageMethod,
     VectorSearchProfile, 
     VectorSearchAlgorithmKind, 
     VectorSearchAlgorithmMetric
 )
 
-def ensure_index_exists(indexer_endpoint, index_name, mgmt_key, openai_endpoint, openai_key, embeddings_model):
+# dimensions of text-embedding-ada-002 and the default of text-embedding-3-small
+DEFAULT_DIMENSIONS = 1536
+
+@dataclass
+class VectorConfig:
     """
-    Creates the index if it doesn't exist
+    Vector field and search configuration of the index.
+    dimensions: reduced embedding size, only for models supporting the dimensions parameter (text-embedding-3-*),
+        None keeps the model default
+    compression: none, scalar (int8) or binary quantization
+    rescore: rescore quantized results with the original vectors, oversampling candidates
+    stored: keep a retrievable copy of the vectors, not needed for querying
+    hnsw_*: HNSW graph parameters
     """
+    dimensions: int = None
+    compression: str = "none"
+    rescore: bool = True
+    oversampling: float = 4.0
+    stored: bool = True
+    hnsw_m: int = 4
+    hnsw_ef_construction: int = 400
+    hnsw_ef_search: int = 500
+
+    @property
+    def field_dimensions(self) -> int:
+        return self.dimensions or DEFAULT_DIMENSIONS
+
+    @staticmethod
+    def from_env():
+        dimensions = os.getenv("VECTOR_DIMENSIONS")
+        return VectorConfig(
+            dimensions=int(dimensions) if dimensions else None,
+            compression=os.getenv("VECTOR_COMPRESSION", "none").lower(),
+            rescore=os.getenv("VECTOR_RESCORE", "true").lower() == "true",
+            oversampling=float(os.getenv("VECTOR_OVERSAMPLING", "4")),
+            stored=os.getenv("VECTOR_STORED", "true").lower() == "true",
+            hnsw_m=int(os.getenv("HNSW_M", "4")),
+            hnsw_ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION", "400")),
+            hnsw_ef_search=int(os.getenv("HNSW_EF_SEARCH", "500")))
+
+def vector_compressions(config: VectorConfig) -> list:
+    if config.compression == "none":
+        return []
+
+    rescoring_options = RescoringOptions(
+        enable_rescoring=config.rescore,
+        default_oversampling=config.oversampling if config.rescore else None,
+        # without rescoring the full precision vectors are not needed at all
+        rescore_storage_method=VectorSearchCompressionRescoreStorageMethod.PRESERVE_ORIGINALS if config.rescore
+            else VectorSearchCompressionRescoreStorageMethod.DISCARD_ORIGINALS)
 
-    client = SearchIndexClient(indexer_endpoint, DefaultAzureCredential())
+    if config.compression == "scalar":
+        return [ScalarQuantizationCompression(
+            compression_name="compression-01",
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            rescoring_options=rescoring_options)]
+    if config.compression == "binary":
+        return [BinaryQuantizationCompression(
+            compression_name="compression-01",
+            rescoring_options=rescoring_options)]
+
+    raise ValueError(f"Unsupported vector compression: {config.compression}")
+
+def manifest_index_name(index_name: str) -> str:
+    return f"{index_name}-manifest"
+
+def ensure_manifest_index_exists(client: SearchIndexClient, index_name: str, vector_config: VectorConfig = None):
+    """
+    Creates the manifest index next to the chunk index, one small document per source document
+    keyed by the same safe id, looked up with get_document. Existing manifest indexes get new fields added.
+    The centroid of a document's chunk vectors is the document tier of two-stage queries, it is queried
+    with the query vector of the chunk search, so the manifest needs no vectorizer nor compression.
+    """
+    vector_config = vector_config or VectorConfig.from_env()
+    name = manifest_index_name(index_name)
+    fields = [
+        SimpleField(name="id", type=SearchFieldDataType.String, key=True, retrievable=True),
+        SimpleField(name="lastModified", type=SearchFieldDataType.DateTimeOffset, retrievable=True),
+        SimpleField(name="contentTag", type=SearchFieldDataType.String, retrievable=True),
+        SimpleField(name="chunkCount", type=SearchFieldDataType.Int32, retrievable=True),
+        SimpleField(name="chunkHashes", type=SearchFieldDataType.Collection(SearchFieldDataType.String), retrievable=True),
+        SimpleField(name="snapshots", type=SearchFieldDataType.Collection(SearchFieldDataType.String), retrievable=True),
+        SimpleField(name="indexed", type=SearchFieldDataType.DateTimeOffset, retrievable=True),
+        SearchField(name="centroid", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), vector_search_dimensions=vector_config.field_dimensions, vector_search_profile_name="centroid-config-01", filterable=False, sortable=False, facetable=False)
+    ]
+    vector_search = VectorSearch(
+        profiles=[VectorSearchProfile(name="centroid-config-01", algorithm_configuration_name="centroid-hnsw-01")],
+        algorithms=[
+            HnswAlgorithmConfiguration(
+                name="centroid-hnsw-01",
+                parameters=HnswParameters(
+                    m=vector_config.hnsw_m,
+                    ef_construction=vector_config.hnsw_ef_construction,
+                    ef_search=vector_config.hnsw_ef_search,
+                    metric=VectorSearchAlgorithmMetric.COSINE))])
+    client.create_or_update_index(SearchIndex(name=name, fields=fields, vector_search=vector_search))
+    print("Manifest index ready")
+
+def ensure_index_exists(indexer_endpoint, index_name, mgmt_key, openai_endpoint, openai_key, embeddings_model, credential: DefaultAzureCredential = None, vector_config: VectorConfig = None):
+    """
+    Creates the index if it doesn't exist. The vector configuration only applies when the
+    index is created, changing it for an existing index takes a re-index (see reindex.py).
+    """
+    vector_config = vector_config or VectorConfig.from_env()
+
+    client = SearchIndexClient(indexer_endpoint, credential or DefaultAzureCredential())
     
     indexFound = False
     
@@ -38,7 +145,7 @@ def ensure_index_exists(indexer_endpoint, index_name, mgmt_key, openai_endpoint,
             SimpleField(name="driveId", type=SearchFieldDataType.String, retrievable=True, filterable=False, searchable=False, facetable=False, sortable=False),  
             SimpleField(name="driveItemId", type=SearchFieldDataType.String, retrievable=True, filterable=False, searchable=False, facetable=False, sortable=False),  
             SimpleField(name="documentId", type=SearchFieldDataType.String, filterable=True, searchable=True, facetable=False, sortable=False, retrievable=True),  
-            SearchField(name="embedding", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), vector_search_dimensions=1536, vector_search_profile_name="vector-config-01", filterable=False, sortable=False, facetable=False),
+            SearchField(name="embedding", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), vector_search_dimensions=vector_config.field_dimensions, vector_search_profile_name="vector-config-01", filterable=False, sortable=False, facetable=False, stored=vector_config.stored, hidden=not vector_config.stored),
             SimpleField(name="uri", type=SearchFieldDataType.String, analyzer_name="standard.lucene", retrievable=True, searchable=False, filterable=False, sortable=False, facetable=False),  
             SearchField(name="title", type=SearchFieldDataType.String, filterable=False, sortable=False, facetable=False),  
             SimpleField(name="chunk", type=SearchFieldDataType.Int32, sortable=True, filterable=False, retrievable=True, searchable=False, facetable=False),  
@@ -47,20 +154,24 @@ def ensure_index_exists(indexer_endpoint, index_name, mgmt_key, openai_endpoint,
             SimpleField(name="snapshot", type=SearchFieldDataType.String, retrievable=True, searchable=False, filterable=False, sortable=False, facetable=False)
         ]  
 
+        compressions = vector_compressions(vector_config)
+
         vector_search = VectorSearch(
             profiles=[
                 VectorSearchProfile(
                     name="vector-config-01", 
                     algorithm_configuration_name="alg-hnsw-01",
-                    vectorizer_name="openai-vectorizer-01")
+                    vectorizer_name="openai-vectorizer-01",
+                    compression_name=compressions[0].compression_name if compressions else None)
                 ],
+            compressions=compressions,
             algorithms=[        
                 HnswAlgorithmConfiguration(  
                     name="alg-hnsw-01",
                     parameters=HnswParameters(  
-                        m=4,  
-                        ef_construction=400,  
-                        ef_search=500,  
+                        m=vector_config.hnsw_m,  
+                        ef_construction=vector_config.hnsw_ef_construction,  
+                        ef_search=vector_config.hnsw_ef_search,  
                         metric=VectorSearchAlgorithmMetric.COSINE,  
                     ),  
                 ),
@@ -83,6 +194,8 @@ def ensure_index_exists(indexer_endpoint, index_name, mgmt_key, openai_endpoint,
     else:
         print("Index already exists")
 
+    ensure_manifest_index_exists(client, index_name, vector_config)
+
 
     
 
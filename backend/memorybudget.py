@@ -0,0 +1,45 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from telemetry import stage
+
+# working set of processing one PDF page: the 150 dpi rendering plus its grayscale, edge and encoding copies
+PDF_PAGE_BYTES = 48 * 1024 * 1024
+# python-docx builds an object tree several times the size of the (compressed) file
+DOCX_EXPANSION = 10
+
+class MemoryBudget:
+    """
+    Bounds the memory of concurrent ingestions in one worker. Every ingestion reserves its
+    estimated working set before downloading and processing and waits while the budget is used up.
+    An ingestion estimated above the whole budget still runs, but alone.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = asyncio.Condition()
+
+    @staticmethod
+    def estimate(filename: str, size: int) -> int:
+        """
+        Downloads stream to disk and PDFs are processed page by page from the memory mapped file,
+        so for PDFs the cost is one page at a time rather than the file size.
+        """
+        if os.path.splitext(filename)[1].lower() == ".docx":
+            return (size or 0) * DOCX_EXPANSION
+        return PDF_PAGE_BYTES
+
+    @asynccontextmanager
+    async def reserve(self, amount: int):
+        amount = min(amount, self.max_bytes)
+        with stage("memory-budget-wait", requested=amount):
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.used == 0 or self.used + amount <= self.max_bytes)
+                self.used += amount
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.used -= amount
+                self._condition.notify_all()
@@ -1,6 +1,17 @@
+import os
 from dataclasses import dataclass
 
+# shorter fragments carry too little text to be worth embedding and are not indexed
+MIN_FRAGMENT_LENGTH = 50
+
 @dataclass
 class DocumentFragment:
     text: str
-    snapshot: str
\ No newline at end of file
+    snapshot: str
+
+def thumbnail_name(snapshot: str) -> str:
+    """
+    Name of the small variant stored next to a snapshot.
+    """
+    stem, extension = os.path.splitext(snapshot)
+    return f"{stem}-thumb{extension}"
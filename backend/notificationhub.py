@@ -1,5 +1,11 @@
+import asyncio
+
 from auth import CallContext, get_user_id
 from azure.messaging.webpubsubservice import WebPubSubServiceClient
+from telemetry import get_logger
+
+# sends in flight, the event loop only keeps weak references to tasks
+_sending = set()
 
 class NotificationHub:
     def __init__(self, connection_string: str, hub: str) -> None:
@@ -10,15 +16,33 @@ class NotificationHub:
 
     def send(self, message: str, user: str = None):
         if(user == None):
-            self.client.send_to_all(message)
+            self.client.send_to_all(message=message)
         else:
-            self.client.send_to_user(message, user)
+            self.client.send_to_user(user_id=user, message=message)
 
 class NotificationChannel: 
+    """
+    Notifications for the user behind the call context. App-only contexts
+    (background crawling) have nobody to notify, so messages are dropped.
+    The WebPubSub client is synchronous: messages are sent from a worker thread in the order they were
+    sent to the channel, without holding up the caller. A failed notification is logged, not raised.
+    """
     def __init__(self, hub: NotificationHub, ctx: CallContext) -> None:
         self.hub = hub
-        self.user_id = get_user_id(ctx.user_token)
+        self.user_id = get_user_id(ctx.user_token) if ctx.user_token else None
+        self._last = None
 
     def send(self, message: str):
-        self.hub.send(self.user_id, message)
+        if self.user_id is not None:
+            self._last = asyncio.get_running_loop().create_task(self.__send(message, self._last))
+            _sending.add(self._last)
+            self._last.add_done_callback(_sending.discard)
+
+    async def __send(self, message: str, previous: asyncio.Task):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await asyncio.to_thread(self.hub.send, message, self.user_id)
+        except Exception as e:
+            get_logger().warning(f"Unable to notify {self.user_id}: {e}")
 
@@ -1,54 +1,59 @@
 import asyncio
 import os
-from auth import CallContext
-from pdfprocessor import PdfProcessor
-from docxprocessor import DocxProcessor
-from embeddings import Embeddings
+import services
+from auth import CallContext, get_user_id
 from indexer import Indexer
+from memorybudget import MemoryBudget
+from resilience import UnavailableError
+from resultcache import ResultCache
 from drive import DriveFileFetcher
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
 from msal import ConfidentialClientApplication
 from dateutil import parser
 from search import SharePointIndex
-from filestorage import FileStorage
-from notificationhub import NotificationHub, NotificationChannel
-from telemetry import get_logger
+from notificationhub import NotificationChannel
+from model import MIN_FRAGMENT_LENGTH
+from telemetry import count_cache, count_deduplicated, get_logger, stage
 
 class SharePointRagOrchestrator:
-    def __init__(self, app: ConfidentialClientApplication):
+    def __init__(self, app: ConfidentialClientApplication, indexer: Indexer = None):
         self.app = app
 
         self.sp_index = SharePointIndex(app)
 
-        self.embeddings = Embeddings(
-            os.getenv("OPENAI_ENDPOINT"),
-            os.getenv("OPENAI_EMBEDDINGS_MODEL"))
-
-        self.indexer = Indexer(
-            os.getenv("INDEXER_ENDPOINT"),
-            os.getenv("INDEXER_INDEX"),
-            self.embeddings,
-            DefaultAzureCredential() )
-
-        self.storage = FileStorage( 
-            storage_account_name=os.getenv("BLOB_STORAGE_ACCOUNT_NAME"),
-            container_name=os.getenv("BLOB_CONTAINER_NAME"))
+        # shared with the rest of the process, see services.py
+        self.embeddings = services.embeddings()
+        self.indexer = indexer or services.indexer()
+        self.storage = services.storage()
+        self.documents = services.document_cache()
+        self.results = services.result_cache()
+        self.memory = services.memory_budget()
+        self.notification_hub = services.notification_hub()
 
         self.drive = DriveFileFetcher( app )
 
-        self.notification_hub = NotificationHub(os.getenv("WEBPUBSUB_CONNECTION_STRING"), 'hub')
-
         self.log = get_logger()
-    async def ensure_document_in_index(self, search_object: dict, ctx: CallContext):
+    async def ensure_document_in_index(self, search_object: dict, ctx: CallContext, force: bool = False):
         intercom = NotificationChannel(self.notification_hub, ctx)
         try:
-            doc_id = await self.__ensure_document_in_index(search_object, ctx, intercom)
+            doc_id = await self.__ensure_document_in_index(search_object, ctx, intercom, force)
             intercom.send(f"Document {doc_id} has been indexed.")
             return doc_id
         except Exception as e:
-
+            self.log.exception(e)
             return ""
+
+    async def remove_document(self, drive_id: str, item_id: str):
+        """
+        Drops all fragments of a document that was deleted in SharePoint.
+        """
+        safe_id = Indexer.safe_id(drive_id, item_id)
+        manifest = await self.indexer.get_manifest(safe_id)
+        removed = await self.indexer.delete_document(safe_id)
+        self.results.invalidate_document(safe_id)
+        if manifest is not None:
+            await self.__update_snapshot_references(set(), set(manifest.get("snapshots") or []))
+        self.log.info(f"Removed {removed} fragments of {safe_id} from the index")
+        return safe_id
     
     async def search(self, keywords: str, query: str, ctx: CallContext, max_results: int = 3):
         
@@ -59,7 +64,7 @@ class SharePointRagOrchestrator:
         intercom.send(f"Asking sharepoint for '{keywords}'...")
         
         self.log.info(f"Asking sharepoint for '{keywords}'...")
-        result = self.sp_index.search(keywords, ctx, max_results)
+        result = await self.sp_index.search(keywords, ctx, max_results)
 
         self.log.info(f"Sharepoint returned {len(result)} results.")
 
@@ -70,7 +75,7 @@ class SharePointRagOrchestrator:
             self.log.info(f"Document ensured in index: {safe_id}") 
             document_ids.append(safe_id)
 
-        suggestions = list(self.indexer.get_from_index(query=query, ids=document_ids, k=max_results))
+        suggestions = await self.indexer.get_from_index(query=query, ids=document_ids, k=max_results)
                
         intercom.send(f"Found {len(suggestions)} indexed fragments.")
 
@@ -82,23 +87,78 @@ class SharePointRagOrchestrator:
         self.log.info(f"Searching indexed documents for '{query}'...")
 
         intercom = NotificationChannel(self.notification_hub, ctx)
+
+        # results are already filtered by the user's permissions, so they are only shared with the same user
+        cache_key = ResultCache.key(get_user_id(ctx.user_token), query, max_results) if ctx.user_token else None
+        suggestions = self.results.get(cache_key) if cache_key else None
+        if suggestions is not None:
+            intercom.send(f"Found {len(suggestions)} indexed fragments.")
+            return suggestions
+
         intercom.send("Searching indexed documents...")
         
         try:
             suggestions = await self.__get_suggestions_from_index(query=query, ctx=ctx, max_results=max_results)
+            if cache_key:
+                self.results.put(cache_key, suggestions)
             
             intercom.send(f"Found {len(suggestions)} indexed fragments.")
             
             return suggestions
         except Exception as e:
-            log.exception(e)
+            self.log.exception(e)
             intercom.send(f"Oops, something went wrong: {e}")
             return []
 
+    async def ask(self, query: str, ctx: CallContext, max_results: int = 3):
+        """
+        Answers a natural-language query in stages, yielded as they become available:
+        results from the existing index (started right away, concurrently with keyword extraction),
+        the extracted keywords, and results refined with a SharePoint keyword search, which
+        indexes newly found documents. The indexed stage always comes before the refined one.
+        """
+        indexed = asyncio.create_task(self.search_indexed(query, ctx, max_results))
+        keywords = asyncio.create_task(services.chat_completions().extract_keywords(query))
+        refined = None
+        pending = {indexed, keywords}
+        indexed_sent = False
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if indexed in done:
+                    indexed_sent = True
+                    yield {"stage": "indexed", "results": indexed.result()}
+
+                if keywords in done:
+                    try:
+                        extracted = keywords.result()
+                    except Exception as e:
+                        self.log.exception(e)
+                        extracted = ""
+                    yield {"stage": "keywords", "keywords": extracted}
+                    if extracted:
+                        refined = asyncio.create_task(self.search(extracted, query, ctx, max_results))
+                        pending.add(refined)
+
+                if refined is not None and refined in done:
+                    if not indexed_sent:
+                        indexed_sent = True
+                        pending.discard(indexed)
+                        yield {"stage": "indexed", "results": await indexed}
+                    try:
+                        yield {"stage": "refined", "results": refined.result()}
+                    except Exception as e:
+                        self.log.exception(e)
+                        yield {"stage": "refined", "results": [], "error": str(e)}
+        finally:
+            # the client went away, don't keep searching and indexing for nobody
+            for task in pending:
+                task.cancel()
+
     async def __get_suggestions_from_index(self, query: str, ctx: CallContext, max_results: int = 3):
         
         # get more than we need so we can filter out inaccessible documents
-        suggestions = self.indexer.get_from_index(query=query, k=max_results*10)
+        suggestions = await self.indexer.get_from_index(query=query, k=max_results*10)
         
         # extract unique document ids
         document_ids = {}
@@ -109,30 +169,50 @@ class SharePointRagOrchestrator:
         valid_suggestions = []
         accessible_documents = {}
         for s in suggestions:
-            if s["documentId"] not in accessible_documents:
-                try:
-                    self.drive.get_item(s['driveId'], s['driveItemId'], ctx)
-                    accessible_documents[s["documentId"]] = True
-                except Exception as e:
-                    # user does not have access to this document
-                    accessible_documents[s["documentId"]] = False
-            
-            if accessible_documents[s["documentId"]]:
+            if await self.__is_accessible(s, ctx, accessible_documents):
                 valid_suggestions.append(s)
             
             if len(valid_suggestions) == max_results:
                 break
 
         return valid_suggestions
+
+    async def get_fragments(self, ids: list[str], ctx: CallContext):
+        """
+        Looks up fragments by id (as returned by get_from_index), keeping the given order
+        and dropping those the user has no access to.
+        """
+        fragments = await self.indexer.get_fragments(ids)
+        accessible_documents = {}
+        return [f for f in fragments if await self.__is_accessible(f, ctx, accessible_documents)]
+
+    async def __is_accessible(self, fragment: dict, ctx: CallContext, accessible_documents: dict) -> bool:
+        """
+        Checks whether the user can read the document of the fragment, memoized per document in accessible_documents.
+        """
+        if fragment["documentId"] not in accessible_documents:
+            try:
+                with stage("permission-check", documentId=fragment["documentId"]):
+                    await self.drive.get_item(fragment['driveId'], fragment['driveItemId'], ctx)
+                accessible_documents[fragment["documentId"]] = True
+            except UnavailableError:
+                # Graph is down, which is not a denial: fail the request instead of caching empty results
+                raise
+            except Exception as e:
+                # user does not have access to this document
+                accessible_documents[fragment["documentId"]] = False
+        return accessible_documents[fragment["documentId"]]
             
 
-    async def __ensure_document_in_index(self, search_object: dict, ctx: CallContext, intercom:NotificationChannel):
+    async def __ensure_document_in_index(self, search_object: dict, ctx: CallContext, intercom:NotificationChannel, force: bool = False):
 
         self.log.info(f"Ensuring document is in index: {search_object['title']} ({search_object['id']})")     
         safe_id = Indexer.safe_id(search_object["driveId"], search_object["id"])
         last_modified = parser.parse(search_object["lastModified"])
         
-        if not self.indexer.is_in_index(safe_id, last_modified):
+        in_index = not force and await self.indexer.is_in_index(safe_id, last_modified)
+        count_cache("index", in_index)
+        if not in_index:
             doctitle = search_object["title"]
             
             
@@ -140,38 +220,146 @@ class SharePointRagOrchestrator:
             
             print(f"Indexing {safe_id}")
             # get item from drive
-            item = self.drive.get_item(search_object["driveId"], search_object["id"], ctx)
+            item = await self.drive.get_item(search_object["driveId"], search_object["id"], ctx)
 
-            filename = search_object["name"]
-            filename_extension = os.path.splitext(filename)[1].lower()
+            # a newer version with the same content tag only changed metadata, nothing to re-index
+            manifest = None if force else await self.indexer.get_manifest(safe_id)
+            if manifest is not None and manifest["contentTag"] == item["contentTag"]:
+                await self.indexer.refresh_manifest(safe_id, last_modified, item["url"], doctitle, manifest["chunkCount"])
+                self.results.invalidate_document(safe_id)
+                return safe_id
 
-            processor = None
-            if filename_extension == ".docx":
-                processor = DocxProcessor(item["downloadUrl"], 500)
-            else:
-                processor = PdfProcessor(item["downloadUrl"], self.storage)
-
-            if processor is None:
-                raise Exception(f"Unsupported file type: {filename_extension}")
-            
-            fragments = list(processor.split(safe_id))
+            # download and processing are blocking and CPU heavy, keep them off the event loop
+            # a forced re-index (e.g. after a chunking change) must not reuse previously extracted fragments
+            async with self.memory.reserve(MemoryBudget.estimate(search_object["name"], item.get("size"))):
+                fragments = await asyncio.to_thread(self.__get_fragments, search_object, item, safe_id, asyncio.get_running_loop(), not force)
+                fragments = await asyncio.to_thread(self.__deduplicate, safe_id, fragments)
 
-            await self.indexer.index_with_embeddings( 
+            added, released = await self.indexer.index_with_embeddings( 
                 docid=safe_id,
                 driveId=search_object["driveId"],
                 driveItemId=search_object["id"],
                 uri=item["url"],
                 title=doctitle,
-                fragments=fragments)
+                fragments=fragments,
+                last_modified=last_modified,
+                content_tag=item["contentTag"])
+            self.results.invalidate_document(safe_id)
+            await self.__update_snapshot_references(added, released)
 
             intercom.send(f"Making sure '{doctitle}' has been successfully indexed...")
 
-            circuit_idx = 1
-            while not self.indexer.is_in_index(safe_id):
-                print(f"Waiting for indexing to complete: {circuit_idx}")
-                await asyncio.sleep(1 + circuit_idx*2)
-                circuit_idx += 1
-                if circuit_idx > 5:
-                    raise Exception("Indexing timeout")
+            # the chunks, not the manifest: on a re-index the manifest exists before the new chunks are searchable
+            with stage("visibility-wait", documentId=safe_id):
+                circuit_idx = 1
+                while not await self.indexer.is_searchable(safe_id, fragments, last_modified):
+                    print(f"Waiting for indexing to complete: {circuit_idx}")
+                    await asyncio.sleep(1 + circuit_idx*2)
+                    circuit_idx += 1
+                    if circuit_idx > 5:
+                        raise Exception("Indexing timeout")
+
+        return safe_id
+
+    async def estimate_document(self, search_object: dict, ctx: CallContext) -> dict:
+        """
+        Dry run of the ingestion: downloads (through the cache) and splits the document without
+        classifying pages, uploading snapshots or calling the embeddings model.
+        Returns the number of pages, fragments and embedding tokens indexing would take, after deduplication,
+        and the fragments and tokens deduplication saved.
+        """
+        item = await self.drive.get_item(search_object["driveId"], search_object["id"], ctx)
+        async with self.memory.reserve(MemoryBudget.estimate(search_object["name"], item.get("size"))):
+            path = await asyncio.to_thread(self.drive.download, search_object["driveId"], item, self.documents)
+
+            filename_extension = os.path.splitext(search_object["name"])[1].lower()
+            if filename_extension == ".docx":
+                from docxprocessor import DocxProcessor
+                fragments = await asyncio.to_thread(lambda: list(DocxProcessor(path, 500).split("")))
+                pages = 0
+            else:
+                from pdfprocessor import PdfProcessor
+                fragments = await asyncio.to_thread(lambda: list(PdfProcessor(path).split("")))
+                pages = len(fragments)
+            fragments, report = await asyncio.to_thread(services.deduplicator().deduplicate, fragments)
+
+        return {
+            "pages": pages,
+            # the same filter as Indexer.index_with_embeddings
+            "fragments": len([f for f in fragments if len(f.text) > MIN_FRAGMENT_LENGTH]),
+            "tokens": report.tokens_after,
+            "deduplicated_fragments": report.removed_fragments,
+            "saved_tokens": report.saved_tokens }
 
-        return safe_id
\ No newline at end of file
+    async def __update_snapshot_references(self, added: set[str], released: set[str]):
+        """
+        Snapshots are shared between documents, their blobs count the documents referencing them.
+        Snapshots with the old per-page names are not reference counted and are skipped.
+        """
+        added = sorted(added)
+        counts = await asyncio.gather(*[self.storage.add_references(name, 1) for name in added])
+        await asyncio.gather(*[self.storage.add_references(name, -1) for name in released])
+        missing = [name for name, count in zip(added, counts) if count is None and name.startswith("snap-")]
+        if len(missing) > 0:
+            # the fragments were checked before indexing, something deleted the blobs since
+            raise Exception(f"Snapshots {', '.join(missing)} are referenced but missing in storage")
+
+    def __deduplicate(self, safe_id: str, fragments: list) -> list:
+        """
+        Strips boilerplate and drops near-duplicate fragments before they are embedded, reports what it saved.
+        """
+        with stage("deduplication", documentId=safe_id) as span:
+            fragments, report = services.deduplicator().deduplicate(fragments)
+            span.set_attribute("removedFragments", report.removed_fragments)
+            span.set_attribute("savedTokens", report.saved_tokens)
+        count_deduplicated("fragments", report.removed_fragments)
+        count_deduplicated("lines", report.stripped_lines)
+        count_deduplicated("tokens", report.saved_tokens)
+        self.log.info(f"Deduplication of {safe_id}: {report.removed_fragments} of {report.fragments} fragments dropped, "
+                      f"{report.stripped_lines} boilerplate lines stripped, {report.saved_tokens} of {report.tokens_before} tokens saved")
+        return fragments
+
+    def __retain_snapshots(self, fragments: list, loop: asyncio.AbstractEventLoop) -> bool:
+        """
+        Whether all snapshots the fragments name still exist, keeps them from being collected until indexed.
+        """
+        async def retain_all():
+            return await asyncio.gather(*[self.storage.retain(name) for name in sorted({f.snapshot for f in fragments if f.snapshot})])
+        return all(asyncio.run_coroutine_threadsafe(retain_all(), loop).result())
+
+    def __get_fragments(self, search_object: dict, item: dict, safe_id: str, loop: asyncio.AbstractEventLoop, reuse_fragments: bool = True):
+        """
+        Splits the document into fragments. Unchanged content (same content tag) that was processed
+        before, e.g. a failed indexing attempt or a metadata-only edit, is neither downloaded nor processed again.
+        """
+        drive_id = search_object["driveId"]
+        fragments = self.documents.get_fragments(drive_id, item["id"], item["contentTag"]) if reuse_fragments else None
+        if fragments is not None and self.__retain_snapshots(fragments, loop):
+            self.log.info(f"Reusing cached fragments of {safe_id}")
+            return fragments
+        if fragments is not None:
+            # e.g. a retry after the snapshot grace period, the unreferenced snapshots were collected
+            self.log.warning(f"Snapshots of the cached fragments of {safe_id} are gone, processing it again")
+            self.documents.drop_fragments(drive_id, item["id"], item["contentTag"])
+
+        path = self.drive.download(drive_id, item, self.documents)
+
+        filename = search_object["name"]
+        filename_extension = os.path.splitext(filename)[1].lower()
+
+        # document libraries (fitz, cv2, numpy, docx, tiktoken) are heavy, load them on first ingestion only
+        processor = None
+        if filename_extension == ".docx":
+            from docxprocessor import DocxProcessor
+            processor = DocxProcessor(path, 500)
+        else:
+            from pdfprocessor import PdfProcessor
+            # snapshot uploads go through the async storage client on the event loop
+            processor = PdfProcessor(path, self.storage, loop=loop)
+
+        if processor is None:
+            raise Exception(f"Unsupported file type: {filename_extension}")
+        
+        fragments = list(processor.split(safe_id))
+        self.documents.put_fragments(drive_id, item["id"], item["contentTag"], fragments)
+        return fragments
\ No newline at end of file
@@ -1,22 +1,30 @@
-from PyPDF2 import PdfReader
-import requests
-import io
+import asyncio
 import fitz
+from datetime import datetime, timezone
 import numpy as np
 import cv2
-from filestorage import FileStorage
-from model import DocumentFragment
-from telemetry import get_logger
+from filestorage import REFERENCES, RELEASED, FileStorage
+from model import DocumentFragment, thumbnail_name
+from snapshots import SnapshotEncoder
+from telemetry import count_bytes, count_cache, get_logger, stage
 
 class PdfProcessor:
 
-    def __init__(self, pdf_file_url: str, storage: FileStorage = None):
-        self.pdf_file_url = pdf_file_url
+    def __init__(self, pdf_file_path: str, storage: FileStorage = None, encoder: SnapshotEncoder = None,
+                 loop: asyncio.AbstractEventLoop = None):
+        """
+        split() runs in a worker thread, storage calls are scheduled on loop (the event loop owning the
+        async storage client) and waited for, so rendering stays off the loop and uploads on it.
+        """
+        self.pdf_file_path = pdf_file_path
         self.storage = storage
+        self.loop = loop
+        self.encoder = encoder or SnapshotEncoder.from_env()
 
     @staticmethod
     def pix_to_image(pix):
-        bytes = np.frombuffer(pix.samples, dtype=np.uint8)
+        # samples_mv is a view on the pixmap, samples would be another copy of the page
+        bytes = np.frombuffer(pix.samples_mv, dtype=np.uint8)
         img = bytes.reshape(pix.height, pix.width, pix.n)
         return img
     
@@ -34,23 +42,66 @@ class PdfProcessor:
 
     def split(self, prefix: str) -> [DocumentFragment]: 
         log = get_logger()
-        log.info(f"Processing {self.pdf_file_url}")
-        response = requests.get(self.pdf_file_url)
-        pdf_io_bytes = io.BytesIO(response.content)
-        
-        doc = fitz.open(stream=pdf_io_bytes, filetype="pdf")
-        # extract text from all pages
-        for page in doc:
-            text = page.get_text()
-            pix = page.get_pixmap(matrix=fitz.Matrix(150/72,150/72))
-            img = PdfProcessor.pix_to_image(pix)
-            imageName = f"{prefix}-{page.number}.png"
-            snapshot = None
-            if self.storage is not None and self.need_to_keep_image(img):
-                self.storage.put(cv2.imencode(".png", img)[1].tobytes(), imageName)
-                snapshot = imageName
-            
-            yield DocumentFragment(
-                text=text,
-                snapshot=snapshot
-            )
\ No newline at end of file
+        log.info(f"Processing {self.pdf_file_path}")
+        # opened by path, MuPDF reads the cached file on demand instead of holding a copy in memory
+        doc = fitz.open(self.pdf_file_path, filetype="pdf")
+        # snapshots of this document known to be stored, repeated pages don't even need the exists check
+        stored = set()
+        try:
+            # extract text from all pages
+            for page in doc:
+                text = page.get_text()
+                snapshot = None
+                # only pages that may become snapshots are rendered
+                if self.storage is not None:
+                    with stage("page-render", page=page.number):
+                        pix = page.get_pixmap(matrix=fitz.Matrix(150/72,150/72))
+                        img = PdfProcessor.pix_to_image(pix)
+                    with stage("classification", page=page.number):
+                        keep = self.need_to_keep_image(img)
+                    if keep:
+                        imageName = self.encoder.name(img)
+                        if imageName not in stored:
+                            self.__store(img, imageName, page.number)
+                            stored.add(imageName)
+                        snapshot = imageName
+                    # one page buffer at a time, not one per page until the generator is done
+                    del img, pix
+                
+                yield DocumentFragment(
+                    text=text,
+                    snapshot=snapshot
+                )
+        finally:
+            doc.close()
+
+    def __store(self, img, imageName: str, page: int):
+        """
+        Uploads snapshot and thumbnail unless another page or document stored the same content before.
+        The check only saves the encoding, the uploads themselves never overwrite, so a concurrent ingestion
+        of the same content can't reset the references of a snapshot stored in between.
+        New blobs start without references, the orchestrator counts them once the document is indexed;
+        if that never happens (failed ingestion) they are collected like released ones.
+        """
+        with stage("snapshot-exists", page=page):
+            exists = self.__run(self.storage.exists(imageName))
+        count_cache("snapshot", exists)
+        if exists:
+            return
+
+        with stage("snapshot-encode", page=page, format=self.encoder.format):
+            encoded = self.encoder.encode(img)
+            thumbnail = self.encoder.encode_thumbnail(img)
+        with stage("snapshot-upload", page=page):
+            # the thumbnail goes first, a snapshot that exists always has its thumbnail
+            self.__run(self.storage.put(thumbnail, thumbnail_name(imageName), self.encoder.content_type, overwrite=False))
+            stored = self.__run(self.storage.put(encoded, imageName, self.encoder.content_type, metadata={
+                REFERENCES: "0",
+                RELEASED: datetime.now(timezone.utc).isoformat() }, overwrite=False))
+        if not stored:
+            # another ingestion stored the same content since the check
+            return
+        count_bytes("snapshot-upload", len(encoded) + len(thumbnail))
+
+    def __run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
\ No newline at end of file
@@ -0,0 +1,325 @@
+"""
+Process-wide rate limiting of outbound calls (Graph, Azure OpenAI, Azure AI Search, Blob Storage).
+
+Every service gets a token bucket (requests per second with a burst) and an adaptive concurrency
+limit: it grows additively while calls succeed and is halved on 429/503, Retry-After pauses the
+service altogether (AIMD). Waiting calls are admitted by priority, interactive requests first;
+background work (crawler, bulk re-index) is marked with the background() context and may only use
+part of the concurrency, so it yields to user traffic.
+
+    async with limiter("openai").slot_async() as permit:
+        ...
+        permit.observe(status_code, headers)
+"""
+import asyncio
+import contextvars
+import email.utils
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+
+from telemetry import count_throttled, stage
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+HTTP_CONNECT_TIMEOUT = 10
+
+_priority = contextvars.ContextVar("rate_limit_priority", default=INTERACTIVE)
+
+@contextmanager
+def background():
+    """
+    Marks outbound calls made in this context, and in tasks and threads started from it, as background work.
+    """
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def is_background() -> bool:
+    return _priority.get() == BACKGROUND
+
+def retry_after(headers) -> float | None:
+    """
+    Parses the retry hints of Azure services (retry-after-ms, x-ms-retry-after-ms, Retry-After in seconds or as a date).
+    """
+    if headers is None:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+class _Waiter:
+    def __init__(self, priority: int):
+        self.priority = priority
+
+class _ThreadWaiter(_Waiter):
+    def __init__(self, priority: int):
+        super().__init__(priority)
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+    def wait(self, timeout: float | None):
+        self.event.wait(timeout)
+        self.event.clear()
+
+class _TaskWaiter(_Waiter):
+    def __init__(self, priority: int):
+        super().__init__(priority)
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self):
+        # may be called from worker threads
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: float | None):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+class Permit:
+    """
+    An admitted call. Report the outcome so the limiter can adapt.
+    """
+    def __init__(self, limiter: "ServiceLimiter"):
+        self.limiter = limiter
+        self.observed = False
+
+    def observe(self, status_code: int, headers=None):
+        self.observed = True
+        self.limiter.feedback(status_code, retry_after(headers))
+
+    def observe_exception(self, e: Exception):
+        """
+        Extracts status and headers from Azure SDK (HttpResponseError), openai (APIStatusError) and requests errors.
+        """
+        status_code = getattr(e, "status_code", None)
+        response = getattr(e, "response", None)
+        if status_code is None and response is not None:
+            status_code = getattr(response, "status_code", None)
+        if status_code is not None:
+            self.observe(status_code, getattr(response, "headers", None))
+
+class ServiceLimiter:
+    """
+    Token bucket plus AIMD concurrency limit for one service, shared by threads and event loop tasks.
+    """
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int,
+                 min_concurrency: int = 1, background_share: float = 0.5):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.background_share = background_share
+
+        self.limit = float(max_concurrency)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.inflight = {INTERACTIVE: 0, BACKGROUND: 0}
+
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def feedback(self, status_code: int, retry_after_seconds: float = None):
+        now = time.monotonic()
+        with self._lock:
+            if status_code in (429, 503):
+                count_throttled(self.name, status_code)
+                # one decrease per second, a burst of 429s is one congestion signal
+                if now - self.last_decrease > 1:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self.last_decrease = now
+                if retry_after_seconds:
+                    self.paused_until = max(self.paused_until, now + retry_after_seconds)
+            elif status_code < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+    @contextmanager
+    def slot(self):
+        """
+        Blocking admission for code running in worker threads. Calls made directly on the event loop
+        thread are admitted right away (waiting there would stall the loop) but still accounted for.
+        """
+        priority = _priority.get()
+        if _in_event_loop():
+            with self._lock:
+                self.inflight[priority] += 1
+        else:
+            waiter = _ThreadWaiter(priority)
+            with stage("rate-limit-wait", service=self.name):
+                self.__enqueue(waiter)
+                while True:
+                    wait = self.__try_admit(waiter)
+                    if wait == 0:
+                        break
+                    waiter.wait(wait)
+        permit = Permit(self)
+        try:
+            yield permit
+            if not permit.observed:
+                permit.observe(200)
+        except Exception as e:
+            permit.observe_exception(e)
+            raise
+        finally:
+            self.__release(priority)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        priority = _priority.get()
+        waiter = _TaskWaiter(priority)
+        with stage("rate-limit-wait", service=self.name):
+            self.__enqueue(waiter)
+            try:
+                while True:
+                    wait = self.__try_admit(waiter)
+                    if wait == 0:
+                        break
+                    await waiter.wait(wait)
+            except BaseException:
+                self.__discard(waiter)
+                raise
+        permit = Permit(self)
+        try:
+            yield permit
+            if not permit.observed:
+                permit.observe(200)
+        except Exception as e:
+            permit.observe_exception(e)
+            raise
+        finally:
+            self.__release(priority)
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Runs a blocking SDK call in a worker thread once admitted.
+        """
+        async with self.slot_async():
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+    def __enqueue(self, waiter: _Waiter):
+        with self._lock:
+            heapq.heappush(self._waiters, (waiter.priority, next(self._sequence), waiter))
+
+    def __discard(self, waiter: _Waiter):
+        with self._lock:
+            self._waiters = [w for w in self._waiters if w[2] is not waiter]
+            heapq.heapify(self._waiters)
+            self.__wake_head()
+
+    def __try_admit(self, waiter: _Waiter) -> float | None:
+        """
+        Returns 0 when admitted, otherwise how long to wait before trying again (None: until woken up).
+        Only the head of the queue is admitted, so interactive calls always go first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._waiters[0][2] is not waiter:
+                return None
+            if now < self.paused_until:
+                return self.paused_until - now
+            if sum(self.inflight.values()) >= max(1, int(self.limit)):
+                return None
+            if waiter.priority == BACKGROUND and self.inflight[BACKGROUND] >= max(1, int(self.limit * self.background_share)):
+                return None
+
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+
+            self.tokens -= 1
+            self.inflight[waiter.priority] += 1
+            heapq.heappop(self._waiters)
+            self.__wake_head()
+            return 0
+
+    def __release(self, priority: int):
+        with self._lock:
+            self.inflight[priority] -= 1
+            self.__wake_head()
+
+    def __wake_head(self):
+        if len(self._waiters) > 0:
+            self._waiters[0][2].wake()
+
+# requests per second, burst, max concurrency
+DEFAULTS = {
+    "graph": (20, 40, 16),
+    "openai": (10, 20, 8),
+    "search": (30, 60, 16),
+    "storage": (50, 100, 32),
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(service: str) -> ServiceLimiter:
+    """
+    The shared limiter of a service, configured by RATE_LIMIT_<SERVICE>_RPS, _BURST and _CONCURRENCY.
+    """
+    with _limiters_lock:
+        if service not in _limiters:
+            rate, burst, concurrency = DEFAULTS[service]
+            prefix = f"RATE_LIMIT_{service.upper()}"
+            _limiters[service] = ServiceLimiter(
+                service,
+                float(os.getenv(f"{prefix}_RPS", rate)),
+                int(os.getenv(f"{prefix}_BURST", burst)),
+                int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+                background_share=float(os.getenv("RATE_LIMIT_BACKGROUND_SHARE", "0.5")))
+        return _limiters[service]
+
+async def http_request(service: str, method: str, url: str, retries: int = 3, **kwargs) -> requests.Response:
+    """
+    Rate limited HTTP call through requests in a worker thread. Throttled responses (429/503) are
+    retried after the Retry-After the service asked for, the last response is returned as it is.
+    """
+    # without a timeout a service outage holds the call until the OS gives up on the socket
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, float(os.getenv("HTTP_TIMEOUT_SECONDS", "30"))))
+    service_limiter = limiter(service)
+    for attempt in range(retries + 1):
+        async with service_limiter.slot_async() as permit:
+            response = await asyncio.to_thread(requests.request, method, url, **kwargs)
+            permit.observe(response.status_code, response.headers)
+        if response.status_code not in (429, 503) or attempt == retries:
+            return response
+        # with a Retry-After the limiter already holds the service back
+        if retry_after(response.headers) is None:
+            await asyncio.sleep(2 ** attempt)
+    return response
@@ -0,0 +1,288 @@
+"""
+Bulk re-index of SharePoint documents into a fresh index, e.g. after changing the embedding model,
+the chunking or the index schema. Production keeps querying INDEXER_INDEX until the new index is
+complete, optionally an alias is then pointed to it.
+
+    python reindex.py --drive <driveId> --item <driveId>:<itemId> --from-file export.jsonl
+                      [--workers 4] [--target-index name] [--checkpoint reindex-checkpoint.jsonl]
+                      [--dry-run] [--alias name]
+
+The export file has one JSON object per line with at least "driveId" and "id".
+Every finished item is appended to the checkpoint file together with the target index, so running
+the same command again resumes where an interrupted run stopped, in the same index.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+import dotenv
+
+from telemetry import get_logger, setup_telemetry
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx")
+# index aliases are only available in preview versions of the search REST API
+ALIAS_API_VERSION = "2025-05-01-preview"
+
+class Checkpoint:
+    """
+    Append-only record of processed items, one JSON line per item.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.done = {}
+        self.index = None
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.done[entry["key"]] = entry
+                        self.index = entry.get("index", self.index)
+
+    def is_done(self, key: str) -> bool:
+        return key in self.done and self.done[key]["status"] == "done"
+
+    def record(self, key: str, status: str, index: str, **details):
+        entry = {"key": key, "status": status, "index": index, **details}
+        self.done[key] = entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+class Progress:
+    """
+    Live throughput of the run, printed every few seconds.
+    """
+    def __init__(self, total: int, interval: float = 5):
+        self.total = total
+        self.interval = interval
+        self.started = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.pages = 0
+        self.tokens = 0
+        self.__last_report = 0.0
+
+    def add(self, ok: bool, pages: int = 0, tokens: int = 0):
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.pages += pages
+        self.tokens += tokens
+        if time.monotonic() - self.__last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        self.__last_report = time.monotonic()
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        processed = self.completed + self.failed
+        rate = processed / elapsed * 60
+        remaining = (self.total - processed) / (processed / elapsed) if processed > 0 else float("nan")
+        print(f"[{processed}/{self.total}] ok={self.completed} failed={self.failed} "
+              f"{rate:.1f} docs/min, pages={self.pages}, tokens={self.tokens}, eta={remaining:.0f}s", flush=True)
+
+def read_export(path: str) -> list[tuple[str, str]]:
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                items.append((entry["driveId"], entry["id"]))
+    return items
+
+async def enumerate_drive(drive, drive_id: str, ctx) -> list[tuple[str, str]]:
+    """
+    Lists all PDF/DOCX files of a drive with a full delta enumeration.
+    """
+    items = []
+    link = None
+    while True:
+        page = await drive.delta(drive_id, ctx, link)
+        for item in page["value"]:
+            if "file" in item and "deleted" not in item and item.get("name", "").lower().endswith(SUPPORTED_EXTENSIONS):
+                items.append((drive_id, item["id"]))
+        link = page.get("@odata.nextLink")
+        if link is None:
+            return items
+
+async def reindex(args):
+    import services
+    from indexer import Indexer
+    from indexer_schema import ensure_index_exists
+    from orchestration import SharePointRagOrchestrator
+
+    app = services.msal_app()
+    checkpoint = Checkpoint(args.checkpoint)
+    target_index = args.target_index or checkpoint.index or f"{os.getenv('INDEXER_INDEX')}-{datetime.now().strftime('%Y%m%d%H%M')}"
+
+    if args.alias and not args.dry_run:
+        # fail now rather than after hours of re-indexing
+        await check_alias(args.alias, services.credential())
+
+    if not args.dry_run:
+        print(f"Re-indexing into {target_index}")
+        await asyncio.to_thread(ensure_index_exists,
+            os.getenv("INDEXER_ENDPOINT"),
+            target_index,
+            os.getenv("INDEXER_MANAGE_KEY"),
+            os.getenv("OPENAI_ENDPOINT"),
+            os.getenv("OPENAI_APIKEY"),
+            os.getenv("OPENAI_EMBEDDINGS_MODEL"),
+            services.credential())
+
+    indexer = Indexer(os.getenv("INDEXER_ENDPOINT"), target_index, services.embeddings(), services.async_credential(), services.transport())
+    orchestrator = SharePointRagOrchestrator(app, indexer)
+    try:
+        await run(args, orchestrator, checkpoint, target_index)
+    finally:
+        await indexer.close()
+        await services.close()
+
+async def run(args, orchestrator, checkpoint: Checkpoint, target_index: str):
+    """
+    The re-index itself, the async clients are closed by reindex() afterwards.
+    """
+    import services
+    from auth import CallContext
+    from ratelimit import background
+
+    log = get_logger()
+    app = orchestrator.app
+
+    items = [tuple(i.split(":", 1)) for i in args.item]
+    for path in args.from_file:
+        items.extend(read_export(path))
+    for drive_id in args.drive:
+        items.extend(await enumerate_drive(orchestrator.drive, drive_id, CallContext.for_app(app)))
+    # keep the order, drop duplicates
+    items = list(dict.fromkeys(items))
+
+    pending = [i for i in items if not checkpoint.is_done(f"{i[0]}:{i[1]}")]
+    print(f"{len(items)} items, {len(items) - len(pending)} already done, {len(pending)} to go")
+
+    progress = Progress(len(pending))
+    queue = asyncio.Queue()
+    for i in pending:
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            drive_id, item_id = queue.get_nowait()
+            key = f"{drive_id}:{item_id}"
+            ctx = CallContext.for_app(app)
+            try:
+                item = await orchestrator.drive.get_item(drive_id, item_id, ctx)
+                search_object = {
+                    "id": item_id,
+                    "name": item["name"],
+                    "title": os.path.splitext(item["name"])[0],
+                    "lastModified": item["lastModified"],
+                    "driveId": drive_id }
+                if args.dry_run:
+                    estimate = await orchestrator.estimate_document(search_object, ctx)
+                    checkpoint.record(key, "done", target_index, **estimate)
+                    progress.add(True, estimate["pages"], estimate["tokens"])
+                else:
+                    ok = await orchestrator.ensure_document_in_index(search_object, ctx, force=True) != ""
+                    checkpoint.record(key, "done" if ok else "failed", target_index)
+                    progress.add(ok)
+            except Exception as e:
+                log.exception(e)
+                checkpoint.record(key, "failed", target_index, error=str(e))
+                progress.add(False)
+
+    # bulk work yields to interactive requests of the same process
+    with background():
+        await asyncio.gather(*[worker() for _ in range(args.workers)])
+    progress.report()
+
+    if args.dry_run:
+        estimates = [e for e in checkpoint.done.values() if e["status"] == "done"]
+        print(f"Estimate for {len(estimates)} documents: "
+              f"{sum(e.get('pages', 0) for e in estimates)} pages, "
+              f"{sum(e.get('fragments', 0) for e in estimates)} fragments, "
+              f"{sum(e.get('tokens', 0) for e in estimates)} embedding tokens "
+              f"({sum(e.get('deduplicated_fragments', 0) for e in estimates)} fragments and "
+              f"{sum(e.get('saved_tokens', 0) for e in estimates)} tokens saved by deduplication)")
+    elif progress.failed == 0:
+        # every document of the fresh index has a centroid, queries against it may run in two stages
+        await orchestrator.indexer.mark_document_tier_complete()
+        if args.alias:
+            await point_alias(args.alias, target_index, services.credential())
+    elif args.alias:
+        print(f"Not switching alias {args.alias}: {progress.failed} items failed, re-run to retry them")
+
+async def search_headers(credential) -> dict:
+    """
+    Authentication of the REST calls, the manage key if configured, otherwise the given identity.
+    """
+    key = os.getenv("INDEXER_MANAGE_KEY") or os.getenv("INDEXER_APIKEY")
+    if key:
+        return {"api-key": key}
+    token = await asyncio.to_thread(credential.get_token, "https://search.azure.com/.default")
+    return {"Authorization": f"Bearer {token.token}"}
+
+async def check_alias(alias: str, credential):
+    """
+    Makes sure the alias can be switched once the re-index is done: the service supports aliases,
+    the identity may manage them, and the name isn't taken by an index (aliases and indexes share names).
+    """
+    from ratelimit import http_request
+
+    endpoint = os.getenv("INDEXER_ENDPOINT").rstrip("/")
+    headers = await search_headers(credential)
+    response = await http_request("search", "GET", f"{endpoint}/aliases?api-version={ALIAS_API_VERSION}", headers=headers)
+    if response.status_code != 200:
+        raise SystemExit(f"Unable to manage index aliases ({response.status_code}): {response.text}")
+    response = await http_request("search", "GET", f"{endpoint}/indexes('{alias}')?api-version={ALIAS_API_VERSION}", headers=headers)
+    if response.status_code == 200:
+        raise SystemExit(f"{alias} is an index, an alias can't take its name")
+
+async def point_alias(alias: str, index_name: str, credential):
+    """
+    Points the alias to the new index, queries against the alias switch over atomically.
+    The manifest index gets a matching alias, the Indexer derives its name from the index name.
+    """
+    from indexer_schema import manifest_index_name
+    from ratelimit import http_request
+
+    endpoint = os.getenv("INDEXER_ENDPOINT").rstrip("/")
+    headers = await search_headers(credential)
+    for name, index in [(manifest_index_name(alias), manifest_index_name(index_name)), (alias, index_name)]:
+        response = await http_request("search", "PUT", f"{endpoint}/aliases('{name}')?api-version={ALIAS_API_VERSION}",
+                                      headers=headers, json={"name": name, "indexes": [index]})
+        if response.status_code not in (200, 201):
+            raise Exception(f"Unable to point alias {name} to {index} ({response.status_code}): {response.text}")
+    print(f"Alias {alias} now points to {index_name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-index SharePoint documents into a fresh index")
+    parser.add_argument("--drive", action="append", default=[], help="drive id to re-index completely")
+    parser.add_argument("--item", action="append", default=[], help="single item as driveId:itemId")
+    parser.add_argument("--from-file", action="append", default=[], help="JSON lines export with driveId and id")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--target-index", default=None, help="defaults to INDEXER_INDEX with a timestamp suffix")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file, pass the same one to resume")
+    parser.add_argument("--dry-run", action="store_true", help="only estimate pages and embedding tokens")
+    parser.add_argument("--alias", default=None, help="point this index alias to the target index when done")
+    args = parser.parse_args()
+
+    if not (args.drive or args.item or args.from_file):
+        parser.error("nothing to re-index, pass --drive, --item or --from-file")
+    for item in args.item:
+        drive_id, _, item_id = item.partition(":")
+        if not drive_id or not item_id:
+            parser.error(f"--item {item!r} is not in the driveId:itemId format")
+    if args.checkpoint is None:
+        # estimates must not mark items as done for the real run
+        args.checkpoint = "reindex-dryrun.jsonl" if args.dry_run else "reindex-checkpoint.jsonl"
+
+    asyncio.run(reindex(args))
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    setup_telemetry()
+    main()
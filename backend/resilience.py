@@ -0,0 +1,207 @@
+"""
+Bounded latency of idempotent outbound GETs (Graph item lookups), on top of the rate limited http_request.
+
+Hedging: when a GET has not returned after the recent p95 latency of its endpoint, an identical second
+request is sent and whichever answers first wins. Hedges are capped at a share of the requests, so a slow
+service doesn't get twice the load, and background work (crawler, re-index) is never hedged.
+Circuit breaking: after consecutive failures (errors, timeouts, 5xx) the endpoint fails fast for a while,
+then a single probe decides whether it closes again. Every call has a deadline, so a call returns or fails
+within HEDGE_DEADLINE_SECONDS, and within no time at all while the endpoint is known to be down.
+
+    response = await resilient_get("graph", "graph-item", url, headers=headers)
+"""
+import asyncio
+import collections
+import os
+import threading
+import time
+
+import requests
+
+from ratelimit import HTTP_CONNECT_TIMEOUT, http_request, is_background
+from telemetry import count_resilience, get_logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+class UnavailableError(Exception):
+    """
+    The endpoint is considered down (open circuit) or didn't answer within the deadline.
+    Unlike an error response, this says nothing about the requested resource.
+    """
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for open_seconds, then lets
+    one probe through (half-open): its success closes the circuit, its failure opens it again.
+    """
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok: bool | None):
+        """
+        Outcome of an allowed call, None if it was cancelled before it told anything about the endpoint.
+        """
+        with self._lock:
+            if ok is None:
+                self._probing = False
+                return
+            if ok:
+                self.failures = 0
+                if self.state != CLOSED:
+                    get_logger().info(f"Circuit of {self.name} closed")
+                    count_resilience(self.name, "circuit-closed")
+                self.state = CLOSED
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                get_logger().warning(f"Circuit of {self.name} opened after {self.failures} failures")
+                count_resilience(self.name, "circuit-opened")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+class HedgePolicy:
+    """
+    Latencies of recent requests to one endpoint and which of the recently sent requests were hedges.
+    """
+    def __init__(self, percentile: float, default_delay: float, min_delay: float, budget: float, window: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.budget = budget
+        self.min_samples = min_samples
+        self._latencies = collections.deque(maxlen=window)
+        self._sent = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.default_delay
+            ordered = sorted(self._latencies)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.percentile / 100 * len(ordered)))])
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def sent(self):
+        with self._lock:
+            self._sent.append(False)
+
+    def may_hedge(self) -> bool:
+        """
+        Whether a hedge keeps the share of hedges among the sent requests within the budget, counts it if so.
+        """
+        with self._lock:
+            if self.budget <= 0 or sum(self._sent) + 1 > self.budget * (len(self._sent) + 1):
+                return False
+            self._sent.append(True)
+            return True
+
+class Endpoint:
+    def __init__(self, name: str):
+        self.name = name
+        self.deadline = float(os.getenv("HEDGE_DEADLINE_SECONDS", "15"))
+        self.breaker = CircuitBreaker(
+            name,
+            int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            float(os.getenv("CIRCUIT_OPEN_SECONDS", "30")))
+        self.hedge = HedgePolicy(
+            float(os.getenv("HEDGE_PERCENTILE", "95")),
+            float(os.getenv("HEDGE_DEFAULT_DELAY_MS", "500")) / 1000,
+            float(os.getenv("HEDGE_MIN_DELAY_MS", "50")) / 1000,
+            float(os.getenv("HEDGE_BUDGET", "0.1")))
+
+    async def get(self, service: str, url: str, **kwargs) -> requests.Response:
+        if not self.breaker.allow():
+            count_resilience(self.name, "rejected")
+            raise UnavailableError(f"{self.name} is unavailable (circuit open)")
+        # a worker thread can't be cancelled, the socket timeout makes sure it doesn't outlive the deadline by much
+        kwargs.setdefault("timeout", (min(HTTP_CONNECT_TIMEOUT, self.deadline), self.deadline))
+        ok = None
+        try:
+            response = await asyncio.wait_for(self.__hedged(service, url, kwargs), self.deadline)
+            ok = response.status_code < 500
+            return response
+        except asyncio.TimeoutError:
+            ok = False
+            count_resilience(self.name, "deadline")
+            raise UnavailableError(f"{self.name} did not answer within {self.deadline}s")
+        except Exception:
+            ok = False
+            raise
+        finally:
+            self.breaker.record(ok)
+
+    async def __attempt(self, service: str, url: str, kwargs: dict) -> requests.Response:
+        start = time.monotonic()
+        response = await http_request(service, "GET", url, **kwargs)
+        self.hedge.observe(time.monotonic() - start)
+        return response
+
+    async def __hedged(self, service: str, url: str, kwargs: dict) -> requests.Response:
+        self.hedge.sent()
+        primary = asyncio.create_task(self.__attempt(service, url, kwargs))
+        attempts = [primary]
+        try:
+            if not is_background():
+                done, _ = await asyncio.wait(attempts, timeout=self.hedge.delay())
+                if len(done) == 0 and self.hedge.may_hedge():
+                    count_resilience(self.name, "hedged")
+                    attempts.append(asyncio.create_task(self.__attempt(service, url, kwargs)))
+
+            # the first attempt that returns a response wins, a failed one leaves the other running
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not primary:
+                            count_resilience(self.name, "hedge-won")
+                        return attempt.result()
+            return primary.result()
+        finally:
+            # the loser's worker thread finishes in the background, its result is dropped
+            for attempt in attempts:
+                attempt.cancel()
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+def endpoint(name: str) -> Endpoint:
+    """
+    The shared hedging and circuit state of an endpoint, e.g. "graph-item".
+    """
+    with _endpoints_lock:
+        if name not in _endpoints:
+            _endpoints[name] = Endpoint(name)
+        return _endpoints[name]
+
+async def resilient_get(service: str, name: str, url: str, **kwargs) -> requests.Response:
+    """
+    Hedged and circuit broken GET, only for idempotent requests. Raises UnavailableError
+    while the endpoint is down or when it doesn't answer within the deadline.
+    """
+    return await endpoint(name).get(service, url, **kwargs)
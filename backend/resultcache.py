@@ -0,0 +1,80 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from telemetry import count_cache
+
+class ResultCache:
+    """
+    Short-lived in-memory cache of permission-filtered /indexed results, keyed by user, normalized
+    query and max_results. Entries expire after ttl_seconds and are dropped as soon as one of the
+    documents they reference is re-indexed or removed. Least recently used entries are evicted
+    once the cached results grow beyond max_bytes. The cache is per process, re-indexing in other
+    processes (reindex.py) is only picked up through the TTL.
+    """
+    def __init__(self, ttl_seconds: float, max_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._by_document = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(user_id: str, query: str, max_results: int) -> tuple:
+        return (user_id, re.sub(r"\s+", " ", query).strip().casefold(), max_results)
+
+    def get(self, key: tuple) -> list[dict] | None:
+        if self.ttl_seconds <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] < time.monotonic():
+                self.__remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        count_cache("indexed-results", entry is not None)
+        return entry["results"] if entry is not None else None
+
+    def put(self, key: tuple, results: list[dict]):
+        if self.ttl_seconds <= 0:
+            return
+        size = len(json.dumps(results, default=str))
+        if size > self.max_bytes:
+            return
+        documents = {r["documentId"] for r in results}
+        with self._lock:
+            self.__remove(key)
+            self._entries[key] = {
+                "expires": time.monotonic() + self.ttl_seconds,
+                "size": size,
+                "results": results,
+                "documents": documents }
+            self.size += size
+            for document_id in documents:
+                self._by_document.setdefault(document_id, set()).add(key)
+            while self.size > self.max_bytes:
+                self.__remove(next(iter(self._entries)))
+
+    def invalidate_document(self, document_id: str):
+        """
+        Drops all results referencing the document, called whenever it is (re-)indexed or removed.
+        """
+        with self._lock:
+            for key in list(self._by_document.get(document_id, ())):
+                self.__remove(key)
+
+    def __remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry["size"]
+        for document_id in entry["documents"]:
+            keys = self._by_document.get(document_id)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._by_document[document_id]
@@ -1,14 +1,15 @@
 from msal import ConfidentialClientApplication
-import requests
-from auth import CallContext, get_token
+from auth import CallContext, get_token, graph_url
+from ratelimit import http_request
+from telemetry import stage
 
 class SharePointIndex:
     def __init__(self, app: ConfidentialClientApplication):
         self.app = app
 
-    def search(self, query: str, ctx: CallContext, max_results: int = 3) -> [dict]:
-        token = get_token(self.app, ctx)
-        url = f"https://graph.microsoft.com/v1.0/search/query"
+    async def search(self, query: str, ctx: CallContext, max_results: int = 3) -> [dict]:
+        token = await get_token(self.app, ctx)
+        url = graph_url("/search/query")
         headers = {"Authorization": "Bearer " + token}
         body = {
             "requests": [
@@ -32,7 +33,8 @@ class SharePointIndex:
                 }
             ]
         }
-        response = requests.post(url, headers=headers, json=body)
+        with stage("graph-search", max_results=max_results):
+            response = await http_request("graph", "POST", url, headers=headers, json=body)
         if response.status_code >= 200 and response.status_code < 300:
             payload = response.json()
 
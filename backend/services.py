@@ -0,0 +1,176 @@
+"""
+Process-wide service clients. Every client is built on first use and then shared,
+so importing the app stays cheap and a worker only pays for what it actually calls.
+Async clients (search, blob storage, OpenAI) share one async credential and the Azure SDK
+clients one pooled aiohttp session, they are created on the event loop and closed by close().
+"""
+
+import os
+import threading
+
+from msal import ConfidentialClientApplication
+
+_instances = {}
+_lock = threading.RLock()
+
+def _get(name: str, factory):
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+    return instance
+
+def override(name: str, instance):
+    """
+    Replaces a shared client before its first use, e.g. the load-test harness (benchmarks/loadtest.py)
+    points the app at local stand-ins.
+    """
+    with _lock:
+        _instances[name] = instance
+
+def credential():
+    """
+    DefaultAzureCredential for the remaining blocking calls (index management at startup and in the CLIs).
+    """
+    def create():
+        from azure.identity import DefaultAzureCredential
+        return DefaultAzureCredential()
+    return _get("credential", create)
+
+def async_credential():
+    """
+    The single async DefaultAzureCredential of the process, so all async clients share one token cache.
+    """
+    def create():
+        from azure.identity.aio import DefaultAzureCredential
+        return DefaultAzureCredential()
+    return _get("async_credential", create)
+
+def http_session():
+    def create():
+        import aiohttp
+        # one connection pool for all Azure SDK clients, sized for the rate limiter's concurrency
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=int(os.getenv("HTTP_POOL_SIZE", "100"))))
+    return _get("http_session", create)
+
+def transport():
+    """
+    A transport for one Azure SDK client on top of the shared session. Closing the client leaves the session open.
+    """
+    from azure.core.pipeline.transport import AioHttpTransport
+    return AioHttpTransport(session=http_session(), session_owner=False)
+
+async def close():
+    """
+    Closes the async clients, the shared credential and the HTTP session, on shutdown.
+    """
+    with _lock:
+        instances = dict(_instances)
+        for name in ("orchestrator", "indexer", "storage", "embeddings", "chat_completions", "async_credential", "http_session"):
+            _instances.pop(name, None)
+    for name in ("indexer", "storage", "embeddings", "chat_completions", "async_credential", "http_session"):
+        if name in instances:
+            await instances[name].close()
+
+def msal_app() -> ConfidentialClientApplication:
+    def create():
+        tenant_id = os.getenv("TENANT_ID")
+        return ConfidentialClientApplication(
+            os.getenv("CLIENT_ID"),
+            authority=f"https://login.microsoftonline.com/{tenant_id}",
+            client_credential=os.getenv("CLIENT_SECRET"))
+    return _get("msal_app", create)
+
+def storage():
+    def create():
+        from filestorage import FileStorage
+        # a connection string (account key, Azurite) takes precedence over the managed identity
+        return FileStorage(
+            storage_connection_string=os.getenv("BLOB_CONNECTION_STRING") or None,
+            storage_account_name=os.getenv("BLOB_STORAGE_ACCOUNT_NAME"),
+            container_name=os.getenv("BLOB_CONTAINER_NAME"),
+            credential=async_credential(),
+            transport=transport())
+    return _get("storage", create)
+
+def notification_hub():
+    def create():
+        from notificationhub import NotificationHub
+        return NotificationHub(os.getenv("WEBPUBSUB_CONNECTION_STRING"), 'hub')
+    return _get("notification_hub", create)
+
+def document_cache():
+    def create():
+        import tempfile
+        from documentcache import DocumentCache
+        return DocumentCache(
+            os.getenv("DOCUMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sharepoint-rag-documents")),
+            int(os.getenv("DOCUMENT_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+    return _get("document_cache", create)
+
+def memory_budget():
+    def create():
+        from memorybudget import MemoryBudget
+        return MemoryBudget(int(os.getenv("INGESTION_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024)
+    return _get("memory_budget", create)
+
+def result_cache():
+    def create():
+        from resultcache import ResultCache
+        return ResultCache(
+            float(os.getenv("INDEXED_CACHE_TTL_SECONDS", "60")),
+            int(os.getenv("INDEXED_CACHE_MAX_MB", "32")) * 1024 * 1024)
+    return _get("result_cache", create)
+
+def deduplicator():
+    def create():
+        from dedup import FragmentDeduplicator
+        return FragmentDeduplicator.from_env()
+    return _get("deduplicator", create)
+
+def embeddings():
+    def create():
+        from embeddings import Embeddings
+        from indexer_schema import VectorConfig
+        return Embeddings(
+            os.getenv("OPENAI_ENDPOINT"),
+            os.getenv("OPENAI_EMBEDDINGS_MODEL"),
+            async_credential(),
+            VectorConfig.from_env().dimensions)
+    return _get("embeddings", create)
+
+def chat_completions():
+    def create():
+        from completions import ChatCompletions
+        return ChatCompletions(os.getenv("OPENAI_ENDPOINT"),
+            os.getenv("OPENAI_COMPLETIONS_MODEL_TEXT"),
+            os.getenv("OPENAI_COMPLETIONS_MODEL_VISUAL"),
+            async_credential())
+    return _get("chat_completions", create)
+
+def indexer():
+    def create():
+        from indexer import Indexer
+        api_key = os.getenv("INDEXER_APIKEY")
+        if api_key:
+            from azure.core.credentials import AzureKeyCredential
+            search_credential = AzureKeyCredential(api_key)
+        else:
+            search_credential = async_credential()
+        return Indexer(
+            os.getenv("INDEXER_ENDPOINT"),
+            os.getenv("INDEXER_INDEX"),
+            embeddings(),
+            search_credential,
+            transport(),
+            top_documents=int(os.getenv("RETRIEVAL_TOP_DOCUMENTS", "0")))
+    return _get("indexer", create)
+
+def orchestrator():
+    def create():
+        from orchestration import SharePointRagOrchestrator
+        return SharePointRagOrchestrator(msal_app())
+    return _get("orchestrator", create)
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import numpy as np
+import cv2
+
+class SnapshotEncoder:
+    """
+    Encodes rendered pages into the stored snapshot and its thumbnail.
+    png      - lossless, the largest and slowest option
+    webp     - lossy with the given quality, the default
+    jpeg     - lossy with the given quality
+    lineart  - grayscale PNG reduced to a few levels, compact for technical drawings
+    The full image goes to the visual model, the thumbnail to the result grid.
+
+    Snapshots are content addressed, so repeated pages (title blocks, standard drawings, template
+    pages) are stored once across all documents and re-indexing finds them already uploaded.
+    exact       - the name derives from the rendered pixels, only identical renderings share a blob
+    perceptual  - the name derives from a difference hash (dHash) of phash_size x phash_size bits,
+                  renderings that look the same at that resolution share a blob
+    """
+    EXTENSIONS = { "png": ".png", "webp": ".webp", "jpeg": ".jpg", "lineart": ".png" }
+    CONTENT_TYPES = { ".png": "image/png", ".webp": "image/webp", ".jpg": "image/jpeg" }
+
+    def __init__(self, format: str = "webp", quality: int = 80, thumbnail_width: int = 320, lineart_levels: int = 8,
+                 dedup: str = "exact", phash_size: int = 16):
+        if format not in SnapshotEncoder.EXTENSIONS:
+            raise ValueError(f"Unsupported snapshot format: {format}")
+        if dedup not in ("exact", "perceptual"):
+            raise ValueError(f"Unsupported snapshot deduplication: {dedup}")
+        self.format = format
+        self.quality = quality
+        self.thumbnail_width = thumbnail_width
+        self.lineart_levels = lineart_levels
+        self.dedup = dedup
+        self.phash_size = phash_size
+
+    @staticmethod
+    def from_env():
+        return SnapshotEncoder(
+            format=os.getenv("SNAPSHOT_FORMAT", "webp").lower(),
+            quality=int(os.getenv("SNAPSHOT_QUALITY", "80")),
+            thumbnail_width=int(os.getenv("SNAPSHOT_THUMBNAIL_WIDTH", "320")),
+            lineart_levels=int(os.getenv("SNAPSHOT_LINEART_LEVELS", "8")),
+            dedup=os.getenv("SNAPSHOT_DEDUP", "exact").lower(),
+            phash_size=int(os.getenv("SNAPSHOT_PHASH_SIZE", "16")))
+
+    @property
+    def extension(self) -> str:
+        return SnapshotEncoder.EXTENSIONS[self.format]
+
+    @property
+    def content_type(self) -> str:
+        return SnapshotEncoder.CONTENT_TYPES[self.extension]
+
+    def name(self, img) -> str:
+        """
+        Content-addressed blob name of a page rendering. The encoder settings are part of the
+        key, a different format or quality never reuses blobs encoded with the old settings.
+        """
+        if self.dedup == "perceptual":
+            content = SnapshotEncoder.dhash(img, self.phash_size)
+        else:
+            content = np.ascontiguousarray(img).tobytes() + repr(img.shape).encode()
+        settings = f"{self.format}:{self.quality}:{self.thumbnail_width}:{self.lineart_levels}".encode()
+        return f"snap-{hashlib.sha256(settings + b'|' + content).hexdigest()[:40]}{self.extension}"
+
+    @staticmethod
+    def dhash(img, size: int) -> bytes:
+        """
+        Difference hash: the grayscale image shrunk to (size + 1) x size, one bit per horizontal neighbour comparison.
+        """
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+        small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+        return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+    def encode(self, img) -> bytes:
+        """
+        Encodes an RGB page rendering (as produced by PdfProcessor.pix_to_image).
+        """
+        if self.format == "lineart":
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+            step = 256 // self.lineart_levels
+            # in uint16, for level counts not dividing 256 the top level would wrap around in uint8 (white turning dark)
+            reduced = np.minimum(gray.astype(np.uint16) // step * step + step // 2, 255).astype(np.uint8)
+            return cv2.imencode(".png", reduced, [cv2.IMWRITE_PNG_COMPRESSION, 9])[1].tobytes()
+
+        # fitz renders RGB while OpenCV encodes BGR
+        bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        if self.format == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        elif self.format == "jpeg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, 6]
+        return cv2.imencode(self.extension, bgr, params)[1].tobytes()
+
+    def encode_thumbnail(self, img) -> bytes:
+        height, width = img.shape[:2]
+        if width > self.thumbnail_width:
+            size = (self.thumbnail_width, max(1, int(height * self.thumbnail_width / width)))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        return self.encode(img)
@@ -1,12 +1,64 @@
 import logging
 import os
+import time
+from contextlib import contextmanager
 
 from azure.core.settings import settings
 from azure.core.tracing.ext.opentelemetry_span import OpenTelemetrySpan
 from azure.monitor.opentelemetry import configure_azure_monitor
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.prometheus import PrometheusMetricReader
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.view import ExplicitBucketHistogramAggregation, View
+from opentelemetry.sdk.resources import Resource
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 SERVICE_NAME = "rag-backend"
 
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# instruments are created against the proxy meter and get bound once setup_telemetry installs the provider
+_meter = metrics.get_meter(SERVICE_NAME)
+_tracer = trace.get_tracer(SERVICE_NAME)
+
+_stage_duration = _meter.create_histogram(
+    "rag.stage.duration",
+    unit="s",
+    description="Duration of a single pipeline stage (token, search, download, embedding, ...)")
+
+_cache_lookups = _meter.create_counter(
+    "rag.cache.lookups",
+    description="Cache lookups by cache name and result (hit/miss)")
+
+_bytes = _meter.create_counter(
+    "rag.bytes",
+    unit="By",
+    description="Bytes moved by a pipeline stage")
+
+_tokens = _meter.create_counter(
+    "rag.tokens",
+    description="Model tokens consumed, by kind (embedding, prompt, completion)")
+
+_throttled = _meter.create_counter(
+    "rag.throttled",
+    description="Throttled responses (429/503) of outbound calls, by service")
+
+_deduplicated = _meter.create_counter(
+    "rag.deduplicated",
+    description="Fragments, boilerplate lines and embedding tokens removed before indexing, by kind")
+
+_resilience = _meter.create_counter(
+    "rag.resilience",
+    description="Hedged requests and circuit breaker events of outbound calls, by endpoint and event")
+
+# stage durations in seconds, the SDK default boundaries (0, 5, 10, 25, ...) would put almost every stage in one bucket
+STAGE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+def _views() -> list[View]:
+    return [View(
+        instrument_name="rag.stage.duration",
+        aggregation=ExplicitBucketHistogramAggregation(boundaries=STAGE_BUCKETS))]
+
 def get_logger():
     return logging.getLogger(SERVICE_NAME)
 
@@ -14,14 +66,67 @@ def setup_telemetry():
 
     application_insights_connection_string = os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
+    # /metrics is served from this reader regardless of Application Insights being configured
+    prometheus_reader = PrometheusMetricReader()
+
     if application_insights_connection_string:
 
         settings.tracing_implementation = OpenTelemetrySpan
         configure_azure_monitor(
             connection_string=application_insights_connection_string,
             logger_name=SERVICE_NAME,
+            metric_readers=[prometheus_reader],
+            views=_views(),
         )
+    else:
+        metrics.set_meter_provider(MeterProvider(
+            resource=Resource.create({"service.name": SERVICE_NAME}),
+            metric_readers=[prometheus_reader],
+            views=_views()))
 
 
     log = logging.getLogger(SERVICE_NAME)
     log.setLevel(logging.INFO)
+
+@contextmanager
+def stage(name: str, **attributes):
+    """
+    Wraps a pipeline stage into a span and records its duration in the stage histogram.
+    Attributes only go to the span to keep the metric cardinality low.
+    """
+    outcome = "ok"
+    start = time.perf_counter()
+    with _tracer.start_as_current_span(name, attributes=attributes) as span:
+        try:
+            yield span
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            _stage_duration.record(time.perf_counter() - start, {"stage": name, "outcome": outcome})
+
+def count_cache(cache: str, hit: bool):
+    _cache_lookups.add(1, {"cache": cache, "result": "hit" if hit else "miss"})
+
+def count_bytes(stage: str, amount: int):
+    _bytes.add(amount, {"stage": stage})
+
+def count_tokens(kind: str, amount: int, model: str = None):
+    if amount:
+        _tokens.add(amount, {"kind": kind, "model": model or "unknown"})
+
+def count_throttled(service: str, status_code: int):
+    _throttled.add(1, {"service": service, "status": str(status_code)})
+
+def count_deduplicated(kind: str, amount: int):
+    if amount:
+        _deduplicated.add(amount, {"kind": kind})
+
+def count_resilience(endpoint: str, event: str):
+    _resilience.add(1, {"endpoint": endpoint, "event": event})
+
+def render_metrics() -> bytes:
+    """
+    Renders all instruments in the Prometheus text exposition format.
+    """
+    return generate_latest()
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# the backend modules import each other as top-level modules, like when running from backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def encoding():
+    """
+    The cl100k_base encoding of the token budgets, tiktoken downloads it on first use.
+    """
+    tiktoken = pytest.importorskip("tiktoken")
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        pytest.skip(f"cl100k_base encoding not available: {e}")
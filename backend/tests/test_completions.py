@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+
+from completions import IMAGE_TOKEN_COST, ChatCompletions
+
+class RecordingCompletions(ChatCompletions):
+    """
+    The packing of generate_grounded without a model: the request is recorded, the answer is fixed.
+    """
+    def __init__(self):
+        self.engine_text = "text-model"
+        self.engine_visual = "visual-model"
+        self.requests = []
+
+    async def _ChatCompletions__create(self, **kwargs):
+        self.requests.append(kwargs)
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(content="answer [1]"))])
+
+    @property
+    def packed(self) -> list[dict]:
+        # system prompt, sources, question
+        return self.requests[-1]["messages"][1]["content"]
+
+def fragment(n: int, words: int = 20) -> dict:
+    return {"id": f"doc-{n}", "title": f"Drawing {n}", "uri": f"https://example.org/{n}", "content": " ".join(["valve"] * words)}
+
+def header_tokens(encoding, n: int) -> int:
+    return len(encoding.encode(f"[{n}] Drawing {n}\n"))
+
+def test_fragments_are_numbered_in_rank_order(encoding):
+    completions = RecordingCompletions()
+    fragments = [fragment(1), fragment(2), fragment(3)]
+
+    result = asyncio.run(completions.generate_grounded("Which valves?", fragments, max_context_tokens=6000))
+
+    assert [c["n"] for c in result["citations"]] == [1, 2, 3]
+    assert [c["id"] for c in result["citations"]] == ["doc-1", "doc-2", "doc-3"]
+    assert [c["text"].split("\n")[0] for c in completions.packed] == ["[1] Drawing 1", "[2] Drawing 2", "[3] Drawing 3"]
+    assert not result["truncated"]
+    assert completions.requests[-1]["model"] == "text-model"
+
+def test_the_last_fragment_is_trimmed_to_the_budget(encoding):
+    completions = RecordingCompletions()
+    fragments = [fragment(1), fragment(2), fragment(3)]
+    first = header_tokens(encoding, 1) + len(encoding.encode(fragments[0]["content"]))
+    budget = first + header_tokens(encoding, 2) + 5
+
+    result = asyncio.run(completions.generate_grounded("Which valves?", fragments, max_context_tokens=budget))
+
+    assert result["truncated"]
+    assert [c["id"] for c in result["citations"]] == ["doc-1", "doc-2"]
+    assert sum(len(encoding.encode(c["text"])) for c in completions.packed) <= budget
+    assert len(encoding.encode(completions.packed[1]["text"].split("\n", 1)[1])) == 5
+
+def test_a_fragment_without_room_for_its_header_is_left_out(encoding):
+    completions = RecordingCompletions()
+    fragments = [fragment(1), fragment(2)]
+    budget = header_tokens(encoding, 1) + len(encoding.encode(fragments[0]["content"]))
+
+    result = asyncio.run(completions.generate_grounded("Which valves?", fragments, max_context_tokens=budget))
+
+    assert result["truncated"]
+    assert [c["id"] for c in result["citations"]] == ["doc-1"]
+
+def test_images_are_included_while_the_budget_pays_for_them(encoding):
+    completions = RecordingCompletions()
+    fragments = [fragment(1), fragment(2)]
+    image_urls = {"doc-1": "https://example.org/snap-1.png", "doc-2": "https://example.org/snap-2.png"}
+    text = [header_tokens(encoding, n) + len(encoding.encode(f["content"])) for n, f in enumerate(fragments, 1)]
+    # room for both texts and one image only
+    budget = sum(text) + IMAGE_TOKEN_COST + 10
+
+    result = asyncio.run(completions.generate_grounded("Which valves?", fragments, image_urls, max_context_tokens=budget))
+
+    assert not result["truncated"]
+    assert [c["type"] for c in completions.packed] == ["text", "image_url", "text"]
+    assert completions.packed[1]["image_url"]["url"] == image_urls["doc-1"]
+    assert completions.requests[-1]["model"] == "visual-model"
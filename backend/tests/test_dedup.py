@@ -0,0 +1,76 @@
+import zlib
+
+import numpy as np
+
+from dedup import _MAX_HASH, _PRIME, FragmentDeduplicator
+from model import DocumentFragment
+
+WORDS = ("pump valve flange gasket bolt pipe elbow tee reducer nozzle weld seam drain vent header "
+         "manifold sleeve anchor support clamp").split()
+
+def text(seed: int, words: int = 120) -> str:
+    generator = np.random.default_rng(seed)
+    return " ".join(generator.choice(WORDS, size=words)) + f" sheet {seed}"
+
+def shingles(deduplicator: FragmentDeduplicator, value: str) -> set[str]:
+    words = value.casefold().split()
+    return {" ".join(words[i:i + deduplicator.shingle_size]) for i in range(len(words) - deduplicator.shingle_size + 1)}
+
+def test_signature_is_the_exact_modular_hash():
+    deduplicator = FragmentDeduplicator()
+    value = text(1)
+    hashes = {zlib.crc32(s.encode("utf-8")) for s in shingles(deduplicator, value)}
+    expected = [min(((int(a) * h + int(b)) % int(_PRIME)) & int(_MAX_HASH) for h in hashes)
+                for a, b in zip(deduplicator._a, deduplicator._b)]
+    assert deduplicator.signature(value).tolist() == expected
+
+def test_signature_estimates_the_jaccard_similarity():
+    deduplicator = FragmentDeduplicator(permutations=256, bands=16)
+    words = text(2, words=400).split()
+    # replace every 25th word: a similarity well below the default threshold
+    changed = " ".join("revised" if i % 25 == 0 else w for i, w in enumerate(words))
+    a, b = shingles(deduplicator, " ".join(words)), shingles(deduplicator, changed)
+    jaccard = len(a & b) / len(a | b)
+
+    estimate = np.mean(deduplicator.signature(" ".join(words)) == deduplicator.signature(changed))
+
+    assert 0.5 < jaccard < 0.9
+    assert abs(estimate - jaccard) < 0.1
+
+def test_boilerplate_lines_are_stripped(encoding):
+    deduplicator = FragmentDeduplicator()
+    fragments = [DocumentFragment(text=f"ACME Engineering - confidential\n{text(n)}\nPage {n} of 4", snapshot=None) for n in range(4)]
+
+    remaining, report = deduplicator.deduplicate(fragments)
+
+    assert len(remaining) == 4
+    assert report.stripped_lines == 8
+    assert all(f.text == text(n) for n, f in enumerate(remaining))
+    assert report.saved_tokens > 0
+
+def test_near_duplicates_are_dropped_and_distinct_fragments_kept(encoding):
+    deduplicator = FragmentDeduplicator()
+    revision = text(1) + " approved"
+    fragments = [DocumentFragment(text=t, snapshot=None) for t in (text(1), text(2), revision, text(3))]
+
+    remaining, report = deduplicator.deduplicate(fragments)
+
+    assert [f.text for f in remaining] == [text(1), text(2), text(3)]
+    assert report.removed_fragments == 1
+
+def test_near_duplicates_with_different_snapshots_are_kept(encoding):
+    deduplicator = FragmentDeduplicator()
+    fragments = [DocumentFragment(text=text(1), snapshot="snap-a.png"), DocumentFragment(text=text(1), snapshot="snap-b.png")]
+
+    remaining, _ = deduplicator.deduplicate(fragments)
+
+    assert remaining == fragments
+
+def test_disabled_deduplication_keeps_everything(encoding):
+    deduplicator = FragmentDeduplicator(enabled=False)
+    fragments = [DocumentFragment(text=text(1), snapshot=None)] * 3
+
+    remaining, report = deduplicator.deduplicate(fragments)
+
+    assert remaining == fragments
+    assert report.saved_tokens == 0
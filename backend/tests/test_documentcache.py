@@ -0,0 +1,88 @@
+import os
+import time
+
+from documentcache import DocumentCache
+from model import DocumentFragment
+
+def download(cache: DocumentCache, item_id: str, content_tag: str, size: int, drive_id: str = "drive") -> str:
+    temp_path = cache.reserve(drive_id, item_id, content_tag)
+    with open(temp_path, "wb") as f:
+        f.write(b"x" * size)
+    return cache.commit(temp_path, drive_id, item_id, content_tag)
+
+def age(path: str, seconds: float):
+    # the mtime is the LRU clock, make the order explicit instead of relying on its resolution
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+def test_entries_are_keyed_by_content_tag(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=1 << 20)
+    path = download(cache, "item", "tag-1", 10)
+
+    assert cache.get("drive", "item", "tag-1") == path
+    assert cache.get("drive", "item", "tag-2") is None
+    assert cache.get("other-drive", "item", "tag-1") is None
+    assert cache.get("drive", "other-item", "tag-1") is None
+
+def test_committing_a_new_version_drops_the_old_ones(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=1 << 20)
+    download(cache, "item", "tag-1", 10)
+    cache.put_fragments("drive", "item", "tag-1", [DocumentFragment(text="old", snapshot=None)])
+    download(cache, "other-item", "tag-1", 10)
+
+    path = download(cache, "item", "tag-2", 10)
+
+    assert cache.get("drive", "item", "tag-2") == path
+    assert cache.get("drive", "item", "tag-1") is None
+    assert cache.get_fragments("drive", "item", "tag-1") is None
+    assert cache.get("drive", "other-item", "tag-1") is not None
+
+def test_least_recently_used_entries_are_evicted_beyond_the_size_budget(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=250)
+    first = download(cache, "first", "tag", 100)
+    second = download(cache, "second", "tag", 100)
+    age(first, 20)
+    age(second, 30)
+    # a hit makes the first the most recently used again
+    assert cache.get("drive", "first", "tag") == first
+
+    download(cache, "third", "tag", 100)
+
+    assert cache.get("drive", "second", "tag") is None
+    assert cache.get("drive", "first", "tag") == first
+    assert cache.get("drive", "third", "tag") is not None
+
+def test_the_committed_entry_is_kept_even_if_it_alone_exceeds_the_budget(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=50)
+    download(cache, "small", "tag", 10)
+
+    path = download(cache, "large", "tag", 100)
+
+    assert cache.get("drive", "large", "tag") == path
+    assert cache.get("drive", "small", "tag") is None
+
+def test_fragments_round_trip(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=1 << 20)
+    fragments = [
+        DocumentFragment(text="Pump house, section A-A\nScale 1:50", snapshot="snap-0123.png"),
+        DocumentFragment(text="Notes without a drawing – ümlauts and “quotes”", snapshot=None)
+    ]
+    assert cache.get_fragments("drive", "item", "tag") is None
+
+    cache.put_fragments("drive", "item", "tag", fragments)
+
+    assert cache.get_fragments("drive", "item", "tag") == fragments
+    assert cache.get_fragments("drive", "item", "other-tag") is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+def test_dropped_fragments_are_extracted_again(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=1 << 20)
+    path = download(cache, "item", "tag", 10)
+    cache.put_fragments("drive", "item", "tag", [DocumentFragment(text="page", snapshot="snap-0123.png")])
+
+    cache.drop_fragments("drive", "item", "tag")
+
+    assert cache.get_fragments("drive", "item", "tag") is None
+    # the original is still there to process again
+    assert cache.get("drive", "item", "tag") == path
+    cache.drop_fragments("drive", "item", "tag")
@@ -0,0 +1,23 @@
+"""
+Peak RSS of the ingestion path (budget, streamed download into the cache, page-by-page processing)
+for a short and a long document. Takes a while, opt in with INGESTION_MEMORY_TEST=true.
+"""
+import os
+
+import pytest
+
+pytestmark = pytest.mark.skipif(os.getenv("INGESTION_MEMORY_TEST", "false").lower() != "true",
+                                reason="set INGESTION_MEMORY_TEST=true to measure the ingestion memory")
+
+def test_peak_rss_does_not_grow_with_the_page_count():
+    pytest.importorskip("fitz")
+    pytest.importorskip("cv2")
+    from benchmarks.ingestion_memory import growth_mb, run
+
+    results = run([int(p) for p in os.getenv("INGESTION_MEMORY_PAGES", "20,200").split(",")])
+
+    assert all(r["fragments"] == r["pages"] for r in results)
+    assert growth_mb(results) <= float(os.getenv("INGESTION_MEMORY_MAX_GROWTH_MB", "50"))
+    max_rss_mb = os.getenv("INGESTION_MEMORY_MAX_RSS_MB")
+    if max_rss_mb:
+        assert max(r["peak_kb"] for r in results) / 1024 <= float(max_rss_mb)
@@ -0,0 +1,104 @@
+import asyncio
+
+from memorybudget import DOCX_EXPANSION, PDF_PAGE_BYTES, MemoryBudget
+
+async def hold(budget: MemoryBudget, amount: int, admitted: list, name: str, release: asyncio.Event):
+    async with budget.reserve(amount):
+        admitted.append(name)
+        await release.wait()
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_reservations_beyond_the_budget_wait():
+    async def scenario():
+        budget = MemoryBudget(100)
+        admitted = []
+        releases = {name: asyncio.Event() for name in ("a", "b", "c")}
+        tasks = [asyncio.create_task(hold(budget, 60, admitted, name, releases[name])) for name in ("a", "b", "c")]
+        await settle()
+        assert admitted == ["a"]
+        assert budget.used == 60
+
+        releases["a"].set()
+        await settle()
+        assert admitted == ["a", "b"]
+        assert budget.used == 60
+
+        releases["b"].set()
+        releases["c"].set()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        assert admitted == ["a", "b", "c"]
+        assert budget.used == 0
+
+    asyncio.run(scenario())
+
+def test_reservations_within_the_budget_run_concurrently():
+    async def scenario():
+        budget = MemoryBudget(100)
+        admitted = []
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(budget, 30, admitted, str(n), release)) for n in range(4)]
+        await settle()
+        assert len(admitted) == 3
+        assert budget.used == 90
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        assert budget.used == 0
+
+    asyncio.run(scenario())
+
+def test_a_reservation_above_the_budget_runs_alone():
+    async def scenario():
+        budget = MemoryBudget(100)
+        admitted = []
+        release_small, release_large = asyncio.Event(), asyncio.Event()
+        small = asyncio.create_task(hold(budget, 10, admitted, "small", release_small))
+        await settle()
+        large = asyncio.create_task(hold(budget, 1000, admitted, "large", release_large))
+        await settle()
+        assert admitted == ["small"]
+
+        release_small.set()
+        await settle()
+        assert admitted == ["small", "large"]
+        assert budget.used == 100
+
+        release_large.set()
+        await asyncio.wait_for(asyncio.gather(small, large), 5)
+        assert budget.used == 0
+
+    asyncio.run(scenario())
+
+def test_cancellation_releases_the_reservation():
+    async def scenario():
+        budget = MemoryBudget(100)
+        admitted = []
+        never = asyncio.Event()
+        holder = asyncio.create_task(hold(budget, 80, admitted, "holder", never))
+        await settle()
+        waiting = asyncio.create_task(hold(budget, 80, admitted, "waiting", asyncio.Event()))
+        await settle()
+
+        # cancelled while waiting, nothing to give back
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert budget.used == 80
+
+        # cancelled while holding, the reservation goes back to the budget
+        holder.cancel()
+        await asyncio.gather(holder, return_exceptions=True)
+        assert budget.used == 0
+
+        release = asyncio.Event()
+        release.set()
+        await asyncio.wait_for(hold(budget, 100, admitted, "after", release), 5)
+        assert admitted == ["holder", "after"]
+
+    asyncio.run(scenario())
+
+def test_estimates():
+    assert MemoryBudget.estimate("drawing.PDF", 500 * 1024 * 1024) == PDF_PAGE_BYTES
+    assert MemoryBudget.estimate("spec.docx", 1024) == 1024 * DOCX_EXPANSION
+    assert MemoryBudget.estimate("spec.docx", None) == 0
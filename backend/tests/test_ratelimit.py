@@ -0,0 +1,99 @@
+import asyncio
+
+from ratelimit import BACKGROUND, INTERACTIVE, ServiceLimiter, background
+
+def saturated_limiter(max_concurrency: int = 1, background_share: float = 0.5) -> ServiceLimiter:
+    # plenty of tokens, only the concurrency limit admits
+    return ServiceLimiter("test", rate=1000, burst=1000, max_concurrency=max_concurrency, background_share=background_share)
+
+def test_interactive_calls_are_admitted_before_queued_background_calls():
+    async def scenario():
+        limiter = saturated_limiter()
+        order = []
+        release = asyncio.Event()
+
+        async def holder():
+            async with limiter.slot_async():
+                await release.wait()
+
+        async def call(name: str, is_background: bool):
+            if is_background:
+                with background():
+                    async with limiter.slot_async():
+                        order.append(name)
+            else:
+                async with limiter.slot_async():
+                    order.append(name)
+
+        held = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(call("background-1", True)), asyncio.create_task(call("background-2", True))]
+        await asyncio.sleep(0)
+        waiting.append(asyncio.create_task(call("interactive-1", False)))
+        waiting.append(asyncio.create_task(call("interactive-2", False)))
+        await asyncio.sleep(0)
+        assert order == []
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(held, *waiting), 5)
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive-1", "interactive-2", "background-1", "background-2"]
+
+def test_background_calls_only_use_their_share_of_the_concurrency():
+    async def scenario():
+        limiter = saturated_limiter(max_concurrency=4, background_share=0.5)
+        peak = 0
+        release = asyncio.Event()
+
+        async def call():
+            nonlocal peak
+            with background():
+                async with limiter.slot_async():
+                    peak = max(peak, limiter.inflight[BACKGROUND])
+                    await release.wait()
+
+        calls = [asyncio.create_task(call()) for _ in range(6)]
+        await asyncio.sleep(0.05)
+        admitted = limiter.inflight[BACKGROUND]
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*calls), 5)
+        return admitted, peak
+
+    admitted, peak = asyncio.run(scenario())
+    assert admitted == 2
+    assert peak == 2
+
+def test_throttling_halves_the_limit_and_success_grows_it_additively():
+    limiter = saturated_limiter(max_concurrency=16)
+    limiter.feedback(429)
+    assert limiter.limit == 8
+    # a burst of 429s within a second is one congestion signal
+    limiter.feedback(429)
+    assert limiter.limit == 8
+
+    limiter.feedback(200)
+    assert limiter.limit == 8 + 1 / 8
+
+def test_retry_after_pauses_the_service():
+    async def scenario():
+        limiter = saturated_limiter(max_concurrency=4)
+        limiter.feedback(429, retry_after_seconds=0.2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        async with limiter.slot_async():
+            return loop.time() - start
+
+    assert asyncio.run(scenario()) >= 0.15
+
+def test_slots_are_released_when_the_call_fails():
+    async def scenario():
+        limiter = saturated_limiter()
+        try:
+            async with limiter.slot_async():
+                raise RuntimeError("failed call")
+        except RuntimeError:
+            pass
+        return limiter.inflight[INTERACTIVE]
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, Endpoint, UnavailableError
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    return clock
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, open_seconds=30)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == CLOSED
+
+    # a success resets the consecutive failures
+    breaker.record(True)
+    for _ in range(2):
+        breaker.record(False)
+    assert breaker.state == CLOSED
+
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+
+def test_half_open_breaker_lets_one_probe_through(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=30)
+    breaker.record(False)
+    clock.now += 30
+
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    # a cancelled probe says nothing about the endpoint, the next call probes
+    breaker.record(None)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    assert breaker.allow() and breaker.allow()
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=30)
+    breaker.record(False)
+    clock.now += 30
+    assert breaker.allow()
+
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+def test_endpoint_fails_fast_while_the_circuit_is_open(monkeypatch):
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "2")
+    monkeypatch.setenv("HEDGE_DEADLINE_SECONDS", "0.05")
+    calls = []
+
+    async def hanging_request(service, method, url, **kwargs):
+        calls.append(url)
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(resilience, "http_request", hanging_request)
+
+    async def scenario():
+        endpoint = Endpoint("test")
+        endpoint.hedge.budget = 0
+        for _ in range(2):
+            with pytest.raises(UnavailableError):
+                await endpoint.get("test", "https://example.org/item")
+        with pytest.raises(UnavailableError):
+            await endpoint.get("test", "https://example.org/item")
+        return endpoint
+
+    endpoint = asyncio.run(scenario())
+    assert endpoint.breaker.state == OPEN
+    # the third call was rejected without a request
+    assert len(calls) == 2
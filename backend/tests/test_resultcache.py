@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+import resultcache
+from resultcache import ResultCache
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(resultcache.time, "monotonic", clock)
+    return clock
+
+def results(*document_ids: str, padding: int = 0) -> list[dict]:
+    return [{"id": f"{d}-0", "documentId": d, "content": "x" * padding} for d in document_ids]
+
+def size(entry: list[dict]) -> int:
+    return len(json.dumps(entry, default=str))
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResultCache(ttl_seconds=60, max_bytes=1 << 20)
+    key = ResultCache.key("user", "pump", 3)
+    cache.put(key, results("doc-a"))
+
+    clock.now += 60
+    assert cache.get(key) == results("doc-a")
+    clock.now += 1
+    assert cache.get(key) is None
+    assert cache.size == 0
+
+def test_a_zero_ttl_disables_the_cache(clock):
+    cache = ResultCache(ttl_seconds=0, max_bytes=1 << 20)
+    key = ResultCache.key("user", "pump", 3)
+    cache.put(key, results("doc-a"))
+    assert cache.get(key) is None
+
+def test_keys_are_per_user_and_normalize_the_query():
+    cache = ResultCache(ttl_seconds=60, max_bytes=1 << 20)
+    cache.put(ResultCache.key("alice", "Pump  House ", 3), results("doc-a"))
+
+    assert cache.get(ResultCache.key("alice", "pump house", 3)) == results("doc-a")
+    assert cache.get(ResultCache.key("bob", "pump house", 3)) is None
+    assert cache.get(ResultCache.key("alice", "pump house", 5)) is None
+
+def test_least_recently_used_entries_are_evicted_beyond_max_bytes():
+    entry = results("doc-a", padding=100)
+    cache = ResultCache(ttl_seconds=60, max_bytes=2 * size(entry) + 10)
+    first, second, third = (ResultCache.key("user", q, 3) for q in ("first", "second", "third"))
+    cache.put(first, entry)
+    cache.put(second, entry)
+    # a hit makes the first the most recently used
+    assert cache.get(first) is not None
+
+    cache.put(third, entry)
+
+    assert cache.get(second) is None
+    assert cache.get(first) is not None
+    assert cache.get(third) is not None
+    assert cache.size == 2 * size(entry)
+
+def test_results_larger_than_the_cache_are_not_stored():
+    entry = results("doc-a", padding=100)
+    cache = ResultCache(ttl_seconds=60, max_bytes=size(entry) - 1)
+    key = ResultCache.key("user", "pump", 3)
+    cache.put(key, entry)
+    assert cache.get(key) is None
+    assert cache.size == 0
+
+def test_invalidating_a_document_drops_every_result_referencing_it():
+    cache = ResultCache(ttl_seconds=60, max_bytes=1 << 20)
+    both = ResultCache.key("alice", "pump", 3)
+    other_user = ResultCache.key("bob", "valve", 3)
+    unrelated = ResultCache.key("alice", "fence", 3)
+    cache.put(both, results("doc-a", "doc-b"))
+    cache.put(other_user, results("doc-b"))
+    cache.put(unrelated, results("doc-c"))
+
+    cache.invalidate_document("doc-b")
+
+    assert cache.get(both) is None
+    assert cache.get(other_user) is None
+    assert cache.get(unrelated) == results("doc-c")
+    assert cache.size == size(results("doc-c"))
+    # the index by document doesn't keep dropped entries alive
+    cache.invalidate_document("doc-a")
+    assert cache.get(unrelated) is not None
@@ -140,6 +140,56 @@ const Main = () => {
         setSearchState({...searchState, results: response.data, loading: false});
     }
 
+    // one call instead of /extract-keywords followed by /suggestions: the backend streams results from
+    // the existing index first and the results refined with the extracted keywords afterwards
+    const askApi = async () => {
+
+        window.sessionStorage.setItem('app_query', searchState.query);
+
+        setSearchState(prev => ({...prev, results: [], loading: true}));
+
+        const accessToken = await getAccessToken();
+
+        try {
+            const response = await fetch(apiConfig.baseUri + '/ask', {
+                method: 'POST',
+                headers: { Authorization: `Bearer ${accessToken}`, 'Content-Type': 'application/json' },
+                body: JSON.stringify({ query: searchState.query, max_results: searchState.max_results })
+            });
+            // an error response is a JSON (or plain text) body, not a result stream
+            if (!response.ok) {
+                throw Error(`/ask failed with ${response.status}: ${await response.text()}`);
+            }
+            if (!response.body) {
+                return;
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) {
+                    break;
+                }
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop() ?? '';
+                for (const line of lines.filter(l => l.trim() !== '')) {
+                    const event = JSON.parse(line);
+                    if (event.stage === 'keywords') {
+                        setKeywordState(prev => ({ ...prev, autoExtracted: event.keywords, isManuallyEdited: false }));
+                        setSearchState(prev => ({ ...prev, keywords: event.keywords }));
+                    } else if (event.stage === 'indexed' || event.stage === 'refined') {
+                        setSearchState(prev => ({ ...prev, results: event.results }));
+                    }
+                }
+            }
+        } finally {
+            setSearchState(prev => ({ ...prev, loading: false }));
+        }
+    }
+
     const lightboxOpened = (item: any) => setLightbox({ open: true, image: apiConfig.baseUri+ "/media/" + item.snapshot })
     const lightboxClosed = () => setLightbox({open: false, image: ''});
 
@@ -265,6 +315,15 @@ const Main = () => {
                     loading={searchState.loading}
                     loadingPosition="end"
                     variant="contained">from preindexed</LoadingButton>            
+
+                <LoadingButton
+                    disabled={searchState.query.trim() === ''}
+                    sx={{ m: 1 }}
+                    onClick={() => askApi()}
+                    endIcon={<SendIcon />}
+                    loading={searchState.loading}
+                    loadingPosition="end"
+                    variant="contained">ask</LoadingButton>
             </Box>
             </Drawer>
 
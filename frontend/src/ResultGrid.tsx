@@ -54,7 +54,12 @@ const ResultGrid:React.FC<ResultGridProps> = ({results, onSelected, onQuery, onV
                     style={{ cursor: 'pointer' }}
                     onClick={() => onSelected(result)}
                     sx={{ width: 200, height: 200 }}
-                    image={apiConfig.baseUri+"/media/" + result.snapshot}/>
+                    image={apiConfig.baseUri+"/media/" + (result.thumbnail ?? result.snapshot)}
+                    // snapshots indexed before thumbnails existed only have the full image
+                    onError={(e: React.SyntheticEvent<HTMLImageElement>) => {
+                        const full = apiConfig.baseUri+"/media/" + result.snapshot;
+                        if (e.currentTarget.src !== full) e.currentTarget.src = full;
+                    }}/>
                 }
                 </Card></Grid>})
 